@@ -1,5 +1,7 @@
 import voxelbotutils as vbu
 
+from cogs import utils
+
 
 class BlockCommands(vbu.Cog):
 
@@ -21,8 +23,9 @@ class BlockCommands(vbu.Cog):
                 ON CONFLICT (user_id, blocked_user_id) DO NOTHING""",
                 ctx.author.id, user,
             )
-        async with self.bot.redis() as re:
-            await re.publish("BlockedUserAdd", {"user_id": ctx.author.id, "blocked_user_id": user})
+        utils.BlockedUserIndex.add(ctx.author.id, user)
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.ShardMessageCodec.publish(re, "BlockedUserAdd", {"user_id": ctx.author.id, "blocked_user_id": user})
         return await ctx.send("That user is now blocked.", wait=False)
 
     @vbu.command()
@@ -42,8 +45,9 @@ class BlockCommands(vbu.Cog):
                 """DELETE FROM blocked_user WHERE user_id=$1 AND blocked_user_id=$2""",
                 ctx.author.id, user,
             )
-        async with self.bot.redis() as re:
-            await re.publish("BlockedUserRemove", {"user_id": ctx.author.id, "blocked_user_id": user})
+        utils.BlockedUserIndex.remove(ctx.author.id, user)
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.ShardMessageCodec.publish(re, "BlockedUserRemove", {"user_id": ctx.author.id, "blocked_user_id": user})
         return await ctx.send("That user is now unblocked.", wait=False)
 
 
@@ -0,0 +1,63 @@
+import typing
+
+
+class BlockedUserIndex(object):
+    """
+    Every block that users have made, held in memory so that checking whether someone's been
+    blocked doesn't need a trip to the database.
+
+    The index is loaded from the database when the cache is set up, and is kept up to date by the
+    `BlockedUserAdd` and `BlockedUserRemove` shard messages. Each block is stored as a single integer
+    (the blocking user's ID in the high 64 bits, the blocked user's in the low 64) in one set.
+    """
+
+    blocked_pairs: typing.Set[int] = set()
+    loaded: bool = False
+
+    @staticmethod
+    def get_key(user_id: int, blocked_user_id: int) -> int:
+        """
+        Get the key that a block is stored under.
+        """
+
+        return (user_id << 64) | blocked_user_id
+
+    @classmethod
+    def load(cls, rows: typing.List[dict]) -> None:
+        """
+        Replace the index with the given rows from the `blocked_user` table.
+        """
+
+        cls.blocked_pairs = {cls.get_key(i['user_id'], i['blocked_user_id']) for i in rows}
+        cls.loaded = True
+
+    @classmethod
+    def add(cls, user_id: int, blocked_user_id: int) -> None:
+        """
+        Add a block to the index.
+        """
+
+        cls.blocked_pairs.add(cls.get_key(user_id, blocked_user_id))
+
+    @classmethod
+    def remove(cls, user_id: int, blocked_user_id: int) -> None:
+        """
+        Remove a block from the index.
+        """
+
+        cls.blocked_pairs.discard(cls.get_key(user_id, blocked_user_id))
+
+    @classmethod
+    def is_blocked(cls, user_id: int, blocked_user_id: int) -> bool:
+        """
+        Get whether a user has blocked another user.
+
+        Args:
+            user_id (int): The user who might have done the blocking.
+            blocked_user_id (int): The user who might have been blocked.
+
+        Returns:
+            bool: Whether or not `user_id` has blocked `blocked_user_id`.
+        """
+
+        return cls.get_key(user_id, blocked_user_id) in cls.blocked_pairs
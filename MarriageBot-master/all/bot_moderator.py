@@ -20,6 +20,52 @@ class BotModerator(vbu.Cog, command_attrs={'hidden': True}):
             await self.bot.startup()
         await ctx.okay()
 
+    @vbu.command()
+    @vbu.checks.is_bot_support()
+    @vbu.bot_has_permissions(send_messages=True)
+    async def migrateusernames(self, ctx: vbu.Context):
+        """
+        Moves user names from their old individual Redis keys into the bucketed name hashes,
+        and says how much memory Redis is using before and after.
+        """
+
+        async with ctx.typing():
+            async with utils.RedisPool.acquire(self.bot) as re:
+                memory_before = (await re.conn.info('memory'))['memory']['used_memory']
+                migrated = 0
+                keys = []
+                async for key in re.conn.iscan(match="UserName-*", count=1_000):
+                    keys.append(key.decode())
+                    if len(keys) >= 1_000:
+                        migrated += await self.migrate_user_name_keys(re, keys)
+                        keys.clear()
+                if keys:
+                    migrated += await self.migrate_user_name_keys(re, keys)
+                memory_after = (await re.conn.info('memory'))['memory']['used_memory']
+        await ctx.send(
+            (
+                f"Migrated `{migrated:,}` names. Redis went from using `{int(memory_before) / 1_048_576:,.1f}MiB` "
+                f"to `{int(memory_after) / 1_048_576:,.1f}MiB`."
+            ),
+            wait=False,
+        )
+
+    async def migrate_user_name_keys(self, re, keys: typing.List[str]) -> int:
+        """
+        Move a batch of old `UserName-<id>` keys into the name hashes, deleting the old keys.
+        """
+
+        values = await re.conn.mget(*keys, encoding="utf-8")
+        names = {
+            int(key[len("UserName-"):]): value
+            for key, value in zip(keys, values)
+            if value and value != "Deleted User"
+        }
+        if names:
+            await utils.DiscordNameManager.set_names_in_redis(re, names)
+        await re.conn.delete(*keys)
+        return len(names)
+
     @vbu.command()
     @vbu.checks.is_bot_support()
     @vbu.bot_has_permissions(send_messages=True)
@@ -85,11 +131,19 @@ class BotModerator(vbu.Cog, command_attrs={'hidden': True}):
         """
 
         async with self.bot.database() as db:
+            previous_rows = await db(
+                """SELECT purchased_by FROM guild_specific_families WHERE guild_id=$1""",
+                guild_id,
+            )
             await db(
                 """INSERT INTO guild_specific_families (guild_id, purchased_by) VALUES ($1, $2)
                 ON CONFLICT (guild_id) DO UPDATE SET purchased_by=excluded.purchased_by""",
                 guild_id, user_id,
             )
+            async with utils.RedisPool.acquire(self.bot) as re:
+                await utils.GoldGuildIndex.update(re, guild_id, user_id)
+                for purchaser_id in {user_id, *[i['purchased_by'] for i in previous_rows if i['purchased_by']]}:
+                    await utils.update_gold_guild_perks(db, re, purchaser_id)
         await ctx.okay()
 
     @vbu.command()
@@ -101,10 +155,14 @@ class BotModerator(vbu.Cog, command_attrs={'hidden': True}):
         """
 
         async with self.bot.database() as db:
-            await db(
-                """DELETE FROM guild_specific_families WHERE guild_id=$1""",
+            rows = await db(
+                """DELETE FROM guild_specific_families WHERE guild_id=$1 RETURNING purchased_by""",
                 guild_id,
             )
+            async with utils.RedisPool.acquire(self.bot) as re:
+                await utils.GoldGuildIndex.update(re, guild_id, None)
+                for purchaser_id in {i['purchased_by'] for i in rows if i['purchased_by']}:
+                    await utils.update_gold_guild_perks(db, re, purchaser_id)
         await ctx.okay()
 
     @vbu.command(hidden=True)
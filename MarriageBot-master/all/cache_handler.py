@@ -30,6 +30,13 @@ class CacheHandler(vbu.Cog):
         Set up the cache for the users.
         """
 
+        # Get where the family tree update log is before we load anything, so that we can replay
+        # whatever changes while we're loading
+        update_log_sequence = None
+        if vbu.RedisConnection.enabled:
+            async with utils.RedisPool.acquire(self.bot) as re:
+                update_log_sequence = await utils.FamilyTreeUpdateLog.get_current_sequence(re)
+
         # Get family data from database
         try:
             if self.bot.config['is_server_specific']:
@@ -56,6 +63,25 @@ class CacheHandler(vbu.Cog):
         for i in parents:
             self.handle_parent(dict(i))
 
+        # - blocked users
+        blocked_users = await db("SELECT user_id, blocked_user_id FROM blocked_user")
+        self.logger.info(f"Caching {len(blocked_users)} blocked users")
+        utils.BlockedUserIndex.load(blocked_users)
+
+        # - Gold guilds
+        gold_guilds = await db("SELECT guild_id, purchased_by FROM guild_specific_families")
+        self.logger.info(f"Caching {len(gold_guilds)} Gold guilds")
+        utils.GoldGuildIndex.load(gold_guilds)
+        if vbu.RedisConnection.enabled:
+            async with utils.RedisPool.acquire(self.bot) as re:
+                await utils.GoldGuildIndex.save_to_redis(re)
+
+        # Catch up on anything that changed while we were loading
+        if update_log_sequence is not None:
+            utils.FamilyTreeUpdateLog.last_applied_sequence = update_log_sequence
+            if not await utils.FamilyTreeUpdateLog.catch_up(self.bot):
+                self.logger.warning("Family tree update log was trimmed while caching - some changes may be missing")
+
         # And done
         self.logger.info("Family tree member caching complete")
         return True
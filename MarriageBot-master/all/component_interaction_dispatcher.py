@@ -0,0 +1,129 @@
+import asyncio
+import math
+import time
+import typing
+
+
+class ComponentInteractionWaiter(object):
+    """
+    Something that's waiting for a component on a given message to be interacted with.
+    """
+
+    __slots__ = ("message_id", "check", "future", "expiry_tick",)
+
+    def __init__(self, message_id: int, check: typing.Optional[typing.Callable], future: asyncio.Future, expiry_tick: int):
+        self.message_id = message_id
+        self.check = check
+        self.future = future
+        self.expiry_tick = expiry_tick
+
+
+class ComponentInteractionDispatcher(object):
+    """
+    Hands component interactions to whatever is waiting on the message that they came from.
+
+    Waiters are stored in a dict by message ID, so an interaction only ever runs the checks of the
+    waiters on its own message rather than every pending proposal's. Timeouts are kept in a timer
+    wheel of `WHEEL_SIZE` slots, each `TICK_LENGTH` seconds long, which is advanced once a tick rather
+    than having a separate timeout for every waiter.
+    """
+
+    TICK_LENGTH = 1  # Seconds
+    WHEEL_SIZE = 256  # Slots - a full turn should be longer than any timeout we use
+
+    waiters: typing.Dict[int, typing.List[ComponentInteractionWaiter]] = {}
+    wheel: typing.List[typing.Set[ComponentInteractionWaiter]] = [set() for _ in range(WHEEL_SIZE)]
+    current_tick: typing.Optional[int] = None  # The last tick that the wheel was advanced to
+
+    @classmethod
+    def get_tick(cls) -> int:
+        """
+        Get the tick that we're currently in.
+        """
+
+        tick = int(time.monotonic() / cls.TICK_LENGTH)
+        if cls.current_tick is None:
+            cls.current_tick = tick
+        return tick
+
+    @classmethod
+    async def wait_for(cls, message_id: int, *, check: typing.Callable = None, timeout: float):
+        """
+        Wait for a component on a message to be interacted with.
+
+        Args:
+            message_id (int): The ID of the message whose components we're waiting on.
+            check (typing.Callable, optional): Called with each interaction on the message - only
+                interactions that it returns True for are given back.
+            timeout (float): How many seconds to wait before giving up.
+
+        Returns:
+            vbu.ComponentInteractionPayload: The interaction.
+
+        Raises:
+            asyncio.TimeoutError: Nobody interacted with the message in time.
+        """
+
+        expiry_tick = cls.get_tick() + max(math.ceil(timeout / cls.TICK_LENGTH), 1)
+        waiter = ComponentInteractionWaiter(message_id, check, asyncio.get_event_loop().create_future(), expiry_tick)
+        cls.waiters.setdefault(message_id, []).append(waiter)
+        cls.wheel[expiry_tick % cls.WHEEL_SIZE].add(waiter)
+        try:
+            return await waiter.future
+        finally:
+            cls.remove(waiter)
+
+    @classmethod
+    def remove(cls, waiter: ComponentInteractionWaiter) -> None:
+        """
+        Stop a waiter from receiving any more interactions or timing out.
+        """
+
+        message_waiters = cls.waiters.get(waiter.message_id)
+        if message_waiters is not None:
+            try:
+                message_waiters.remove(waiter)
+            except ValueError:
+                pass
+            if not message_waiters:
+                del cls.waiters[waiter.message_id]
+        cls.wheel[waiter.expiry_tick % cls.WHEEL_SIZE].discard(waiter)
+
+    @classmethod
+    def dispatch(cls, payload) -> None:
+        """
+        Hand an interaction to anything that's waiting on its message.
+        """
+
+        message_waiters = cls.waiters.get(payload.message.id)
+        if not message_waiters:
+            return
+        for waiter in list(message_waiters):
+            if waiter.future.done():
+                continue
+            try:
+                if waiter.check is None or waiter.check(payload):
+                    waiter.future.set_result(payload)
+            except Exception as e:
+                waiter.future.set_exception(e)
+
+    @classmethod
+    def advance(cls) -> int:
+        """
+        Move the wheel up to the current tick, timing out anything that's expired on the way.
+
+        Returns:
+            int: How many waiters were timed out.
+        """
+
+        tick = cls.get_tick()
+        timed_out = 0
+        for slot_tick in range(cls.current_tick + 1, min(tick, cls.current_tick + cls.WHEEL_SIZE) + 1):
+            slot = cls.wheel[slot_tick % cls.WHEEL_SIZE]
+            for waiter in [i for i in slot if i.expiry_tick <= tick]:
+                slot.discard(waiter)
+                if not waiter.future.done():
+                    waiter.future.set_exception(asyncio.TimeoutError())
+                    timed_out += 1
+        cls.current_tick = max(cls.current_tick, tick)
+        return timed_out
@@ -34,6 +34,17 @@ class CustomisedTreeUser(object):
             return cls(**data[0])
         return cls(user_id)
 
+    @property
+    def style_key(self) -> tuple:
+        """
+        Everything about the user's customisations that changes how their tree looks.
+        """
+
+        return (
+            self.edge, self.node, self.font, self.highlighted_font,
+            self.highlighted_node, self.background, self.direction,
+        )
+
     @property
     def hex(self) -> dict:
         """
@@ -117,6 +128,40 @@ class CustomisedTreeUser(object):
             'direction': '"TB"',
         }
 
+    def style_dot_script(self, dot_script:str, highlighted_user_id:int=None) -> str:
+        """
+        Adds this user's colours to an unstyled DOT script. This works both for a script
+        that's yet to be laid out and for one that Graphviz has already positioned, so a cached
+        layout can be recoloured without having to lay it out again.
+
+        Args:
+            dot_script (str): The unstyled DOT script.
+            highlighted_user_id (int, optional): The ID of the user whose node should be highlighted.
+
+        Returns:
+            str: The styled DOT script.
+        """
+
+        hex_strings = self.hex
+        header = (
+            f"node [fontcolor={hex_strings['font']},color={hex_strings['edge']},fillcolor={hex_strings['node']}];"
+            f"edge [color={hex_strings['edge']}];"
+            f"bgcolor={hex_strings['background']};"
+        )
+        footer = ""
+        if highlighted_user_id is not None:
+            footer = f"{highlighted_user_id}[fillcolor={hex_strings['highlighted_node']}, fontcolor={hex_strings['highlighted_font']}];"
+
+        # Default attributes only apply to the nodes that come after them, so the header has to go
+        # at the very top of the graph, and the highlight right at the bottom
+        opening_index = dot_script.index("{") + 1
+        closing_index = dot_script.rindex("}")
+        return (
+            dot_script[:opening_index] + header
+            + dot_script[opening_index:closing_index] + footer
+            + dot_script[closing_index:]
+        )
+
     @classmethod
     def get_default_unquoted_hex(cls) -> dict:
         """
@@ -1,35 +1,235 @@
+import asyncio
+import collections
+import time
 import typing
 
+import discord
 import voxelbotutils as utils
 
+from cogs.utils.redis_pool import RedisPool
+
 
 class DiscordNameManager(object):
+    """
+    A bounded in-process cache of user names, sitting in front of Redis and the Discord API.
+
+    Names are kept for `name_ttl` seconds after they were last fetched, and the least recently
+    used names are evicted once there are more than `max_cached_names` of them, so a shard's memory
+    doesn't grow with every user that it's ever shown.
+    """
+
+    cached_names: typing.Dict[int, 'DiscordNameManager'] = collections.OrderedDict()
+    max_cached_names: int = 10_000
+    name_ttl: float = 300.0
+
+    # Fetches from the API that are currently running, so that concurrent lookups for the same user
+    # can share one request
+    fetches_in_flight: typing.Dict[int, asyncio.Task] = {}
+
+    # Users that the API told us don't exist recently, mapped to when we can try again
+    deleted_users: typing.Dict[int, float] = {}
+    deleted_user_ttl: float = 60.0
+    max_deleted_users: int = 10_000
+
+    # Names are stored in Redis as fields in a set of hash buckets, and a new set of buckets is used
+    # for each generation - a bucket expires two generations after it was last written to, so
+    # names that we haven't seen for a while fall out of Redis on their own
+    name_bucket_count: int = 65_536
+    name_generation_length: int = 7 * 24 * 60 * 60
 
-    cached_names: typing.Dict[int, 'DiscordNameManager'] = {}
+    # How the cache is doing - these are reported (and reset) by the name handler cog
+    cache_hits: int = 0
+    cache_misses: int = 0
+    cache_evictions: int = 0
 
-    __slots__ = ("user_id", "_name", "age",)
+    __slots__ = ("user_id", "_name", "fetched_at",)
 
     def __init__(self, user_id:int, name:str=None):
         self.user_id: int = user_id
-        self._name: str = name
-        self.age: int = 0 if self._name else 1_000
+        self._name: str = None
+        self.fetched_at: float = 0.0
+        self.name = name
         self.cached_names[self.user_id] = self
+        while len(self.cached_names) > self.max_cached_names:
+            self.cached_names.popitem(last=False)
+            self.__class__.cache_evictions += 1
 
     @property
     def name(self):
-        self.age += 1
         return self._name
 
     @name.setter
     def name(self, new_name:str):
         if new_name is None:
             return None
-        self.age = 0
+        self.fetched_at = time.monotonic()
         self._name = new_name
 
     @property
     def name_is_valid(self):
-        return self.age <= 3
+        return self._name is not None and time.monotonic() - self.fetched_at <= self.name_ttl
+
+    def mark_deleted(self) -> str:
+        """
+        Cache this user as deleted, but only for as long as our negative cache lasts, in case we
+        just failed to fetch them.
+        """
+
+        self.name = "Deleted User"
+        self.fetched_at -= max(self.name_ttl - self.deleted_user_ttl, 0)
+        return self.name
+
+    @classmethod
+    def get_cached(cls, user_id:int) -> 'DiscordNameManager':
+        """
+        Get the cache object for a given user, creating it if it doesn't exist, and recording
+        whether or not it had a valid name in it.
+        """
+
+        v = cls.cached_names.get(user_id)
+        if v is None:
+            v = cls(user_id)
+        else:
+            cls.cached_names.move_to_end(user_id)
+        if v.name_is_valid:
+            cls.cache_hits += 1
+        else:
+            cls.cache_misses += 1
+        return v
+
+    @classmethod
+    def pop_cache_stats(cls) -> typing.Dict[str, int]:
+        """
+        Get the hits, misses, and evictions since this was last called, as well as the current size
+        of the cache.
+        """
+
+        output = {
+            "hit": cls.cache_hits,
+            "miss": cls.cache_misses,
+            "eviction": cls.cache_evictions,
+            "size": len(cls.cached_names),
+        }
+        cls.cache_hits = cls.cache_misses = cls.cache_evictions = 0
+        return output
+
+    @classmethod
+    def get_name_generation(cls) -> int:
+        """
+        Get the generation that names are currently being written to.
+        """
+
+        return int(time.time() // cls.name_generation_length)
+
+    @classmethod
+    def get_name_bucket_key(cls, user_id:int, generation:int) -> str:
+        """
+        Get the Redis key of the hash that a user's name is stored in for a given generation.
+        """
+
+        return f"UserNames-{generation}-{user_id % cls.name_bucket_count}"
+
+    @classmethod
+    async def get_names_from_redis(cls, re, user_ids:typing.List[int]) -> typing.Dict[int, typing.Optional[str]]:
+        """
+        Get the names of a series of users from Redis in a single round trip. Names that are only
+        found in the previous generation are copied into the current one.
+
+        Args:
+            re (utils.redis.RedisConnection): The Redis connection to use.
+            user_ids (typing.List[int]): The IDs of the users we want to grab the names of.
+
+        Returns:
+            typing.Dict[int, typing.Optional[str]]: A dict of user ID to name, or None if they weren't in Redis.
+        """
+
+        generation = cls.get_name_generation()
+        pipeline = re.conn.pipeline()
+        for user_id in user_ids:
+            pipeline.hget(cls.get_name_bucket_key(user_id, generation), str(user_id), encoding="utf-8")
+            pipeline.hget(cls.get_name_bucket_key(user_id, generation - 1), str(user_id), encoding="utf-8")
+        results = await pipeline.execute()
+        names = {}
+        carry_forward = {}
+        for index, user_id in enumerate(user_ids):
+            current, previous = results[index * 2], results[(index * 2) + 1]
+            if current is None and previous is not None:
+                carry_forward[user_id] = previous
+            names[user_id] = current or previous
+        if carry_forward:
+            await cls.set_names_in_redis(re, carry_forward)
+        return names
+
+    @classmethod
+    async def set_names_in_redis(cls, re, names:typing.Dict[int, str]) -> None:
+        """
+        Write a series of names into Redis in a single round trip.
+
+        Args:
+            re (utils.redis.RedisConnection): The Redis connection to use.
+            names (typing.Dict[int, str]): A dict of user ID to name.
+        """
+
+        generation = cls.get_name_generation()
+        buckets: typing.Dict[str, list] = {}
+        for user_id, name in names.items():
+            buckets.setdefault(cls.get_name_bucket_key(user_id, generation), list()).extend([str(user_id), name])
+        pipeline = re.conn.pipeline()
+        for key, pairs in buckets.items():
+            pipeline.hmset(key, *pairs)
+            pipeline.expire(key, cls.name_generation_length * 2)
+        await pipeline.execute()
+
+    @classmethod
+    async def fetch_name_from_api(cls, bot:utils.Bot, user_id:int) -> typing.Optional[str]:
+        """
+        Fetch a user's name from the API. Concurrent calls for the same user share a single
+        request, and users that don't exist aren't fetched again until their negative cache
+        entry expires.
+
+        Args:
+            bot (utils.Bot): The bot instance that we can use to fetch from the API with.
+            user_id (int): The ID of the user we want to grab the name of.
+
+        Returns:
+            typing.Optional[str]: The user's name, or None if they don't exist.
+
+        Raises:
+            discord.HTTPException: We couldn't fetch the user for some other reason.
+        """
+
+        # See if they didn't exist recently
+        retry_at = cls.deleted_users.get(user_id)
+        if retry_at is not None:
+            if retry_at > time.monotonic():
+                return None
+            cls.deleted_users.pop(user_id, None)
+
+        # The fetch runs in its own task so that a caller being cancelled doesn't cancel it
+        # for everyone else that's waiting on it
+        async def fetch() -> typing.Optional[str]:
+            try:
+                user = await bot.fetch_user(user_id)
+            except discord.NotFound:
+                now = time.monotonic()
+                if len(cls.deleted_users) >= cls.max_deleted_users:
+                    cls.deleted_users = {i: o for i, o in cls.deleted_users.items() if o > now}
+                cls.deleted_users[user_id] = now + cls.deleted_user_ttl
+                return None
+            return str(user)
+
+        def on_done(task):
+            if cls.fetches_in_flight.get(user_id) is task:
+                del cls.fetches_in_flight[user_id]
+            if not task.cancelled():
+                task.exception()  # Anything waiting on the task gets the error - don't warn about it
+
+        task = cls.fetches_in_flight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            cls.fetches_in_flight[user_id] = task
+            task.add_done_callback(on_done)
+        return await asyncio.shield(task)
 
     async def fetch_name(self, bot:utils.Bot) -> str:
         """
@@ -38,18 +238,19 @@ class DiscordNameManager(object):
         the API).
         """
 
-        async with bot.redis() as re:
-            v = await re.get(f"UserName-{self.user_id}")
+        async with RedisPool.acquire(bot) as re:
+            v = (await self.get_names_from_redis(re, [self.user_id]))[self.user_id]
         if v:
             self.name = v
             return v
         try:
-            user = await bot.fetch_user(self.user_id)
-            name = str(user)
-        except Exception:
-            name = "Deleted User"
-        async with bot.redis() as re:
-            await re.set(f"UserName-{self.user_id}", name)
+            name = await self.fetch_name_from_api(bot, self.user_id)
+        except discord.HTTPException:
+            return "Deleted User"  # Not cached, so we'll try again next time
+        if name is None:
+            return self.mark_deleted()
+        async with RedisPool.acquire(bot) as re:
+            await self.set_names_in_redis(re, {self.user_id: name})
         self.name = name
         return name
 
@@ -67,9 +268,7 @@ class DiscordNameManager(object):
         """
 
         # Grab our cached object
-        v = cls.cached_names.get(user_id)
-        if v is None:
-            v = cls(user_id)
+        v = cls.get_cached(user_id)
 
         # See if it has a name
         if v.name_is_valid:
@@ -77,3 +276,74 @@ class DiscordNameManager(object):
 
         # Grab a new name from the cache for them
         return await v.fetch_name(bot)
+
+    @classmethod
+    async def fetch_names_by_ids(
+            cls, bot:utils.Bot, user_ids:typing.Iterable[int], *,
+            max_concurrent_fetches:int=10) -> typing.Dict[int, str]:
+        """
+        Get the names for a series of users given their IDs. Any names that aren't cached locally
+        are grabbed from Redis in one go, and anything that isn't in Redis is fetched from the API
+        concurrently and then written back to Redis in one go. Deleted users are only kept in our
+        negative cache, never in Redis.
+
+        Args:
+            bot (utils.Bot): The bot instance that we can use to fetch from the API/Redis with.
+            user_ids (typing.Iterable[int]): The IDs of the users we want to grab the names of.
+            max_concurrent_fetches (int, optional): The most users that we'll fetch from the API at once.
+
+        Returns:
+            typing.Dict[int, str]: A dict of user ID to name, in the order that the IDs were given.
+        """
+
+        # See which names we have cached already
+        user_ids = list(dict.fromkeys(user_ids))
+        names: typing.Dict[int, str] = {}
+        to_fetch: typing.List['DiscordNameManager'] = []
+        for user_id in user_ids:
+            v = cls.get_cached(user_id)
+            if v.name_is_valid:
+                names[user_id] = v.name
+            else:
+                to_fetch.append(v)
+        if not to_fetch:
+            return {i: names[i] for i in user_ids}
+
+        # Grab what we can from Redis
+        async with RedisPool.acquire(bot) as re:
+            redis_names = await cls.get_names_from_redis(re, [i.user_id for i in to_fetch])
+        missing: typing.List['DiscordNameManager'] = []
+        for v, name in zip(to_fetch, redis_names.values()):
+            if name:
+                v.name = name
+                names[v.user_id] = name
+            else:
+                missing.append(v)
+
+        # Fetch the rest from the API
+        if missing:
+            semaphore = asyncio.Semaphore(max_concurrent_fetches)
+
+            async def fetch_from_api(user_id:int) -> typing.Optional[str]:
+                async with semaphore:
+                    return await cls.fetch_name_from_api(bot, user_id)
+
+            api_names = await asyncio.gather(*[fetch_from_api(i.user_id) for i in missing], return_exceptions=True)
+            fetched_names = {}
+            for v, name in zip(missing, api_names):
+                if isinstance(name, discord.HTTPException):
+                    names[v.user_id] = "Deleted User"  # Not cached, so we'll try again next time
+                    continue
+                elif isinstance(name, BaseException):
+                    raise name
+                if name is None:
+                    names[v.user_id] = v.mark_deleted()
+                    continue
+                v.name = name
+                names[v.user_id] = fetched_names[v.user_id] = name
+            if fetched_names:
+                async with RedisPool.acquire(bot) as re:
+                    await cls.set_names_in_redis(re, fetched_names)
+
+        # And done
+        return {i: names[i] for i in user_ids}
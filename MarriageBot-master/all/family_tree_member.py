@@ -7,6 +7,7 @@ import voxelbotutils as utils
 from cogs.utils.customised_tree_user import CustomisedTreeUser
 from cogs.utils.family_tree.relationship_string_simplifier import RelationshipStringSimplifier as Simplifier
 from cogs.utils.discord_name_manager import DiscordNameManager
+from cogs.utils.native_tree_renderer import NativeTreeRenderer
 
 
 
@@ -21,8 +22,9 @@ class FamilyTreeMember(object):
 
     all_users: typing.Dict[typing.Tuple[int, int], 'FamilyTreeMember'] = {}
     INVISIBLE = "[shape=circle, label=\"\", height=0.001, width=0.001]"  # For the DOT script
+    mutation_count: int = 0  # How many times any member has been created or changed
 
-    __slots__ = ('id', '_children', '_parent', '_partner', 'tree_id', '_guild_id')
+    __slots__ = ('id', '_children', '_parent', '_partner', 'tree_id', '_guild_id', '_mutation')
 
     def __init__(self, discord_id:int, children:list=None, parent_id:int=None, partner_id:int=None, guild_id:int=0):
         self.id: int = discord_id
@@ -31,8 +33,18 @@ class FamilyTreeMember(object):
         self._partner: int = partner_id
         self._guild_id: int = guild_id
         self.tree_id: str = get_random_string()  # Used purely for the dot joining two spouses in the GZ script
+        self.mark_mutated()
         self.all_users[(self.id, self._guild_id)] = self
 
+    def mark_mutated(self) -> None:
+        """
+        Mark that this member has been changed, so that anything keyed on their family's version
+        (eg in-progress tree renders) isn't reused.
+        """
+
+        FamilyTreeMember.mutation_count += 1
+        self._mutation: int = FamilyTreeMember.mutation_count
+
     def __hash__(self):
         return hash((self.id, self._guild_id,))
 
@@ -371,7 +383,8 @@ class FamilyTreeMember(object):
 
     def generational_span(
             self, people_dict:dict=None, depth:int=0, add_parent:bool=False, expand_upwards:bool=False,
-            all_people:set=None, recursive_depth:int=0) -> typing.Dict[int, typing.List['FamilyTreeMember']]:
+            all_people:set=None, recursive_depth:int=0, depth_range:typing.Tuple[int, int]=None,
+            max_children:int=None) -> typing.Dict[int, typing.List['FamilyTreeMember']]:
         """
         Gets a list of every user related to this one.
         If "add_parent" and "expand_upwards" are True, then it should add every user in a given tree,
@@ -384,6 +397,8 @@ class FamilyTreeMember(object):
             expand_upwards (bool, optional): Whether or not to expand upwards in the tree.
             all_people (set, optional): A set of all people who this recursive function would look at.
             recursive_depth (int, optional): How far into the recursion you have gone - this is so we don't get recursion errors.
+            depth_range (typing.Tuple[int, int], optional): The lowest and highest generations that should be added to the span.
+            max_children (int, optional): The maximum number of children that should be added for each user.
 
         Returns:
             typing.Dict[int, typing.List['FamilyTreeMember']]: A dictionary of each generation of users.
@@ -398,6 +413,8 @@ class FamilyTreeMember(object):
             return people_dict
         if recursive_depth >= 500:
             return people_dict
+        if depth_range and not depth_range[0] <= depth <= depth_range[1]:
+            return people_dict
         all_people.add(self.id)
 
         # Add to dict
@@ -407,10 +424,13 @@ class FamilyTreeMember(object):
         # Add your children
         if self._children:
             children = self.children
+            if max_children is not None:
+                children = list(children)[:max_children]
             for child in children:
                 people_dict = child.generational_span(
                     people_dict, depth=depth + 1, add_parent=False, expand_upwards=expand_upwards,
-                    all_people=all_people, recursive_depth=recursive_depth + 1
+                    all_people=all_people, recursive_depth=recursive_depth + 1,
+                    depth_range=depth_range, max_children=max_children,
                 )
 
         # Add your partner
@@ -418,7 +438,8 @@ class FamilyTreeMember(object):
             partner = self.partner
             people_dict = partner.generational_span(
                 people_dict, depth=depth, add_parent=True, expand_upwards=expand_upwards,
-                all_people=all_people, recursive_depth=recursive_depth + 1
+                all_people=all_people, recursive_depth=recursive_depth + 1,
+                depth_range=depth_range, max_children=max_children,
             )
 
         # Add your parent
@@ -426,13 +447,60 @@ class FamilyTreeMember(object):
             parent = self.parent
             people_dict = parent.generational_span(
                 people_dict, depth=depth - 1, add_parent=True, expand_upwards=expand_upwards,
-                all_people=all_people, recursive_depth=recursive_depth + 1
+                all_people=all_people, recursive_depth=recursive_depth + 1,
+                depth_range=depth_range, max_children=max_children,
             )
 
         # Remove dupes, should they be in there
         return people_dict
 
-    async def to_dot_script(self, bot:utils.Bot, customised_tree_user:CustomisedTreeUser=None) -> str:
+    def windowed_generational_span(
+            self, generations_up:int=2, generations_down:int=2, max_children:int=10) -> typing.Dict[int, typing.List['FamilyTreeMember']]:
+        """
+        Gets a generational span of the whole family (including non-blood relatives) that's limited to a
+        number of generations around this user, so that very large families can be looked at a piece at a time.
+
+        Args:
+            generations_up (int, optional): How many generations above this user to include.
+            generations_down (int, optional): How many generations below this user to include.
+            max_children (int, optional): The maximum number of children to include for each user.
+
+        Returns:
+            typing.Dict[int, typing.List['FamilyTreeMember']]: A dictionary of each generation of users.
+        """
+
+        return self.generational_span(
+            add_parent=True, expand_upwards=True,
+            depth_range=(-generations_up, generations_down), max_children=max_children,
+        )
+
+    @staticmethod
+    def get_hidden_branches(gen_span:dict, reachable_users:typing.Set[int]=None) -> typing.List['FamilyTreeMember']:
+        """
+        Gets the users in a generational span who have a parent or children that aren't in the span.
+
+        Args:
+            gen_span (dict): The generational span.
+            reachable_users (typing.Set[int], optional): The IDs of the only users who count as being cut off - eg
+                the users in the whole of the tree that the span was taken from.
+
+        Returns:
+            typing.List[FamilyTreeMember]: The users whose relatives have been cut off.
+        """
+
+        all_users = {i.id for generation in gen_span.values() for i in generation}
+
+        def is_hidden(user_id):
+            return user_id not in all_users and (reachable_users is None or user_id in reachable_users)
+
+        output = []
+        for generation in gen_span.values():
+            for i in generation:
+                if (i._parent and is_hidden(i._parent)) or any(is_hidden(o) for o in i._children):
+                    output.append(i)
+        return output
+
+    async def to_dot_script(self, bot:utils.Bot, customised_tree_user:CustomisedTreeUser=None, *, styled:bool=True) -> str:
         """
         Gives you a string of the current family tree that will go through DOT.
 
@@ -440,6 +508,8 @@ class FamilyTreeMember(object):
             bot (utils.Bot): The bot instance that should be used to get the names of users.
             customised_tree_user (CustomisedTreeUser, optional): The customised tree object that should be used to alter how the
                 dot script looks.
+            styled (bool, optional): Whether or not to add the user's colours to the script. If not, only the
+                structure of the tree (and its direction) is output.
 
         Returns:
             str: The generated DOT code.
@@ -447,9 +517,9 @@ class FamilyTreeMember(object):
 
         root_user = self.get_root()
         gen_span = root_user.generational_span()
-        return await self.to_dot_script_from_generational_span(bot, gen_span, customised_tree_user)
+        return await self.to_dot_script_from_generational_span(bot, gen_span, customised_tree_user, styled=styled)
 
-    async def to_full_dot_script(self, bot:utils.Bot, customised_tree_user:CustomisedTreeUser=None) -> str:
+    async def to_full_dot_script(self, bot:utils.Bot, customised_tree_user:CustomisedTreeUser=None, *, styled:bool=True) -> str:
         """
         Gives you the string of the FULL current family.
 
@@ -457,6 +527,8 @@ class FamilyTreeMember(object):
             bot (utils.Bot): The bot instance that should be used to get the names of users.
             customised_tree_user (CustomisedTreeUser, optional): The customised tree object that should be used to alter how the
                 dot script looks.
+            styled (bool, optional): Whether or not to add the user's colours to the script. If not, only the
+                structure of the tree (and its direction) is output.
 
         Returns:
             str: The generated DOT code.
@@ -464,20 +536,18 @@ class FamilyTreeMember(object):
 
         root_user = self.get_root()
         gen_span = root_user.generational_span(expand_upwards=True, add_parent=True)
-        return await self.to_dot_script_from_generational_span(bot, gen_span, customised_tree_user)
+        return await self.to_dot_script_from_generational_span(bot, gen_span, customised_tree_user, styled=styled)
 
-    async def to_dot_script_from_generational_span(self, bot:utils.Bot, gen_span:dict, customised_tree_user:CustomisedTreeUser) -> str:
+    def add_relations_to_generational_span(self, gen_span:dict) -> dict:
         """
-        Generates the DOT script from a given generational span.
+        Adds this user's partner and parent to a generational span (in place), so that they're
+        always shown on a tree centred on this user.
 
         Args:
-            bot (utils.Bot): The bot instance that should be used to get the names of users.
             gen_span (dict): The generational span.
-            customised_tree_user (CustomisedTreeUser, optional): The customised tree object that should be used to alter how the
-                dot script looks.
 
         Returns:
-            str: The generated DOT code.
+            dict: The same generational span.
         """
 
         # Find my own depth
@@ -500,33 +570,76 @@ class FamilyTreeMember(object):
                 x = gen_span.get(my_depth - 1, list())
                 x.append(parent)
                 gen_span[my_depth - 1] = x
+        return gen_span
+
+    async def to_svg_from_generational_span(self, bot:utils.Bot, gen_span:dict, customised_tree_user:CustomisedTreeUser) -> NativeTreeRenderer:
+        """
+        Lays out a generational span without going through Graphviz. This is only meant for small
+        families - the layout is a lot simpler than the one that DOT gives.
+
+        Args:
+            bot (utils.Bot): The bot instance that should be used to get the names of users.
+            gen_span (dict): The generational span.
+            customised_tree_user (CustomisedTreeUser): The customised tree object that should be used to colour the tree.
+
+        Returns:
+            NativeTreeRenderer: The renderer that can write the tree as an SVG or PNG.
+        """
+
+        self.add_relations_to_generational_span(gen_span)
+        names = await DiscordNameManager.fetch_names_by_ids(
+            bot, [i.id for generation in gen_span.values() for i in generation],
+        )
+        return NativeTreeRenderer(gen_span, names, customised_tree_user, self.id)
+
+    async def to_dot_script_from_generational_span(
+            self, bot:utils.Bot, gen_span:dict, customised_tree_user:CustomisedTreeUser, *, styled:bool=True) -> str:
+        """
+        Generates the DOT script from a given generational span.
+
+        The script is built without any colours so that the same family structure always gives the
+        same script, and the colours are then added on top by the customised tree user (if we're asked
+        to style it at all).
+
+        Args:
+            bot (utils.Bot): The bot instance that should be used to get the names of users.
+            gen_span (dict): The generational span.
+            customised_tree_user (CustomisedTreeUser, optional): The customised tree object that should be used to alter how the
+                dot script looks.
+            styled (bool, optional): Whether or not to add the user's colours to the script.
+
+        Returns:
+            str: The generated DOT code.
+        """
+
+        if customised_tree_user is None:
+            customised_tree_user = CustomisedTreeUser(self.id)
+        self.add_relations_to_generational_span(gen_span)
 
         # Make some initial digraph stuff
         all_text: str = (
             "digraph {"
-            f"node [shape=box,fontcolor={customised_tree_user.hex['font']},color={customised_tree_user.hex['edge']},"
-            f"fillcolor={customised_tree_user.hex['node']},style=filled];"
-            f"edge [dir=none,color={customised_tree_user.hex['edge']}];"
-            f"bgcolor={customised_tree_user.hex['background']};"
+            "node [shape=box,style=filled];"
+            "edge [dir=none];"
             f"rankdir={customised_tree_user.hex['direction']};"
         )
 
         # Set up some stuff for later
         all_users: typing.Set['FamilyTreeMember'] = set()
-        user_parent_tree: typing.Dict['FamilyTreeMember', str] = {}  # Connects a parent to a random string used to connect the children
+        user_parent_tree: typing.Dict['FamilyTreeMember', str] = {}  # Connects a parent to a string used to connect the children
 
         # Add the username for each user (from unflattened list)
+        names = await DiscordNameManager.fetch_names_by_ids(
+            bot, [i.id for generation in gen_span.values() for i in generation],
+        )
         for generation in gen_span.values():
             for i in generation:
-                name = await DiscordNameManager.fetch_name_by_id(bot, i.id)
+                name = names.get(i.id)
                 if name is None:
                     continue
                 all_users.add(i)
                 name = name.replace('"', '\\"')
-                if i == self:
-                    all_text += f'{i.id}[label="{name}", fillcolor={customised_tree_user.hex["highlighted_node"]}, fontcolor={customised_tree_user.hex["highlighted_font"]}];'
-                else:
-                    all_text += f'{i.id}[label="{name}"];'
+                all_text += f'{i.id}[label="{name}"];'
 
         # Order the generations
         generation_numbers: typing.List[int] = sorted(list(gen_span.keys()))  # The ordered list of generation numbers - just a list of sequential numbers
@@ -563,8 +676,9 @@ class FamilyTreeMember(object):
                 # Add the user and their partner
                 if partner and partner in generation:
 
-                    # Set their user parent tree so they share a family value
-                    user_parent_tree[partner.id] = user_parent_tree[person.id] = get_random_string()
+                    # Set their user parent tree so they share a family value - this needs to be the same
+                    # every time we generate the script so that we can cache the layout
+                    user_parent_tree[partner.id] = user_parent_tree[person.id] = f"p{person.id}_{partner.id}"
 
                     # Add the users and family value
                     all_text += f"{person.id} -> {user_parent_tree[person.id]} -> {partner.id};"
@@ -602,4 +716,6 @@ class FamilyTreeMember(object):
 
         # And we're done!
         all_text += "}"
+        if styled:
+            return customised_tree_user.style_dot_script(all_text, self.id)
         return all_text
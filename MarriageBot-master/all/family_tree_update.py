@@ -0,0 +1,295 @@
+import asyncio
+import json
+import typing
+
+from cogs.utils.family_tree.family_tree_member import FamilyTreeMember
+from cogs.utils.redis_pool import RedisPool
+from cogs.utils.shard_message_codec import ShardMessageCodec
+
+
+class FamilyTreeUpdate(object):
+    """
+    A single operation on the family graph (a marriage, an adoption, an abandonment, etc), described
+    as the partner and child links that it adds and removes.
+
+    An update is published over Redis once per operation, and applying it is synchronous so that
+    no other task on a shard can see the operation half done. Applying an update twice does nothing
+    the second time, so the shard that made the change can apply it locally and still receive its
+    own event.
+    """
+
+    ADD_PARTNER = "add_partner"
+    REMOVE_PARTNER = "remove_partner"
+    ADD_CHILD = "add_child"
+    REMOVE_CHILD = "remove_child"
+
+    __slots__ = ("guild_id", "changes", "sequence",)
+
+    def __init__(self, guild_id: int = 0, changes: typing.List[typing.List] = None, sequence: int = None):
+        self.guild_id: int = guild_id
+        self.changes: typing.List[typing.List] = changes or list()  # [operation, user ID, other user ID]
+        self.sequence: typing.Optional[int] = sequence  # Given by the update log when the update is published
+
+    def __repr__(self) -> str:
+        return f"FamilyTreeUpdate[{self.guild_id} <{len(self.changes)} changes>]"
+
+    def add_partner(self, user_id: int, partner_id: int) -> 'FamilyTreeUpdate':
+        """
+        Marry two users.
+        """
+
+        self.changes.append([self.ADD_PARTNER, user_id, partner_id])
+        return self
+
+    def remove_partner(self, user_id: int, partner_id: int) -> 'FamilyTreeUpdate':
+        """
+        Divorce two users.
+        """
+
+        self.changes.append([self.REMOVE_PARTNER, user_id, partner_id])
+        return self
+
+    def add_child(self, parent_id: int, child_id: int) -> 'FamilyTreeUpdate':
+        """
+        Make a user the child of another.
+        """
+
+        self.changes.append([self.ADD_CHILD, parent_id, child_id])
+        return self
+
+    def remove_child(self, parent_id: int, child_id: int) -> 'FamilyTreeUpdate':
+        """
+        Remove a user from being the child of another.
+        """
+
+        self.changes.append([self.REMOVE_CHILD, parent_id, child_id])
+        return self
+
+    @property
+    def user_ids(self) -> typing.List[int]:
+        """
+        The IDs of all of the users affected by the update.
+        """
+
+        return list(dict.fromkeys(i for _, user_id, other_id in self.changes for i in (user_id, other_id)))
+
+    def to_json(self) -> dict:
+        """
+        Converts the update to JSON format so you can throw it through Redis.
+        """
+
+        return {
+            'guild_id': self.guild_id,
+            'changes': self.changes,
+            'user_ids': self.user_ids,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'FamilyTreeUpdate':
+        """
+        Loads a FamilyTreeUpdate object from JSON.
+        """
+
+        return cls(guild_id=data['guild_id'], changes=data['changes'], sequence=data.get('sequence'))
+
+    def apply(self) -> None:
+        """
+        Apply the update to the cached family tree members.
+        """
+
+        for operation, user_id, other_id in self.changes:
+            user = FamilyTreeMember.get(user_id, self.guild_id)
+            other = FamilyTreeMember.get(other_id, self.guild_id)
+            user.mark_mutated()
+            other.mark_mutated()
+            if operation == self.ADD_PARTNER:
+                user._partner = other.id
+                other._partner = user.id
+            elif operation == self.REMOVE_PARTNER:
+                if user._partner == other.id:
+                    user._partner = None
+                if other._partner == user.id:
+                    other._partner = None
+            elif operation == self.ADD_CHILD:
+                if other.id not in user._children:
+                    user._children.append(other.id)
+                other._parent = user.id
+            elif operation == self.REMOVE_CHILD:
+                try:
+                    user._children.remove(other.id)
+                except ValueError:
+                    pass
+                if other._parent == user.id:
+                    other._parent = None
+
+    async def publish(self, re) -> None:
+        """
+        Apply the update locally, add it to the update log, and send it to every other shard.
+
+        Args:
+            re (utils.redis.RedisConnection): The Redis connection to publish over.
+        """
+
+        self.apply()
+        self.sequence = await FamilyTreeUpdateLog.publish(re, self)
+
+
+class FamilyTreeUpdateLog(object):
+    """
+    A durable, sequence numbered log of every family tree update, kept in a Redis stream.
+
+    Each update is given the next sequence number, added to the stream, and published in a single
+    script so that the three can't disagree about the order of updates. Each shard remembers the
+    sequence number of the last update that it applied; when an update arrives with a gap before it
+    (or a periodic check finds that the log has moved on) the missing updates are replayed from the
+    stream in order, so a shard that missed some updates catches up without reloading everything.
+    """
+
+    SEQUENCE_KEY = "FamilyTreeUpdateSequence"
+    STREAM_KEY = "FamilyTreeUpdateLog"
+    MAX_LOG_LENGTH = 100_000
+
+    # The message is built from the start of its header (version, type, guild ID), the sequence number
+    # as 8 big endian bytes, and its body - see ShardMessageCodec
+    PUBLISH_SCRIPT = """
+    local sequence = redis.call('INCR', KEYS[1])
+    local remaining = sequence
+    local sequence_bytes = {}
+    for i = 8, 1, -1 do
+        sequence_bytes[i] = string.char(remaining % 256)
+        remaining = math.floor(remaining / 256)
+    end
+    local payload = ARGV[1] .. table.concat(sequence_bytes) .. ARGV[2]
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], sequence .. '-0', 'payload', payload)
+    redis.call('PUBLISH', ARGV[4], payload)
+    return sequence
+    """
+
+    last_applied_sequence: typing.Optional[int] = None
+    _lock: typing.Optional[asyncio.Lock] = None
+
+    @classmethod
+    def get_lock(cls) -> asyncio.Lock:
+        """
+        Gets the lock that stops updates being applied while we're catching up.
+        """
+
+        if cls._lock is None:
+            cls._lock = asyncio.Lock()
+        return cls._lock
+
+    @classmethod
+    async def publish(cls, re, update: FamilyTreeUpdate) -> int:
+        """
+        Add an update to the log and publish it.
+
+        Args:
+            re (utils.redis.RedisConnection): The Redis connection to use.
+            update (FamilyTreeUpdate): The update to publish.
+
+        Returns:
+            int: The sequence number that the update was given.
+        """
+
+        header = ShardMessageCodec.encode_header("FamilyTreeUpdate", update.guild_id)
+        return await re.conn.eval(
+            cls.PUBLISH_SCRIPT,
+            keys=[cls.SEQUENCE_KEY, cls.STREAM_KEY],
+            args=[
+                header[:-8],  # Everything but the sequence number
+                ShardMessageCodec.encode_body(update.to_json()),
+                cls.MAX_LOG_LENGTH,
+                ShardMessageCodec.CHANNEL_NAME,
+            ],
+        )
+
+    @staticmethod
+    def decode(data: bytes) -> FamilyTreeUpdate:
+        """
+        Decode an update from the log, which may be from before the log used the binary format.
+        """
+
+        if data[:1] == b"{":
+            return FamilyTreeUpdate.from_json(json.loads(data))
+        _, _, sequence = ShardMessageCodec.decode_header(data)
+        return FamilyTreeUpdate.from_json({**ShardMessageCodec.decode_body(data), 'sequence': sequence})
+
+    @classmethod
+    async def get_current_sequence(cls, re) -> int:
+        """
+        Get the sequence number of the latest update in the log.
+        """
+
+        return int(await re.get(cls.SEQUENCE_KEY) or 0)
+
+    @classmethod
+    async def receive(cls, bot, update: FamilyTreeUpdate) -> bool:
+        """
+        Apply an update that's been received over Redis, replaying any updates that we missed
+        before it.
+
+        Args:
+            bot (utils.Bot): The bot instance to get a Redis connection from.
+            update (FamilyTreeUpdate): The update that was received.
+
+        Returns:
+            bool: Whether or not we're in sync with the log - if not then the cache needs to be reloaded.
+        """
+
+        # Updates from shards that don't use the log, or before we know where we are in it, are just applied
+        if update.sequence is None or cls.last_applied_sequence is None:
+            update.apply()
+            return True
+
+        # Apply it in order
+        async with cls.get_lock():
+            if update.sequence <= cls.last_applied_sequence:
+                return True
+            if update.sequence > cls.last_applied_sequence + 1:
+                if not await cls._catch_up(bot, update.sequence - 1):
+                    return False
+            update.apply()
+            cls.last_applied_sequence = update.sequence
+        return True
+
+    @classmethod
+    async def catch_up(cls, bot, up_to: int = None) -> bool:
+        """
+        Replay any updates in the log that we haven't applied.
+
+        Args:
+            bot (utils.Bot): The bot instance to get a Redis connection from.
+            up_to (int, optional): The last sequence number to replay - the latest in the log by default.
+
+        Returns:
+            bool: Whether or not we're in sync with the log - if not then the cache needs to be reloaded.
+        """
+
+        async with cls.get_lock():
+            return await cls._catch_up(bot, up_to)
+
+    @classmethod
+    async def _catch_up(cls, bot, up_to: int = None) -> bool:
+        if cls.last_applied_sequence is None:
+            return True
+        async with RedisPool.acquire(bot) as re:
+            if up_to is None:
+                up_to = await cls.get_current_sequence(re)
+            if up_to <= cls.last_applied_sequence:
+                return True
+            entries = await re.conn.xrange(
+                cls.STREAM_KEY,
+                start=f"{cls.last_applied_sequence + 1}-0",
+                stop=f"{up_to}-0",
+            )
+
+        # Make sure that the log still has everything we missed
+        if len(entries) != up_to - cls.last_applied_sequence:
+            return False
+
+        # Replay them
+        for _, fields in entries:
+            update = cls.decode(fields[b'payload'])
+            update.apply()
+            cls.last_applied_sequence = update.sequence
+        return True
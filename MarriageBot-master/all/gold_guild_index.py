@@ -0,0 +1,167 @@
+import typing
+
+from cogs.utils.shard_message_codec import ShardMessageCodec
+
+
+class GoldGuildIndex(object):
+    """
+    Which guilds have MarriageBot Gold, and who bought it for them, held in memory so that checking
+    a guild or a purchaser doesn't need a trip to the database.
+
+    Each shard loads the index from the database when its cache is set up. The first one to find the
+    Redis hash (guild ID: purchaser ID) missing fills it in, for anything that doesn't hold the index
+    itself, like the website. Changes are made through `update`, which writes to the hash (if it's
+    there - otherwise the next shard to start fills it in from the database) and sends the change to
+    every shard.
+    """
+
+    REDIS_KEY = "GoldGuilds"
+
+    # KEYS: hash; ARGV: guild ID, purchaser ID, ... - only fills in the hash if it's missing, so that
+    # one shard's snapshot doesn't overwrite changes made since another's
+    SAVE_IF_MISSING_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        return 0
+    end
+    for i = 1, #ARGV, 2 do
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    return 1
+    """
+
+    # KEYS: hash; ARGV: guild ID, purchaser ID - doesn't create the hash with just the one guild in it
+    SET_IF_SAVED_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+    """
+
+    purchasers: typing.Dict[int, int] = {}  # Guild ID: purchaser ID (0 if we don't know who bought it)
+    guilds_by_purchaser: typing.Dict[int, typing.Set[int]] = {}  # Purchaser ID: guild IDs
+    loaded: bool = False
+
+    @classmethod
+    def load(cls, rows: typing.List[dict]) -> None:
+        """
+        Replace the index with the given rows from the `guild_specific_families` table.
+        """
+
+        cls.purchasers = {}
+        cls.guilds_by_purchaser = {}
+        for row in rows:
+            cls.apply(row['guild_id'], row['purchased_by'] or 0)
+        cls.loaded = True
+
+    @classmethod
+    def apply(cls, guild_id: int, purchaser_id: typing.Optional[int]) -> None:
+        """
+        Change who bought Gold for a guild in the index.
+
+        Args:
+            guild_id (int): The guild that's changed.
+            purchaser_id (typing.Optional[int]): The user who bought Gold for the guild, 0 if we don't
+                know, or None if the guild doesn't have Gold any more.
+        """
+
+        previous_purchaser_id = cls.purchasers.pop(guild_id, None)
+        if previous_purchaser_id is not None:
+            purchased_guilds = cls.guilds_by_purchaser.get(previous_purchaser_id, set())
+            purchased_guilds.discard(guild_id)
+            if not purchased_guilds:
+                cls.guilds_by_purchaser.pop(previous_purchaser_id, None)
+        if purchaser_id is not None:
+            cls.purchasers[guild_id] = purchaser_id
+            cls.guilds_by_purchaser.setdefault(purchaser_id, set()).add(guild_id)
+
+    @classmethod
+    def is_gold_guild(cls, guild_id: int) -> bool:
+        """
+        Get whether a guild has MarriageBot Gold.
+        """
+
+        return guild_id in cls.purchasers
+
+    @classmethod
+    def get_purchased_guilds(cls, user_id: int) -> typing.Set[int]:
+        """
+        Get the IDs of the guilds that a user has bought MarriageBot Gold for.
+        """
+
+        return cls.guilds_by_purchaser.get(user_id, set())
+
+    @classmethod
+    async def save_to_redis(cls, re) -> bool:
+        """
+        Fill in the Redis hash with what's in the index, if nothing has filled it in already.
+
+        Returns:
+            bool: Whether the hash was filled in.
+        """
+
+        if not cls.purchasers or await re.conn.exists(cls.REDIS_KEY):
+            return False  # Don't send the whole index just for the script to find the hash is there
+        args = [i for item in cls.purchasers.items() for i in item]
+        return bool(await re.conn.eval(cls.SAVE_IF_MISSING_SCRIPT, keys=[cls.REDIS_KEY], args=args))
+
+    @classmethod
+    async def fetch_purchasers(cls, re, guild_ids: typing.List[int]) -> typing.Optional[typing.Dict[int, int]]:
+        """
+        Get who bought Gold for some guilds from Redis, for anything that doesn't hold the index.
+
+        Args:
+            re (utils.RedisConnection): The Redis connection to use.
+            guild_ids (typing.List[int]): The guilds to look up.
+
+        Returns:
+            typing.Optional[typing.Dict[int, int]]: Guild ID: purchaser ID, for only the guilds that have
+                Gold - or None if the hash is missing, in which case use `fetch_purchasers_from_db`.
+        """
+
+        if not guild_ids:
+            return {}
+        pipeline = re.conn.pipeline()
+        pipeline.exists(cls.REDIS_KEY)
+        pipeline.hmget(cls.REDIS_KEY, *guild_ids)
+        exists, data = await pipeline.execute()
+        if not exists:
+            return None
+        return {i: int(o) for i, o in zip(guild_ids, data) if o is not None}
+
+    @staticmethod
+    async def fetch_purchasers_from_db(db, guild_ids: typing.List[int]) -> typing.Dict[int, int]:
+        """
+        Get who bought Gold for some guilds from the database, for when the Redis hash is missing.
+        """
+
+        if not guild_ids:
+            return {}
+        rows = await db(
+            """SELECT guild_id, purchased_by FROM guild_specific_families WHERE guild_id=ANY($1::BIGINT[])""",
+            guild_ids,
+        )
+        return {i['guild_id']: i['purchased_by'] or 0 for i in rows}
+
+    @classmethod
+    async def update(cls, re, guild_id: int, purchaser_id: typing.Optional[int]) -> None:
+        """
+        Change who bought Gold for a guild everywhere - in this process, in Redis, and on every shard.
+
+        Args:
+            re (utils.RedisConnection): The Redis connection to use.
+            guild_id (int): The guild that's changed.
+            purchaser_id (typing.Optional[int]): The user who bought Gold for the guild, or None if
+                the guild doesn't have Gold any more.
+        """
+
+        if purchaser_id is None:
+            await re.conn.hdel(cls.REDIS_KEY, guild_id)
+        else:
+            await re.conn.eval(cls.SET_IF_SAVED_SCRIPT, keys=[cls.REDIS_KEY], args=[guild_id, purchaser_id or 0])
+        if cls.loaded:
+            cls.apply(guild_id, purchaser_id)
+        await ShardMessageCodec.publish(
+            re, "UpdateGoldGuild", {"guild_id": guild_id, "user_id": purchaser_id},
+            guild_id=0,  # Every shard needs to know about every guild's purchaser
+        )
@@ -0,0 +1,141 @@
+import asyncio
+import collections
+import typing
+
+
+class GuildSettingsCache(object):
+    """
+    MarriageBot's own settings for each guild (incest, max family members, gifs, and max children),
+    loaded from the database the first time that a guild is used rather than all at startup.
+
+    Only the most recently used `max_cached_guilds` guilds are kept, so guilds that have gone idle
+    are dropped and loaded again if they're used later. Updates from other shards are only applied to
+    guilds that are cached - a guild that isn't will get the new settings from the database when it's
+    loaded anyway.
+    """
+
+    max_cached_guilds: int = 10_000
+    default_settings: dict = {
+        'allow_incest': False,
+        'max_family_members': 2_000,
+        'gifs_enabled': True,
+    }
+
+    cached_settings: typing.Dict[int, dict] = collections.OrderedDict()
+    loads_in_flight: typing.Dict[int, asyncio.Task] = {}
+    pending_updates: typing.Dict[int, dict] = {}  # Updates that arrived while the guild was being loaded
+
+    @classmethod
+    async def get(cls, bot, guild_id: int) -> dict:
+        """
+        Get the settings for a guild, loading them if they're not cached.
+
+        Args:
+            bot (utils.Bot): The bot instance to load the settings with.
+            guild_id (int): The ID of the guild.
+
+        Returns:
+            dict: The guild's settings, with the guild's max children per role under `max_children`.
+        """
+
+        settings = cls.cached_settings.get(guild_id)
+        if settings is not None:
+            cls.cached_settings.move_to_end(guild_id)
+            return settings
+
+        # Load them, unless we're loading them already
+        def on_done(task):
+            cls.loads_in_flight.pop(guild_id, None)
+            cls.pending_updates.pop(guild_id, None)
+            if not task.cancelled():
+                task.exception()  # Anything waiting on the task gets the error - don't warn about it
+
+        task = cls.loads_in_flight.get(guild_id)
+        if task is None:
+            task = bot.loop.create_task(cls.load(bot, guild_id))
+            cls.loads_in_flight[guild_id] = task
+            task.add_done_callback(on_done)
+        return await asyncio.shield(task)
+
+    @classmethod
+    async def load(cls, bot, guild_id: int) -> dict:
+        """
+        Load the settings for a guild from the database and cache them.
+        """
+
+        async with bot.database() as db:
+            settings_rows = await db(
+                """SELECT * FROM guild_settings WHERE guild_id=$1 OR guild_id=0 ORDER BY guild_id DESC LIMIT 1""",
+                guild_id,
+            )
+            max_children_rows = await db(
+                """SELECT role_id, amount FROM max_children_amount WHERE guild_id=$1""",
+                guild_id,
+            )
+        settings = cls.default_settings.copy()
+        if settings_rows:
+            settings.update({i: o for i, o in dict(settings_rows[0]).items() if i in cls.default_settings and o is not None})
+        settings['max_children'] = {i['role_id']: i['amount'] for i in max_children_rows}
+        settings.update(cls.pending_updates.pop(guild_id, {}))
+        settings['max_children_roles'] = cls.get_max_children_roles(settings['max_children'])
+        cls.cached_settings[guild_id] = settings
+        while len(cls.cached_settings) > cls.max_cached_guilds:
+            cls.cached_settings.popitem(last=False)
+        return settings
+
+    @classmethod
+    def update(cls, guild_id: int, **settings) -> None:
+        """
+        Change the settings for a guild, if it's cached or being loaded.
+        """
+
+        cached = cls.cached_settings.get(guild_id)
+        if cached is not None:
+            cached.update(settings)
+            if 'max_children' in settings:
+                cached['max_children_roles'] = cls.get_max_children_roles(settings['max_children'])
+        elif guild_id in cls.loads_in_flight:
+            cls.pending_updates.setdefault(guild_id, {}).update(settings)
+
+    @staticmethod
+    def get_max_children_roles(max_children: typing.Optional[dict]) -> typing.List[typing.Tuple[int, int]]:
+        """
+        Turn a guild's max children per role into a list of `(amount, role ID)`, largest amount first,
+        so that the first role a member has is the one that gives them the most children.
+        """
+
+        return sorted(
+            ((int(amount), int(role_id)) for role_id, amount in (max_children or {}).items()),
+            reverse=True,
+        )
+
+    @classmethod
+    def get_max_children_for_roles(cls, settings: dict, role_ids: typing.Sequence[int]) -> int:
+        """
+        Get the most children that any of the given roles allow in a guild, or 0 if none of them are set.
+        """
+
+        for amount, role_id in settings['max_children_roles']:
+            if role_id in role_ids:
+                return amount
+        return 0
+
+    @classmethod
+    async def guild_allows_incest(cls, ctx) -> bool:
+        """
+        Get whether the guild that a command was run in allows incest.
+        """
+
+        if not ctx.bot.config.get('is_server_specific', False) or ctx.guild is None:
+            return False
+        return (await cls.get(ctx.bot, ctx.guild.id))['allow_incest']
+
+    @classmethod
+    async def get_max_family_members(cls, ctx) -> int:
+        """
+        Get the maximum number of members that a family can have in the guild that a command was run in.
+        """
+
+        if not ctx.bot.config.get('is_server_specific', False) or ctx.guild is None:
+            return ctx.bot.config['max_family_members']
+        return (await cls.get(ctx.bot, ctx.guild.id))['max_family_members']
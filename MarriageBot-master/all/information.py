@@ -1,5 +1,8 @@
 import asyncio
-import collections
+import io
+import time
+import typing
+import uuid
 
 import discord
 from discord.ext import commands
@@ -9,23 +12,34 @@ from cogs import utils
 
 
 class TreeCommandCooldown(vbu.cooldown.Cooldown):
+    """
+    A cooldown for the tree commands that's shared between every shard through Redis, with the
+    length of the cooldown coming from the user's perks.
+    """
+
     async def predicate(self, ctx):
         perks = await utils.get_marriagebot_perks(ctx.bot, ctx.author.id)
         self.per = perks.tree_command_cooldown
+        retry_after = await utils.RedisCooldown.consume(
+            ctx.bot, ctx.command.qualified_name, ctx.author.id,
+            rate=self.rate, per=self.per,
+        )
 
+        # Line this bucket up with the shared one, so that it refuses (or allows) the command
+        # with the same retry time
+        if retry_after:
+            self._tokens = 0
+            self._window = time.time() - self.per + retry_after
+        else:
+            self._tokens = self.rate
 
-class Information(vbu.Cog):
-
-    def __init__(self, bot):
-        super().__init__(bot)
-        self.locks = collections.defaultdict(asyncio.Lock)
 
-    def get_lock(self, user_id: int) -> asyncio.Lock:
-        """
-        Gets the lock for a particular user.
-        """
+class Information(vbu.Cog):
 
-        return self.locks[user_id]
+    # How much of a family is shown at a time when it's too big to draw all at once
+    TREE_WINDOW_GENERATIONS_UP = 2
+    TREE_WINDOW_GENERATIONS_DOWN = 2
+    TREE_WINDOW_MAX_CHILDREN = 10
 
     @vbu.command(aliases=['spouse', 'husband', 'wife', 'marriage'])
     @vbu.cooldown.no_raise_cooldown(1, 3, commands.BucketType.user)
@@ -110,8 +124,8 @@ class Information(vbu.Cog):
         if user_id == ctx.author.id:
             output = f"You have {len(user_info._children)} {children_plural}:\n"
         children = [
-            (await utils.DiscordNameManager.fetch_name_by_id(self.bot, i), i,)
-            for i in user_info._children
+            (name, i,)
+            for i, name in (await utils.DiscordNameManager.fetch_names_by_ids(self.bot, user_info._children)).items()
         ]
         output += "\n".join([
             f"\N{BULLET} **{utils.escape_markdown(i[0])}** (`{i[1]}`)"
@@ -183,8 +197,8 @@ class Information(vbu.Cog):
 
         # Get the name of the siblings
         sibling_list = [
-            (await utils.DiscordNameManager.fetch_name_by_id(self.bot, sibling), sibling,)
-            for sibling in sibling_list
+            (username, sibling,)
+            for sibling, username in (await utils.DiscordNameManager.fetch_names_by_ids(self.bot, sibling_list)).items()
         ]
         output += "\n".join([
             f"\N{BULLET} **{utils.escape_markdown(username)}** (`{uid}`)"
@@ -310,14 +324,7 @@ class Information(vbu.Cog):
         """
 
         await ctx.defer()
-        lock = self.get_lock(ctx.author.id)
-        if lock.locked():
-            return
-        async with lock:
-            try:
-                return await self.treemaker(ctx=ctx, user_id=user or ctx.author.id)
-            except Exception:
-                raise
+        return await self.treemaker(ctx=ctx, user_id=user or ctx.author.id)
 
     @vbu.command(aliases=['st', 'stupidtree', 'fulltree', 'bt'])
     @vbu.cooldown.cooldown(1, 60, commands.BucketType.user, cls=TreeCommandCooldown())
@@ -330,94 +337,338 @@ class Information(vbu.Cog):
         """
 
         await ctx.defer()
-        lock = self.get_lock(ctx.author.id)
-        if lock.locked():
-            return
-        async with lock:
-            try:
-                return await self.treemaker(ctx=ctx, user_id=user or ctx.author.id, stupid_tree=True)
-            except Exception:
-                raise
+        return await self.treemaker(ctx=ctx, user_id=user or ctx.author.id, stupid_tree=True)
 
-    async def treemaker(self, ctx: vbu.Context, user_id: int, stupid_tree: bool = False):
+    async def treemaker(self, ctx: vbu.Context, user_id: int, stupid_tree: bool = False, window_centre_id: int = None):
         """
         Handles the generation and sending of the tree to the user.
+
+        Very large families are only shown a window of generations at a time around one person
+        (the requesting user, to begin with), and the user is given components to move that window
+        around the family.
         """
 
         # Get their family tree
         user_info = utils.FamilyTreeMember.get(user_id, utils.get_family_guild_id(ctx))
-        user_name = await utils.DiscordNameManager.fetch_name_by_id(self.bot, user_id)
 
         # Make sure they have one
         if user_info.is_empty:
             if user_id == ctx.author.id:
                 return await ctx.send("You have no family to put into a tree .-.")
+            user_name = await utils.DiscordNameManager.fetch_name_by_id(self.bot, user_id)
             return await ctx.send(
                 f"**{utils.escape_markdown(user_name)}** has no family to put into a tree .-.",
                 allowed_mentions=discord.AllowedMentions.none(),
             )
 
-        # Get their customisations
+        # Get the generations of their family
+        family_guild_id = utils.get_family_guild_id(ctx)
+        root_user = user_info.get_root()
+        tree_member = user_info
+        window_centre = None
+        if window_centre_id is not None:
+            window_centre = utils.FamilyTreeMember.get(window_centre_id, family_guild_id)
+        elif stupid_tree:
+            gen_span = root_user.generational_span(expand_upwards=True, add_parent=True)
+            if sum(len(i) for i in gen_span.values()) > self.bot.config.get('windowed_tree_min_members', 150):
+                window_centre = user_info
+        else:
+            gen_span = root_user.generational_span()
+        if window_centre is not None:
+            tree_member = window_centre
+            gen_span = self.get_tree_window_span(root_user, window_centre, stupid_tree)
+        family_version = utils.TreeRenderRegistry.get_family_version(gen_span)
+
+        # Start grabbing everyone's names in the background so that they're cached by the time we
+        # need them
+        name_prefetch = self.bot.loop.create_task(utils.DiscordNameManager.fetch_names_by_ids(
+            self.bot, [i.id for generation in gen_span.values() for i in generation],
+        ))
+
+        # Get their customisations and perks
         async with self.bot.database() as db:
             ctu = await utils.CustomisedTreeUser.fetch_by_id(db, ctx.author.id)
-
-        # Get their dot script
-        async with ctx.typing():
-            if stupid_tree:
-                dot_code = await user_info.to_full_dot_script(self.bot, ctu)
-            else:
-                dot_code = await user_info.to_dot_script(self.bot, ctu)
-
-        # Write the dot to a file
-        dot_filename = f'{self.bot.config["tree_file_location"]}/{ctx.author.id}.gz'
-        try:
-            with open(dot_filename, 'w', encoding='utf-8') as a:
-                a.write(dot_code)
-        except Exception as e:
-            self.logger.error(f"Could not write to {dot_filename}")
-            raise e
-
-        # Convert to an image
-        image_filename = f'{self.bot.config["tree_file_location"].rstrip("/")}/{ctx.author.id}.png'
-        # http://www.graphviz.org/doc/info/output.html#d:png
         perks = await utils.get_marriagebot_perks(ctx.bot, ctx.author.id)
-        # highest quality colour, and antialiasing
-        # not using this because not much point
-        # todo: add extra level for better colour, stroke etc, basically like the one in the readme (in addition to antialiasing)
-        # if False:
-        #     format_rendering_option = '-Tpng:cairo'  # -T:png does the same thing but this is clearer
-        # normal colour, and antialising
-        if perks.tree_render_quality >= 1:
-            format_rendering_option = '-Tpng:cairo'
-        # normal colour, no antialising
-        else:
-            format_rendering_option = '-Tpng:gd'
 
-        dot = await asyncio.create_subprocess_exec('dot', format_rendering_option, dot_filename, '-o', image_filename, '-Gcharset=UTF-8')
-        await asyncio.wait_for(dot.wait(), 10.0, loop=self.bot.loop)
-
-        # Kill subprocess
+        # Render the tree, sharing the render with anyone else who's asked for the same image
+        render_key = (
+            family_guild_id, family_version, root_user.id, user_id,
+            stupid_tree, window_centre_id, ctu.style_key, perks.tree_render_quality >= 1,
+        )
+        if utils.TreeRenderRegistry.is_rendering(render_key):
+            name_prefetch.cancel()
         try:
-            dot.kill()
-        except ProcessLookupError:
-            pass  # It already died
-        except Exception:
-            raise
+            tree_render = await utils.TreeRenderRegistry.render(
+                render_key,
+                lambda: self.render_tree(
+                    ctx, user_info, tree_member, window_centre, gen_span, ctu, perks, name_prefetch, stupid_tree,
+                ),
+            )
+        except utils.TreeRenderError as e:
+            return await ctx.send(str(e), allowed_mentions=discord.AllowedMentions.none())
+        window_centre, gen_span = tree_render.window_centre, tree_render.gen_span
+        image_data, image_extension = tree_render.image_data, tree_render.image_extension
+        renderer_name, original_image_size = tree_render.renderer_name, tree_render.original_image_size
 
         # Send file
-        try:
-            file = discord.File(image_filename)
-        except FileNotFoundError:
-            return await ctx.send("I was unable to send your family tree image - please try again later.")
+        file = discord.File(io.BytesIO(image_data), filename=f"tree.{image_extension}")
         text = "[Click here](https://marriagebot.xyz/) to customise your tree."
-        if not stupid_tree:
+        if window_centre is not None:
+            text = "This family is too big for me to draw all at once, so here's just part of it. " + text
+        elif not stupid_tree:
             text += f" Use `{ctx.prefix}bloodtree` for your _entire_ family, including non-blood relatives."
-        tree_message = await ctx.send(text, file=file)
+        components = None
+        if window_centre is not None:
+            components = await self.get_tree_window_components(root_user, window_centre, gen_span, stupid_tree)
+        upload_start_time = time.monotonic()
+        tree_message = await ctx.send(text, file=file, components=components, wait=True)
+        upload_time = time.monotonic() - upload_start_time
         await self.bot.add_delete_reaction(tree_message)
 
-        # Delete the files
-        self.bot.loop.create_task(asyncio.create_subprocess_exec('rm', dot_filename))
-        self.bot.loop.create_task(asyncio.create_subprocess_exec('rm', image_filename))
+        # Track how much the image was shrunk and how long it took to upload
+        async with self.bot.stats() as stats:
+            tags = {"renderer": renderer_name, "format": image_extension}
+            stats.histogram("marriagebot.tree.image_size.original", original_image_size, tags=tags)
+            stats.histogram("marriagebot.tree.image_size.uploaded", len(image_data), tags=tags)
+            stats.timing("marriagebot.tree.upload_time", upload_time * 1_000, tags=tags)
+
+        # Let them move around the tree
+        if components is not None:
+            self.bot.loop.create_task(self.wait_for_tree_window_move(ctx, tree_message, components, user_id, stupid_tree))
+
+    async def render_tree(
+            self, ctx: vbu.Context, user_info, tree_member, window_centre, gen_span: dict,
+            ctu, perks, name_prefetch: asyncio.Task, stupid_tree: bool) -> 'utils.TreeRender':
+        """
+        Renders a tree image for a part of a family. This is shared between everyone who asks for
+        the same tree while it's being rendered, so it doesn't send anything itself.
+
+        Raises:
+            utils.TreeRenderError: The tree couldn't be rendered.
+        """
+
+        family_member_count = sum(len(i) for i in gen_span.values())
+
+        # Small families are drawn by us directly, since starting Graphviz takes longer than laying
+        # them out does
+        image_filename = f'{self.bot.config["tree_file_location"].rstrip("/")}/{ctx.author.id}-{uuid.uuid4().hex}.png'
+        render_start_time = time.monotonic()
+        native_tree_max_members = self.bot.config.get('native_tree_max_members', 0)
+        if family_member_count <= native_tree_max_members and utils.NativeTreeRenderer.is_available():
+            renderer_name = "native"
+            async with ctx.typing():
+                name_wait_time = await self.wait_for_name_prefetch(name_prefetch)
+                renderer = await tree_member.to_svg_from_generational_span(self.bot, gen_span, ctu)
+                await self.bot.loop.run_in_executor(None, renderer.render, image_filename)
+
+        # Everything else goes through Graphviz
+        else:
+            renderer_name = "graphviz"
+
+            # Work out what quality they'd normally get
+            # http://www.graphviz.org/doc/info/output.html#d:png
+            # highest quality colour, and antialiasing
+            # not using this because not much point
+            # todo: add extra level for better colour, stroke etc, basically like the one in the readme (in addition to antialiasing)
+            # if False:
+            #     format_rendering_option = '-Tpng:cairo'  # -T:png does the same thing but this is clearer
+            # normal colour, and antialising
+            if perks.tree_render_quality >= 1:
+                format_rendering_option = '-Tpng:cairo'
+            # normal colour, no antialising
+            else:
+                format_rendering_option = '-Tpng:gd'
+
+            # Work out how we can render this within our time budget
+            render_budget = self.bot.config.get('tree_render_budget', 10.0)
+            render_cost = utils.RenderCostEstimator.get_cost(gen_span)
+            plan = utils.RenderCostEstimator.get_plan(render_cost, format_rendering_option, budget=render_budget)
+            if plan.split:
+                if window_centre is None:
+                    window_centre = tree_member = user_info
+                    gen_span = self.get_tree_window_span(user_info.get_root(), user_info, stupid_tree)
+                    render_cost = utils.RenderCostEstimator.get_cost(gen_span)
+                    plan = utils.RenderCostEstimator.get_plan(
+                        render_cost, format_rendering_option, budget=render_budget, can_split=False,
+                    )
+                else:
+                    plan.refuse = True
+            if plan.refuse:
+                name_prefetch.cancel()
+                raise utils.TreeRenderError("Your family is too big for me to draw in one image - sorry!")
+
+            # Get their dot script - this is unstyled so that we can reuse the layout for it if
+            # it's been rendered recently
+            async with ctx.typing():
+                name_wait_time = await self.wait_for_name_prefetch(name_prefetch)
+                dot_code = await tree_member.to_dot_script_from_generational_span(self.bot, gen_span, ctu, styled=False)
+
+            # Lay out the tree, add the user's colours to it, and convert it to an image - the
+            # estimates only learn from renders that did their own layout, at the DPI they used
+            graphviz_start_time = time.monotonic()
+            layout_is_cached = utils.TreeLayoutCache.is_cached(dot_code)
+            dpi = plan.dpi
+            try:
+                layout = await utils.TreeLayoutCache.get_layout(dot_code, timeout=render_budget)
+                layout = ctu.style_dot_script(layout, user_info.id)
+                dpi = utils.TreeImageOptimiser.get_dpi_for_layout(layout, plan.dpi)
+                await utils.TreeLayoutCache.render_layout(
+                    layout, plan.format_rendering_option, image_filename,
+                    dpi=dpi,
+                    timeout=max(render_budget - (time.monotonic() - graphviz_start_time), 1.0),
+                )
+            except asyncio.TimeoutError:
+                if not layout_is_cached:
+                    utils.RenderCostEstimator.record(plan.format_rendering_option, dpi, render_cost, render_budget)
+                raise utils.TreeRenderError("Your family took too long for me to draw - please try again later.")
+            except utils.TreeLayoutError:
+                raise utils.TreeRenderError("I was unable to send your family tree image - please try again later.")
+            if not layout_is_cached:
+                utils.RenderCostEstimator.record(
+                    plan.format_rendering_option, dpi, render_cost,
+                    time.monotonic() - graphviz_start_time,
+                )
+
+        # Track how long each renderer takes for each size of family so we can see where
+        # the crossover between them is
+        render_time = time.monotonic() - render_start_time
+        async with self.bot.stats() as stats:
+            tags = {
+                "renderer": renderer_name,
+                "family_size": str(1 << (family_member_count - 1).bit_length()),
+            }
+            stats.timing("marriagebot.tree.render_time", render_time * 1_000, tags=tags)
+            stats.timing("marriagebot.tree.name_wait_time", name_wait_time * 1_000, tags=tags)
+
+        # Read the image back and shrink it down before we upload it
+        try:
+            with open(image_filename, 'rb') as a:
+                image_data = a.read()
+        except FileNotFoundError:
+            raise utils.TreeRenderError("I was unable to send your family tree image - please try again later.")
+        finally:
+            self.bot.loop.create_task(asyncio.create_subprocess_exec('rm', '-f', image_filename))
+        original_image_size = len(image_data)
+        image_extension = "png"
+        if utils.TreeImageOptimiser.is_available():
+            image_data, image_extension = await self.bot.loop.run_in_executor(
+                None,
+                lambda: utils.TreeImageOptimiser.optimise(
+                    image_data, image_format=self.bot.config.get('tree_image_format', 'png'),
+                ),
+            )
+        return utils.TreeRender(image_data, image_extension, original_image_size, renderer_name, window_centre, gen_span)
+
+    def get_tree_window_span(self, root_user, window_centre, stupid_tree: bool) -> dict:
+        """
+        Gets the part of a family that's shown around a user when it's too big to draw all at once.
+        Bloodtrees show everyone around the user, and trees show the generations of the normal tree
+        that are around the user.
+        """
+
+        if stupid_tree:
+            return window_centre.windowed_generational_span(
+                self.TREE_WINDOW_GENERATIONS_UP, self.TREE_WINDOW_GENERATIONS_DOWN, self.TREE_WINDOW_MAX_CHILDREN,
+            )
+        gen_span = root_user.generational_span()
+        depth = next((i for i, o in gen_span.items() if any(m.id == window_centre.id for m in o)), 0)
+        return {
+            i: o for i, o in gen_span.items()
+            if depth - self.TREE_WINDOW_GENERATIONS_UP <= i <= depth + self.TREE_WINDOW_GENERATIONS_DOWN
+        }
+
+    async def wait_for_name_prefetch(self, name_prefetch: asyncio.Task) -> float:
+        """
+        Waits for a name prefetch to finish, returning how long we had to wait for it. If the
+        prefetch failed then the names will just be fetched again as the tree is built.
+        """
+
+        # The prefetch can fail or be cancelled without it stopping us - but if we're cancelled, we
+        # stop as normal
+        wait_start_time = time.monotonic()
+        await asyncio.wait([name_prefetch])
+        if not name_prefetch.cancelled():
+            name_prefetch.exception()
+        return time.monotonic() - wait_start_time
+
+    async def get_tree_window_components(
+            self, root_user, window_centre, gen_span: dict, stupid_tree: bool) -> typing.Optional[vbu.MessageComponents]:
+        """
+        Gets the components that let a user move a tree window around their family.
+        """
+
+        # Trees can only be moved around the normal tree, which doesn't have the relatives of anyone
+        # who married in
+        reachable_user_ids = None
+        if not stupid_tree:
+            reachable_user_ids = {i.id for generation in root_user.generational_span().values() for i in generation}
+
+        # See who they can move up to
+        rows = []
+        centre_parent = window_centre.parent
+        if stupid_tree and centre_parent is None and window_centre.partner:
+            centre_parent = window_centre.partner.parent
+        if centre_parent and (reachable_user_ids is None or centre_parent.id in reachable_user_ids):
+            rows.append(vbu.ActionRow(
+                vbu.Button(label="Show older generations", custom_id=f"TREE_WINDOW {centre_parent.id}"),
+            ))
+
+        # And which branches have been cut off - the children that were cut from the person in the middle
+        # of the window can be moved to directly
+        options = []
+        shown_user_ids = {i.id for generation in gen_span.values() for i in generation}
+        hidden_branches = utils.FamilyTreeMember.get_hidden_branches(gen_span, reachable_user_ids)
+        hidden_children = [
+            i for i in window_centre._children
+            if i not in shown_user_ids and (reachable_user_ids is None or i in reachable_user_ids)
+        ]
+        names = await utils.DiscordNameManager.fetch_names_by_ids(
+            self.bot, [i.id for i in hidden_branches if i != window_centre] + hidden_children,
+        )
+        for member in hidden_branches:
+            if member == window_centre:
+                for child_id in hidden_children:
+                    options.append(vbu.SelectOption(label=f"Show {names[child_id]}"[:100], value=f"TREE_WINDOW {child_id}"))
+                continue
+            name = names[member.id]
+            options.append(vbu.SelectOption(label=f"Expand {name}'s branch"[:100], value=f"TREE_WINDOW {member.id}"))
+        options = options[:25]  # The most options that a select menu can have
+        if options:
+            rows.append(vbu.ActionRow(
+                vbu.SelectMenu(custom_id="TREE_WINDOW_BRANCH", options=options, placeholder="Expand a branch"),
+            ))
+        if not rows:
+            return None
+        return vbu.MessageComponents(*rows)
+
+    async def wait_for_tree_window_move(
+            self, ctx: vbu.Context, tree_message: discord.Message, components: vbu.MessageComponents,
+            user_id: int, stupid_tree: bool):
+        """
+        Waits for the user to move their tree window, and renders the new window when they do.
+        """
+
+        # Wait for them to pick somewhere
+        def check(payload: vbu.ComponentInteractionPayload):
+            if payload.user.id != ctx.author.id:
+                self.bot.loop.create_task(payload.respond("You can't respond to this message!", wait=False, ephemeral=True))
+                return False
+            return True
+        try:
+            payload = await utils.ComponentInteractionDispatcher.wait_for(tree_message.id, check=check, timeout=120)
+            await payload.defer_update()
+        except asyncio.TimeoutError:
+            return
+        finally:
+            self.bot.loop.create_task(tree_message.edit(components=components.disable_components()))
+
+        # Render the new window
+        if payload.values:
+            selected = payload.values[0]
+        else:
+            selected = payload.component.custom_id
+        window_centre_id = int(selected[len("TREE_WINDOW "):])
+        await self.treemaker(ctx, user_id, stupid_tree=stupid_tree, window_centre_id=window_centre_id)
 
 
 def setup(bot: vbu.Bot):
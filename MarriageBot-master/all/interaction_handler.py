@@ -0,0 +1,35 @@
+from discord.ext import tasks
+import voxelbotutils as vbu
+
+from cogs import utils
+
+
+class InteractionHandler(vbu.Cog):
+
+    def __init__(self, bot: vbu.Bot):
+        super().__init__(bot)
+        self.advance_interaction_timeouts.start()
+
+    def cog_unload(self):
+        self.advance_interaction_timeouts.cancel()
+
+    @tasks.loop(seconds=utils.ComponentInteractionDispatcher.TICK_LENGTH)
+    async def advance_interaction_timeouts(self):
+        """
+        Times out anything that's been waiting on a component interaction for too long.
+        """
+
+        utils.ComponentInteractionDispatcher.advance()
+
+    @vbu.Cog.listener()
+    async def on_component_interaction(self, payload: vbu.ComponentInteractionPayload):
+        """
+        Hands component interactions to whatever's waiting on their message.
+        """
+
+        utils.ComponentInteractionDispatcher.dispatch(payload)
+
+
+def setup(bot: vbu.Bot):
+    x = InteractionHandler(bot)
+    bot.add_cog(x)
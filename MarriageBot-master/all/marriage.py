@@ -35,9 +35,8 @@ class Marriage(vbu.Cog):
             return await ctx.send("That is a robot. Robots cannot consent to marriage.", wait=False)
 
         # Lock those users
-        re = await self.bot.redis.get_connection()
         try:
-            lock = await utils.ProposalLock.lock(re, ctx.author.id, target.id)
+            lock = await utils.ProposalLock.lock(self.bot, ctx.author.id, target.id)
         except utils.ProposalInProgress:
             return await ctx.send("Aren't you popular! One of you is already waiting on a proposal - please try again later.", wait=False)
 
@@ -62,7 +61,7 @@ class Marriage(vbu.Cog):
         # See if they're already related
         async with ctx.typing():
             relation = author_tree.get_relation(target_tree)
-        if relation and utils.guild_allows_incest(ctx) is False:
+        if relation and await utils.GuildSettingsCache.guild_allows_incest(ctx) is False:
             await lock.unlock()
             return await ctx.send(
                 f"Woah woah woah, it looks like you guys are already related! {target.mention} is your {relation}!",
@@ -72,7 +71,7 @@ class Marriage(vbu.Cog):
 
         # Check the size of their trees
         # TODO I can make this a util because I'm going to use it a couple times
-        max_family_members = utils.get_max_family_members(ctx)
+        max_family_members = await utils.GuildSettingsCache.get_max_family_members(ctx)
         async with ctx.typing():
             family_member_count = 0
             for i in author_tree.span(add_parent=True, expand_upwards=True):
@@ -120,11 +119,8 @@ class Marriage(vbu.Cog):
         )  # Keep allowed mentions on
 
         # Ping over redis
-        author_tree._partner = target.id
-        target_tree._partner = ctx.author.id
-        await re.publish('TreeMemberUpdate', author_tree.to_json())
-        await re.publish('TreeMemberUpdate', target_tree.to_json())
-        await re.disconnect()
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.FamilyTreeUpdate(family_guild_id).add_partner(author_tree.id, target_tree.id).publish(re)
         await lock.unlock()
 
     @vbu.command()
@@ -173,11 +169,8 @@ class Marriage(vbu.Cog):
         )
 
         # Ping over redis
-        author_tree._partner = None
-        target_tree._partner = None
-        async with self.bot.redis() as re:
-            await re.publish('TreeMemberUpdate', author_tree.to_json())
-            await re.publish('TreeMemberUpdate', target_tree.to_json())
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.FamilyTreeUpdate(family_guild_id).remove_partner(author_tree.id, target_tree.id).publish(re)
 
 
 def setup(bot: vbu.Bot):
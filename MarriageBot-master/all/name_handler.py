@@ -1,17 +1,113 @@
+import collections
+import typing
+
 import discord
+from discord.ext import tasks
 import voxelbotutils as vbu
 
+from cogs import utils
+
 
 class NameHandler(vbu.Cog):
 
+    # How many names we remember having written to Redis, so that we can skip rewriting them
+    MAX_WRITTEN_NAMES = 50_000
+
+    def __init__(self, bot: vbu.Bot):
+        super().__init__(bot)
+        self.written_names: typing.Dict[int, typing.Tuple[int, str]] = collections.OrderedDict()  # User ID: (name generation, the name we last wrote)
+        self.pending_names: typing.Dict[int, str] = {}  # User ID: the name waiting to be written
+        self.skipped_name_writes = 0
+        self.report_name_cache_stats.start()
+        self.flush_pending_names_loop.start()
+
+    def cog_unload(self):
+        self.report_name_cache_stats.cancel()
+        self.flush_pending_names_loop.cancel()
+        self.bot.loop.create_task(self.flush_pending_names())
+
+    def queue_name_write(self, user: discord.User):
+        """
+        Queues a user's name to be written to Redis, unless we know it's already there. Names are
+        written again once per name generation so that active users don't expire out of Redis.
+        """
+
+        name = str(user)
+        if self.written_names.get(user.id) == (utils.DiscordNameManager.get_name_generation(), name):
+            self.written_names.move_to_end(user.id)
+            self.skipped_name_writes += 1
+            return
+        self.pending_names[user.id] = name
+
+    async def flush_pending_names(self):
+        """
+        Writes all of the queued names to Redis in one go. If they can't be written then they're
+        queued again for next time.
+        """
+
+        # Grab what's been queued
+        pending_names, self.pending_names = self.pending_names, {}
+        skipped_name_writes, self.skipped_name_writes = self.skipped_name_writes, 0
+        if pending_names:
+
+            # Write them all, putting them back if we can't - without replacing anything newer
+            generation = utils.DiscordNameManager.get_name_generation()
+            try:
+                async with utils.RedisPool.acquire(self.bot) as re:
+                    await utils.DiscordNameManager.set_names_in_redis(re, pending_names)
+            except Exception:
+                for user_id, name in pending_names.items():
+                    self.pending_names.setdefault(user_id, name)
+                self.skipped_name_writes += skipped_name_writes
+                raise
+
+            # Remember what we wrote, and update any names that we've got cached in memory
+            for user_id, name in pending_names.items():
+                self.written_names[user_id] = (generation, name)
+                self.written_names.move_to_end(user_id)
+                cached = utils.DiscordNameManager.cached_names.get(user_id)
+                if cached is not None:
+                    cached.name = name
+            while len(self.written_names) > self.MAX_WRITTEN_NAMES:
+                self.written_names.popitem(last=False)
+
+        # And track how much we've saved
+        async with self.bot.stats() as stats:
+            stats.increment("marriagebot.names.redis_ops", value=1 if pending_names else 0)
+            stats.increment("marriagebot.names.writes", value=len(pending_names), tags={"result": "written"})
+            stats.increment("marriagebot.names.writes", value=skipped_name_writes, tags={"result": "unchanged"})
+
+    @tasks.loop(seconds=5)
+    async def flush_pending_names_loop(self):
+        """
+        Periodically writes the queued names to Redis. Errors are logged rather than raised, since
+        they'd stop the loop for good.
+        """
+
+        try:
+            await self.flush_pending_names()
+        except Exception as e:
+            self.logger.error(f"Failed to write queued names to Redis: {e}", exc_info=e)
+
+    @tasks.loop(seconds=60)
+    async def report_name_cache_stats(self):
+        """
+        Sends how the in-process name cache is doing to statsd.
+        """
+
+        cache_stats = utils.DiscordNameManager.pop_cache_stats()
+        async with self.bot.stats() as stats:
+            for result in ("hit", "miss", "eviction"):
+                stats.increment("marriagebot.names.cache", value=cache_stats[result], tags={"result": result})
+            stats.gauge("marriagebot.names.cache_size", cache_stats["size"])
+
     @vbu.Cog.listener()
     async def on_message(self, message: discord.Message):
         """
         Caches a user's name when send any message.
         """
 
-        async with self.bot.redis() as re:
-            await re.set(f"UserName-{message.author.id}", str(message.author))
+        self.queue_name_write(message.author)
 
     @vbu.Cog.listener()
     async def on_user_update(self, before: discord.User, after: discord.User):
@@ -23,8 +119,7 @@ class NameHandler(vbu.Cog):
             return
         if str(after).endswith("#0000"):
             return
-        async with self.bot.redis() as re:
-            await re.set(f'UserName-{after.id}', str(after))
+        self.queue_name_write(after)
 
 
 def setup(bot: vbu.Bot):
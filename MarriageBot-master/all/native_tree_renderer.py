@@ -0,0 +1,261 @@
+import html
+import typing
+
+try:
+    import cairosvg
+except (ImportError, OSError):  # OSError is raised when Cairo itself isn't installed
+    cairosvg = None
+
+from cogs.utils.customised_tree_user import CustomisedTreeUser
+
+
+class NativeTreeRenderer(object):
+    """
+    A pure Python layered layout and SVG writer for small family trees, so that we don't need to
+    start up Graphviz for a family of a handful of people.
+
+    The layout follows the same rules as the DOT script: each generation is a row, partners sit next
+    to each other joined by a line, and children hang from a point between their parent and the
+    parent's partner.
+    """
+
+    FONT_SIZE = 14
+    CHARACTER_WIDTH = 7.5  # Rough average width of a character at our font size
+    NODE_PADDING = 10
+    NODE_HEIGHT = 36
+    NODE_GAP = 20  # The gap between two unrelated nodes on the same row
+    PARTNER_GAP = 30  # The gap between two partners
+    RANK_GAP = 60  # The gap between two generations
+    MARGIN = 10
+
+    def __init__(
+            self, gen_span: typing.Dict[int, list], names: typing.Dict[int, str],
+            customised_tree_user: CustomisedTreeUser, highlighted_user_id: int = None):
+        self.gen_span = gen_span
+        self.people = {i.id: i for generation in gen_span.values() for i in generation}
+        self.names = names
+        self.customised_tree_user = customised_tree_user
+        self.highlighted_user_id = highlighted_user_id
+        self.is_horizontal = customised_tree_user.direction == "LR"
+
+    @classmethod
+    def is_available(cls) -> bool:
+        """
+        Whether or not we're able to turn the SVG into a PNG.
+        """
+
+        return cairosvg is not None
+
+    def get_node_size(self, user_id: int) -> typing.Tuple[float, float]:
+        """
+        Get the width and height of a user's node.
+        """
+
+        width = len(self.names[user_id]) * self.CHARACTER_WIDTH + (self.NODE_PADDING * 2)
+        return max(width, self.NODE_HEIGHT), self.NODE_HEIGHT
+
+    def get_node_breadth(self, user_id: int) -> float:
+        """
+        Get the size of the node along a generation's row.
+        """
+
+        width, height = self.get_node_size(user_id)
+        return height if self.is_horizontal else width
+
+    def get_node_depth(self, user_id: int) -> float:
+        """
+        Get the size of the node across a generation's row.
+        """
+
+        width, height = self.get_node_size(user_id)
+        return width if self.is_horizontal else height
+
+    def get_generation_units(self, generation: list) -> typing.List[list]:
+        """
+        Split a generation into its units - either a single person or a person and their partner.
+        """
+
+        units = []
+        added_already = set()
+        for person in generation:
+            if person.id in added_already or person.id not in self.names:
+                continue
+            added_already.add(person.id)
+            partner = person.partner
+            if partner and partner in generation and partner.id in self.names:
+                units.append([person, partner])
+                added_already.add(partner.id)
+            else:
+                units.append([person])
+        return units
+
+    def get_unit_breadth(self, unit: list) -> float:
+        """
+        Get the size of a unit along a generation's row.
+        """
+
+        return sum(self.get_node_breadth(i.id) for i in unit) + (self.PARTNER_GAP * (len(unit) - 1))
+
+    def layout(self) -> typing.Tuple[dict, list, float, float]:
+        """
+        Lay out the tree.
+
+        Returns:
+            typing.Tuple[dict, list, float, float]: The centre of each node keyed by user ID,
+                the lines to be drawn as pairs of points, and the width and height of the image.
+        """
+
+        # Work out the position of every node along its row, generation by generation, so that
+        # children can be placed under their parents
+        breadth_positions: typing.Dict[int, float] = {}  # User ID: centre along the row
+        rank_of_user: typing.Dict[int, int] = {}  # User ID: rank number
+        hub_of_user: typing.Dict[int, float] = {}  # User ID: where the user's children hang from along the row
+        generation_numbers = sorted(self.gen_span.keys())
+        for rank, generation_number in enumerate(generation_numbers):
+            units = self.get_generation_units(self.gen_span[generation_number])
+
+            # Group the units by who their parents are so that siblings are kept together, ordered
+            # by where their parents are
+            groups: typing.Dict[typing.Optional[int], list] = {}
+            for unit in units:
+                parent_id = None
+                for person in unit:
+                    if person._parent in hub_of_user:
+                        parent_id = person._parent
+                        break
+                groups.setdefault(parent_id, list()).append(unit)
+            ordered_groups = sorted(
+                groups.items(),
+                key=lambda item: hub_of_user[item[0]] if item[0] is not None else float("inf"),
+            )
+
+            # Place each group as close to the middle of their parents as we can without overlapping
+            cursor = 0.0
+            for parent_id, group in ordered_groups:
+                group_breadth = sum(self.get_unit_breadth(i) for i in group) + (self.NODE_GAP * (len(group) - 1))
+                if parent_id is not None:
+                    cursor = max(cursor, hub_of_user[parent_id] - (group_breadth / 2))
+                for unit in group:
+                    for person in unit:
+                        breadth = self.get_node_breadth(person.id)
+                        breadth_positions[person.id] = cursor + (breadth / 2)
+                        rank_of_user[person.id] = rank
+                        cursor += breadth + self.PARTNER_GAP
+                    cursor += self.NODE_GAP - self.PARTNER_GAP
+                    unit_hub = sum(breadth_positions[i.id] for i in unit) / len(unit)
+                    for person in unit:
+                        hub_of_user[person.id] = unit_hub
+                cursor += self.NODE_GAP
+
+        # Work out where each row goes
+        rank_depths = []
+        for generation_number in generation_numbers:
+            rank_depths.append(max(
+                [self.get_node_depth(i.id) for i in self.gen_span[generation_number] if i.id in self.names] or [0],
+            ))
+        rank_positions = []
+        cursor = 0.0
+        for depth in rank_depths:
+            rank_positions.append(cursor + (depth / 2))
+            cursor += depth + self.RANK_GAP
+        total_depth = cursor - self.RANK_GAP
+
+        # Make sure nothing is hanging off the left of the image
+        minimum_breadth = min(
+            breadth_positions[i] - (self.get_node_breadth(i) / 2)
+            for i in breadth_positions
+        )
+        total_breadth = max(
+            breadth_positions[i] + (self.get_node_breadth(i) / 2)
+            for i in breadth_positions
+        ) - minimum_breadth
+
+        def get_point(breadth: float, depth: float) -> typing.Tuple[float, float]:
+            breadth = breadth - minimum_breadth + self.MARGIN
+            depth = depth + self.MARGIN
+            if self.is_horizontal:
+                return depth, breadth
+            return breadth, depth
+
+        # Position the nodes
+        node_positions = {
+            user_id: get_point(breadth_positions[user_id], rank_positions[rank_of_user[user_id]])
+            for user_id in breadth_positions
+        }
+
+        # Draw the lines between partners and from parents to their children
+        lines = []
+        added_partners = set()
+        added_hubs = set()
+        for user_id, rank in rank_of_user.items():
+            person = self.people[user_id]
+            partner = person._partner
+            if partner in rank_of_user and rank_of_user[partner] == rank and partner not in added_partners:
+                added_partners.add(user_id)
+                lines.append((node_positions[user_id], node_positions[partner]))
+            children = [i for i in person._children if i in rank_of_user]
+            if not children or (rank, hub_of_user[user_id]) in added_hubs:
+                continue
+            added_hubs.add((rank, hub_of_user[user_id]))
+            hub_depth = rank_positions[rank] + (rank_depths[rank] / 2) + (self.RANK_GAP / 2)
+            if partner in rank_of_user and hub_of_user.get(partner) == hub_of_user[user_id]:
+                children.extend([i for i in self.people[partner]._children if i in rank_of_user and i not in children])
+                hub_start = get_point(hub_of_user[user_id], rank_positions[rank])
+            else:
+                hub_start = get_point(hub_of_user[user_id], rank_positions[rank] + (rank_depths[rank] / 2))
+            hub = get_point(hub_of_user[user_id], hub_depth)
+            lines.append((hub_start, hub))
+            for child_id in children:
+                child_rank = rank_of_user[child_id]
+                lines.append((hub, get_point(
+                    breadth_positions[child_id],
+                    rank_positions[child_rank] - (self.get_node_depth(child_id) / 2),
+                )))
+
+        # And done
+        width, height = get_point(total_breadth + minimum_breadth + self.MARGIN, total_depth + self.MARGIN)
+        return node_positions, lines, width, height
+
+    def to_svg(self) -> str:
+        """
+        Lay out the tree and write it as an SVG.
+        """
+
+        node_positions, lines, width, height = self.layout()
+        colours = {
+            i: "none" if o == "transparent" else o
+            for i, o in self.customised_tree_user.unquoted_hex.items()
+        }
+        output = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}" viewBox="0 0 {width:.0f} {height:.0f}">',
+            f'<rect width="100%" height="100%" fill="{colours["background"]}"/>',
+        ]
+
+        # Lines go underneath the nodes
+        for (x1, y1), (x2, y2) in lines:
+            output.append(f'<line x1="{x1:.1f}" y1="{y1:.1f}" x2="{x2:.1f}" y2="{y2:.1f}" stroke="{colours["edge"]}"/>')
+
+        # Add the nodes
+        for user_id, (x, y) in node_positions.items():
+            node_width, node_height = self.get_node_size(user_id)
+            if user_id == self.highlighted_user_id:
+                fill, font = colours["highlighted_node"], colours["highlighted_font"]
+            else:
+                fill, font = colours["node"], colours["font"]
+            output.append(
+                f'<rect x="{x - (node_width / 2):.1f}" y="{y - (node_height / 2):.1f}" width="{node_width:.1f}" '
+                f'height="{node_height:.1f}" fill="{fill}" stroke="{colours["edge"]}"/>'
+            )
+            output.append(
+                f'<text x="{x:.1f}" y="{y:.1f}" fill="{font}" font-family="Times,serif" font-size="{self.FONT_SIZE}" '
+                f'text-anchor="middle" dominant-baseline="central">{html.escape(self.names[user_id])}</text>'
+            )
+        output.append('</svg>')
+        return "".join(output)
+
+    def render(self, image_filename: str) -> None:
+        """
+        Write the tree to a PNG file.
+        """
+
+        cairosvg.svg2png(bytestring=self.to_svg().encode(), write_to=image_filename)
@@ -23,11 +23,12 @@ class Parentage(vbu.Cog):
         # See how many children they're allowed with Gold
         gold_children_amount = 0
         if self.bot.config.get('is_server_specific', False):
-            guild_max_children = self.bot.guild_settings[guild.id].get('max_children')
-            if guild_max_children:
-                gold_children_amount = max([
-                    amount if int(role_id) in user._roles else 0 for role_id, amount in guild_max_children.items()
-                ])
+            guild_settings = await utils.GuildSettingsCache.get(self.bot, guild.id)
+            gold_children_amount = utils.GuildSettingsCache.get_max_children_for_roles(guild_settings, user._roles)
+
+        # Their perks can't get them any more than the global max
+        if gold_children_amount >= utils.TIER_THREE.max_children:
+            return utils.TIER_THREE.max_children
 
         # See how many children they're allowed normally (in regard to Patreon tier)
         marriagebot_perks = await utils.get_marriagebot_perks(self.bot, user.id)
@@ -66,9 +67,8 @@ class Parentage(vbu.Cog):
             return await ctx.send("I think I could do better actually, but thank you!", wait=False)
 
         # Lock those users
-        re = await self.bot.redis.get_connection()
         try:
-            lock = await utils.ProposalLock.lock(re, ctx.author.id, target.id)
+            lock = await utils.ProposalLock.lock(self.bot, ctx.author.id, target.id)
         except utils.ProposalInProgress:
             return await ctx.send("Aren't you popular! One of you is already waiting on a proposal - please try again later.", wait=False)
 
@@ -93,7 +93,7 @@ class Parentage(vbu.Cog):
         # See if they're already related
         async with ctx.typing():
             relation = author_tree.get_relation(target_tree)
-        if relation and utils.guild_allows_incest(ctx) is False:
+        if relation and await utils.GuildSettingsCache.guild_allows_incest(ctx) is False:
             await lock.unlock()
             return await ctx.send(
                 f"Woah woah woah, it looks like you guys are already related! {target.mention} is your {relation}!",
@@ -111,7 +111,7 @@ class Parentage(vbu.Cog):
 
         # Check the size of their trees
         # TODO I can make this a util because I'm going to use it a couple times
-        max_family_members = utils.get_max_family_members(ctx)
+        max_family_members = await utils.GuildSettingsCache.get_max_family_members(ctx)
         async with ctx.typing():
             family_member_count = 0
             for i in author_tree.span(add_parent=True, expand_upwards=True):
@@ -158,11 +158,8 @@ class Parentage(vbu.Cog):
         )
 
         # And we're done
-        target_tree._children.append(author_tree.id)
-        author_tree._parent = target.id
-        await re.publish('TreeMemberUpdate', author_tree.to_json())
-        await re.publish('TreeMemberUpdate', target_tree.to_json())
-        await re.disconnect()
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.FamilyTreeUpdate(family_guild_id).add_child(target_tree.id, author_tree.id).publish(re)
         await lock.unlock()
 
     @vbu.command(context_command_type=vbu.ApplicationCommandType.USER, context_command_name="Adopt user")
@@ -190,9 +187,8 @@ class Parentage(vbu.Cog):
             return await ctx.send("That is a robot. Robots cannot consent to adoption.", wait=False)
 
         # Lock those users
-        re = await self.bot.redis.get_connection()
         try:
-            lock = await utils.ProposalLock.lock(re, ctx.author.id, target.id)
+            lock = await utils.ProposalLock.lock(self.bot, ctx.author.id, target.id)
         except utils.ProposalInProgress:
             return await ctx.send("Aren't you popular! One of you is already waiting on a proposal - please try again later.", wait=False)
 
@@ -217,7 +213,7 @@ class Parentage(vbu.Cog):
         # See if they're already related
         async with ctx.typing():
             relation = author_tree.get_relation(target_tree)
-        if relation and utils.guild_allows_incest(ctx) is False:
+        if relation and await utils.GuildSettingsCache.guild_allows_incest(ctx) is False:
             await lock.unlock()
             return await ctx.send(
                 f"Woah woah woah, it looks like you guys are already related! {target.mention} is your {relation}!",
@@ -235,7 +231,7 @@ class Parentage(vbu.Cog):
 
         # Check the size of their trees
         # TODO I can make this a util because I'm going to use it a couple times
-        max_family_members = utils.get_max_family_members(ctx)
+        max_family_members = await utils.GuildSettingsCache.get_max_family_members(ctx)
         async with ctx.typing():
             family_member_count = 0
             for i in author_tree.span(add_parent=True, expand_upwards=True):
@@ -278,11 +274,8 @@ class Parentage(vbu.Cog):
         await result.ctx.send(f"I'm happy to introduce {ctx.author.mention} as your parent, {target.mention}!", wait=False)
 
         # And we're done
-        author_tree._children.append(target.id)
-        target_tree._parent = author_tree.id
-        await re.publish('TreeMemberUpdate', author_tree.to_json())
-        await re.publish('TreeMemberUpdate', target_tree.to_json())
-        await re.disconnect()
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.FamilyTreeUpdate(family_guild_id).add_child(author_tree.id, target_tree.id).publish(re)
         await lock.unlock()
 
     @vbu.command(aliases=['abort'])
@@ -303,18 +296,19 @@ class Parentage(vbu.Cog):
         if target is None:
 
             # Make a list of options
-            child_options = []
-            for index, child_tree in enumerate(user_tree.children):
-                child_name = await utils.DiscordNameManager.fetch_name_by_id(self.bot, child_tree.id)
-                child_options.append(vbu.SelectOption(label=child_name, value=f"DISOWN {child_tree.id}"))
-                if index >= 25:
-                    return await ctx.send(
-                        (
-                            "I couldn't work out which of your children you wanted to disown. "
-                            "You can ping or use their ID to disown them."
-                        ),
-                        wait=False,
-                    )
+            if len(user_tree._children) > 25:
+                return await ctx.send(
+                    (
+                        "I couldn't work out which of your children you wanted to disown. "
+                        "You can ping or use their ID to disown them."
+                    ),
+                    wait=False,
+                )
+            child_names = await utils.DiscordNameManager.fetch_names_by_ids(self.bot, user_tree._children)
+            child_options = [
+                vbu.SelectOption(label=child_name, value=f"DISOWN {child_id}")
+                for child_id, child_name in child_names.items()
+            ]
 
             # See if they don't have any children
             if not child_options:
@@ -332,14 +326,12 @@ class Parentage(vbu.Cog):
 
             # Make our check
             def check(payload: vbu.ComponentInteractionPayload):
-                if payload.message.id != m.id:
-                    return False
                 if payload.user.id != ctx.author.id:
                     self.bot.loop.create_task(payload.respond("You can't respond to this message!", wait=False, ephemeral=True))
                     return False
                 return True
             try:
-                payload = await self.bot.wait_for("component_interaction", check=check, timeout=60)
+                payload = await utils.ComponentInteractionDispatcher.wait_for(m.id, check=check, timeout=60)
                 await payload.defer_update()
                 await payload.message.delete()
             except asyncio.TimeoutError:
@@ -373,17 +365,9 @@ class Parentage(vbu.Cog):
         if result is None:
             return
 
-        # Remove from cache
-        try:
-            user_tree._children.remove(child_tree.id)
-        except ValueError:
-            pass
-        child_tree._parent = None
-
-        # Remove from redis
-        async with self.bot.redis() as re:
-            await re.publish('TreeMemberUpdate', user_tree.to_json())
-            await re.publish('TreeMemberUpdate', child_tree.to_json())
+        # Remove from cache and redis
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.FamilyTreeUpdate(family_guild_id).remove_child(user_tree.id, child_tree.id).publish(re)
 
         # Remove from database
         async with self.bot.database() as db:
@@ -431,17 +415,9 @@ class Parentage(vbu.Cog):
         if result is None:
             return
 
-        # Remove family caching
-        user_tree._parent = None
-        try:
-            parent_tree._children.remove(ctx.author.id)
-        except ValueError:
-            pass
-
-        # Ping them off over reids
-        async with self.bot.redis() as re:
-            await re.publish('TreeMemberUpdate', user_tree.to_json())
-            await re.publish('TreeMemberUpdate', parent_tree.to_json())
+        # Remove family caching and ping them off over redis
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.FamilyTreeUpdate(family_guild_id).remove_child(parent_tree.id, user_tree.id).publish(re)
 
         # Remove their relationship from the database
         async with self.bot.database() as db:
@@ -485,11 +461,6 @@ class Parentage(vbu.Cog):
         if result is None:
             return
 
-        # Disown em
-        for child in child_trees:
-            child._parent = None
-        user_tree._children = []
-
         # Save em
         async with self.bot.database() as db:
             await db(
@@ -497,10 +468,12 @@ class Parentage(vbu.Cog):
                 ctx.author.id, family_guild_id, [child.id for child in child_trees],
             )
 
-        # Redis em
-        async with self.bot.redis() as re:
-            for person in child_trees + [user_tree]:
-                await re.publish('TreeMemberUpdate', person.to_json())
+        # Disown em and redis em
+        update = utils.FamilyTreeUpdate(family_guild_id)
+        for child in child_trees:
+            update.remove_child(user_tree.id, child.id)
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await update.publish(re)
 
         # Output to user
         await result.ctx.send("You've sucessfully disowned all of your children :c", wait=False)
@@ -538,24 +511,6 @@ class Parentage(vbu.Cog):
         child_trees = list(user_tree.children)
         partner_tree = user_tree.partner
 
-        # Remove children from cache
-        for child in child_trees:
-            child._parent = None
-        user_tree._children = []
-
-        # Remove parent from cache
-        if parent_tree:
-            user_tree._parent = None
-            try:
-                parent_tree._children.remove(ctx.author.id)
-            except ValueError:
-                pass
-
-        # Remove partner from cache
-        if partner_tree:
-            user_tree._partner = None
-            partner_tree._partner = None
-
         # Remove from database
         async with self.bot.database() as db:
             await db(
@@ -573,15 +528,16 @@ class Parentage(vbu.Cog):
                     ctx.author.id, partner_tree.id, family_guild_id,
                 )
 
-        # Remove from redis
-        async with self.bot.redis() as re:
-            for person in child_trees:
-                await re.publish('TreeMemberUpdate', person.to_json())
-            if parent_tree:
-                await re.publish('TreeMemberUpdate', parent_tree.to_json())
-            if partner_tree:
-                await re.publish('TreeMemberUpdate', partner_tree.to_json())
-            await re.publish('TreeMemberUpdate', user_tree.to_json())
+        # Remove from cache and redis
+        update = utils.FamilyTreeUpdate(family_guild_id)
+        for child in child_trees:
+            update.remove_child(user_tree.id, child.id)
+        if parent_tree:
+            update.remove_child(parent_tree.id, user_tree.id)
+        if partner_tree:
+            update.remove_partner(user_tree.id, partner_tree.id)
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await update.publish(re)
 
         # And we're done
         await result.ctx.send(
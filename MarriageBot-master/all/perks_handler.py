@@ -1,9 +1,15 @@
 import asyncio
 import collections
-from datetime import datetime as dt, timedelta
+from datetime import datetime as dt, timedelta, timezone
+import time
+import typing
 
 import voxelbotutils as vbu
 
+from cogs.utils.gold_guild_index import GoldGuildIndex
+from cogs.utils.redis_pool import RedisPool
+from cogs.utils.shard_message_codec import ShardMessageCodec
+
 
 class MarriageBotPerks(object):
 
@@ -54,29 +60,39 @@ TIER_VOTER = MarriageBotPerks(
 TIER_NONE = MarriageBotPerks()
 
 
-CACHED_PERK_ITEMS = collections.defaultdict(lambda: (None, dt(2000, 1, 1),))
-
+PERK_TIERS = {
+    "TIER_THREE": TIER_THREE,
+    "TIER_TWO": TIER_TWO,
+    "TIER_ONE": TIER_ONE,
+    "TIER_VOTER": TIER_VOTER,
+    "TIER_NONE": TIER_NONE,
+}
+PERK_TIER_NAMES = {id(o): i for i, o in PERK_TIERS.items()}
 
-def cache_response(**lifetime):
-    def inner(func):
-        async def wrapper(bot: vbu.Bot, user_id: int):
-            perks, expiry_time = CACHED_PERK_ITEMS[user_id]
-            if expiry_time > dt.utcnow():
-                return perks  # Cache not expired
-            perks = await func(bot, user_id)
-            CACHED_PERK_ITEMS[user_id] = (perks, dt.utcnow() + timedelta(**lifetime),)
-            return perks
-        return wrapper
-    return inner
+# Perks are materialised in the user_perks table, which the purchase, refund, and vote webhooks keep up
+# to date. They're cached in Redis so that every shard shares them, and in memory on each shard - whenever
+# a webhook changes someone's perks, the new ones are sent to every shard. Cached perks are loaded again
+# after PERKS_REVALIDATE_LIFETIME in case a change was missed, or after PERKS_RETRY_LIFETIME if we're still
+# waiting to hear from Upgrade.Chat about them. Until PERKS_STALE_LIFETIME after that, the cached perks are still
+# given back while they're loaded again in the background
+PERKS_REDIS_KEY = "MarriageBotPerks-{user_id}"
+PERKS_REVALIDATE_LIFETIME = timedelta(hours=1)
+PERKS_STALE_LIFETIME = timedelta(hours=1)
+PERKS_RETRY_LIFETIME = timedelta(minutes=1)
+MAX_CACHED_PERKS = 10_000
+VOTE_LIFETIME = timedelta(hours=12)
+CACHED_PERKS: typing.Dict[int, typing.Tuple[MarriageBotPerks, float, float]] = collections.OrderedDict()  # User ID: (perks, valid until, revalidate at)
+PERK_LOADS_IN_FLIGHT: typing.Dict[int, asyncio.Task] = {}
+PERK_RECHECKS_IN_FLIGHT: typing.Dict[int, asyncio.Task] = {}
 
 
-@cache_response(minutes=2)
 async def get_marriagebot_perks(bot: vbu.Bot, user_id: int) -> MarriageBotPerks:
     """
-    Get the specific perks that any given user has.
+    Get the specific perks that any given user has. This never waits on Upgrade.Chat or Top.gg -
+    users that we've never seen before, and subscribers, are checked against them in the background.
 
     Args:
-        bot (utils.Bot): The bot instance that will be used to fetch data from Upgrade.Chat.
+        bot (utils.Bot): The bot instance that will be used to load the user's perks.
         user_id (int): The ID of the user we want to get the perks of.
 
     Returns:
@@ -87,33 +103,343 @@ async def get_marriagebot_perks(bot: vbu.Bot, user_id: int) -> MarriageBotPerks:
     if user_id in bot.owner_ids:
         return TIER_THREE
 
-    # Check if they have a purchase
+    # See if they're cached
+    cached = CACHED_PERKS.get(user_id)
+    if cached is not None:
+        perks, valid_until, revalidate_at = cached
+        now = time.time()
+        if (not valid_until or valid_until > now) and revalidate_at + PERKS_STALE_LIFETIME.total_seconds() > now:
+            CACHED_PERKS.move_to_end(user_id)
+            if revalidate_at <= now:
+                refresh_marriagebot_perks(bot, user_id)
+            return perks
+
+    # Nope - wait for them to be loaded
+    return await asyncio.shield(refresh_marriagebot_perks(bot, user_id))
+
+
+def refresh_marriagebot_perks(bot: vbu.Bot, user_id: int) -> asyncio.Task:
+    """
+    Start loading a user's perks and caching them, unless we're loading them already.
+
+    Returns:
+        asyncio.Task: The task loading the user's perks.
+    """
+
+    def on_done(task):
+        PERK_LOADS_IN_FLIGHT.pop(user_id, None)
+        if not task.cancelled():
+            task.exception()  # Anything waiting on the task gets the error - don't warn about it
+
+    task = PERK_LOADS_IN_FLIGHT.get(user_id)
+    if task is None:
+        task = bot.loop.create_task(load_marriagebot_perks(bot, user_id))
+        PERK_LOADS_IN_FLIGHT[user_id] = task
+        task.add_done_callback(on_done)
+    return task
+
+
+async def load_marriagebot_perks(bot: vbu.Bot, user_id: int) -> MarriageBotPerks:
+    """
+    Load a user's perks from Redis, or from the database if they're not there, and cache them.
+    """
+
+    # See if another shard has cached them
+    async with RedisPool.acquire(bot) as re:
+        cached = await re.conn.get(PERKS_REDIS_KEY.format(user_id=user_id), encoding="utf-8")
+    if cached and cached.count(":") == 2:
+        tier_name, valid_until, revalidate_at = cached.split(":")
+        perks, valid_until, revalidate_at = PERK_TIERS[tier_name], float(valid_until), float(revalidate_at)
+        now = time.time()
+        if (not valid_until or valid_until > now) and revalidate_at > now:
+            cache_marriagebot_perks(user_id, perks, valid_until, revalidate_at)
+            return perks
+
+    # Get them from the database
+    async with bot.database() as db:
+        rows = await db("SELECT * FROM user_perks WHERE user_id=$1", user_id)
+
+    # Users from before perks were stored get what we know about them without asking Upgrade.Chat or
+    # Top.gg, only in this shard's memory, until they've been looked up in the background
+    if not rows:
+        row = {
+            'user_id': user_id,
+            'has_gold_guild': await fetch_has_guild_purchase(bot, user_id),
+            'upgrade_chat_tier': 0,
+            'last_voted': None,
+        }
+        recheck_marriagebot_perks(bot, user_id)
+        perks, valid_until = get_perks_from_row(row)
+        cache_marriagebot_perks(user_id, perks, valid_until, time.time() + PERKS_RETRY_LIFETIME.total_seconds())
+        return perks
+
+    # Subscribers are checked against Upgrade.Chat in the background, so that subscriptions which run
+    # out without us getting a webhook are picked up
+    row = rows[0]
+    if row['upgrade_chat_tier']:
+        recheck_marriagebot_perks(bot, user_id)
+
+    # And cache them
+    perks, valid_until = get_perks_from_row(row)
+    revalidate_at = time.time() + PERKS_REVALIDATE_LIFETIME.total_seconds()
+    async with RedisPool.acquire(bot) as re:
+        await set_perks_in_redis(re, user_id, perks, valid_until, revalidate_at)
+    cache_marriagebot_perks(user_id, perks, valid_until, revalidate_at)
+    return perks
+
+
+def recheck_marriagebot_perks(bot: vbu.Bot, user_id: int) -> asyncio.Task:
+    """
+    Start checking a user's perks against Upgrade.Chat (and Top.gg, for users that we've never
+    stored), unless we're checking them already.
+
+    Returns:
+        asyncio.Task: The task checking the user's perks.
+    """
+
+    def on_done(task):
+        PERK_RECHECKS_IN_FLIGHT.pop(user_id, None)
+        if not task.cancelled() and task.exception():
+            bot.logger.error(f"Failed to recheck perks for user {user_id}", exc_info=task.exception())
+
+    task = PERK_RECHECKS_IN_FLIGHT.get(user_id)
+    if task is None:
+        task = bot.loop.create_task(_recheck_marriagebot_perks(bot, user_id))
+        PERK_RECHECKS_IN_FLIGHT[user_id] = task
+        task.add_done_callback(on_done)
+    return task
+
+
+async def _recheck_marriagebot_perks(bot: vbu.Bot, user_id: int) -> None:
+    async with bot.database() as db:
+        rows = await db("SELECT * FROM user_perks WHERE user_id=$1", user_id)
+
+    # Users from before perks were stored are looked up the once, and then stored - unless we couldn't
+    # reach Upgrade.Chat, in which case we'll try again when their perks are next loaded
+    if not rows:
+        row = await fetch_user_perks_row(bot, user_id)
+        if row['upgrade_chat_tier'] is None:
+            return
+        async with bot.database() as db:
+            await db(
+                """INSERT INTO user_perks (user_id, has_gold_guild, upgrade_chat_tier, last_voted)
+                VALUES ($1, $2, $3, $4) ON CONFLICT (user_id) DO NOTHING""",
+                user_id, row['has_gold_guild'], row['upgrade_chat_tier'], row['last_voted'],
+            )
+        perks, valid_until = get_perks_from_row(row)
+        async with RedisPool.acquire(bot) as re:
+            await set_perks_in_redis(re, user_id, perks, valid_until)
+        cache_marriagebot_perks(user_id, perks, valid_until)
+        return
+
+    # Subscribers keep the tier that they had if Upgrade.Chat doesn't respond, but are checked again soon
+    row = rows[0]
+    purchased_item_names = await fetch_upgrade_chat_item_names(bot, user_id)
+    if purchased_item_names is None:
+        perks, valid_until = get_perks_from_row(row)
+        revalidate_at = time.time() + PERKS_RETRY_LIFETIME.total_seconds()
+        async with RedisPool.acquire(bot) as re:
+            await set_perks_in_redis(re, user_id, perks, valid_until, revalidate_at)
+        cache_marriagebot_perks(user_id, perks, valid_until, revalidate_at)
+        return
+
+    # Store their new tier if it's changed, which also sends it to every shard
+    upgrade_chat_tier = get_upgrade_chat_tier(purchased_item_names)
+    if upgrade_chat_tier != row['upgrade_chat_tier']:
+        async with bot.database() as db:
+            async with RedisPool.acquire(bot) as re:
+                await update_user_perks(db, re, user_id, upgrade_chat_tier=upgrade_chat_tier)
+
+
+def cache_marriagebot_perks(
+        user_id: int, perks: MarriageBotPerks, valid_until: float = 0.0,
+        revalidate_at: typing.Optional[float] = None) -> None:
+    """
+    Cache a user's perks in memory.
+
+    Args:
+        user_id (int): The ID of the user.
+        perks (MarriageBotPerks): Their perks.
+        valid_until (float, optional): The timestamp that the perks run out at, if they do.
+        revalidate_at (typing.Optional[float], optional): The timestamp to load the perks again at -
+            PERKS_REVALIDATE_LIFETIME from now by default.
+    """
+
+    if revalidate_at is None:
+        revalidate_at = time.time() + PERKS_REVALIDATE_LIFETIME.total_seconds()
+    CACHED_PERKS[user_id] = (perks, valid_until, revalidate_at)
+    CACHED_PERKS.move_to_end(user_id)
+    while len(CACHED_PERKS) > MAX_CACHED_PERKS:
+        CACHED_PERKS.popitem(last=False)
+
+
+def update_cached_marriagebot_perks(user_id: int, tier_name: str, valid_until: float = 0.0) -> None:
+    """
+    Update a user's perks in memory if we've got them cached, for when we're told that they've changed.
+    """
+
+    if user_id in CACHED_PERKS:
+        cache_marriagebot_perks(user_id, PERK_TIERS[tier_name], valid_until)
+
+
+async def set_perks_in_redis(
+        re, user_id: int, perks: MarriageBotPerks, valid_until: float = 0.0,
+        revalidate_at: typing.Optional[float] = None) -> None:
+    """
+    Cache a user's perks in Redis for every shard to use, until they need loading again.
+    """
+
+    if revalidate_at is None:
+        revalidate_at = time.time() + PERKS_REVALIDATE_LIFETIME.total_seconds()
+    await re.conn.set(
+        PERKS_REDIS_KEY.format(user_id=user_id),
+        f"{PERK_TIER_NAMES[id(perks)]}:{valid_until}:{revalidate_at}",
+        expire=max(int(revalidate_at - time.time()), 1),
+    )
+
+
+async def update_user_perks(db, re, user_id: int, **columns) -> MarriageBotPerks:
+    """
+    Change a user's stored perks, and send their new perks to every shard. This is used by the
+    purchase, refund, and vote webhooks.
+
+    Args:
+        db (utils.DatabaseConnection): The database connection to use.
+        re (utils.RedisConnection): The Redis connection to use.
+        user_id (int): The ID of the user whose perks have changed.
+        **columns: The columns in the user_perks table to change.
+
+    Returns:
+        MarriageBotPerks: The user's new perks.
+    """
+
+    # Update the table
+    names = list(columns.keys())
+    rows = await db(
+        """INSERT INTO user_perks (user_id, {0}) VALUES ($1, {1})
+        ON CONFLICT (user_id) DO UPDATE SET {2} RETURNING *""".format(
+            ", ".join(names),
+            ", ".join(f"${i}" for i in range(2, len(names) + 2)),
+            ", ".join(f"{i}=excluded.{i}" for i in names),
+        ),
+        user_id, *columns.values(),
+    )
+
+    # Cache and publish the new perks
+    perks, valid_until = get_perks_from_row(rows[0])
+    await set_perks_in_redis(re, user_id, perks, valid_until)
+    await ShardMessageCodec.publish(re, "UpdateUserPerks", {
+        "user_id": user_id,
+        "tier": PERK_TIER_NAMES[id(perks)],
+        "valid_until": valid_until,
+    })
+    return perks
+
+
+async def update_gold_guild_perks(db, re, user_id: int) -> MarriageBotPerks:
+    """
+    Update a user's stored perks after the Gold guilds that they've bought have changed.
+    """
+
+    rows = await db("SELECT * FROM guild_specific_families WHERE purchased_by=$1", user_id)
+    return await update_user_perks(db, re, user_id, has_gold_guild=bool(rows))
+
+
+def get_perks_from_row(row) -> typing.Tuple[MarriageBotPerks, float]:
+    """
+    Work out which perks a user has from their row in the user_perks table.
+
+    Returns:
+        typing.Tuple[MarriageBotPerks, float]: Their perks, and the timestamp that they run out at
+            (0 if they don't run out).
+    """
+
+    if row['has_gold_guild'] or row['upgrade_chat_tier'] >= 3:
+        return TIER_THREE, 0.0
+    elif row['upgrade_chat_tier'] == 2:
+        return TIER_TWO, 0.0
+    elif row['upgrade_chat_tier'] == 1:
+        return TIER_ONE, 0.0
+    if row['last_voted']:
+        valid_until = (row['last_voted'] + VOTE_LIFETIME).replace(tzinfo=timezone.utc).timestamp()
+        if valid_until > time.time():
+            return TIER_VOTER, valid_until
+    return TIER_NONE, 0.0
+
+
+def get_upgrade_chat_tier(purchased_item_names: typing.List[str]) -> int:
+    """
+    Get the highest subscription tier from a list of Upgrade.Chat item names.
+    """
+
+    if "MarriageBot Subscription Tier 3" in purchased_item_names:
+        return 3
+    elif "MarriageBot Subscription Tier 2" in purchased_item_names:
+        return 2
+    elif "MarriageBot Subscription Tier 1" in purchased_item_names:
+        return 1
+    return 0
+
+
+async def fetch_user_perks_row(bot: vbu.Bot, user_id: int) -> dict:
+    """
+    Build a user's row for the user_perks table from the database, Upgrade.Chat, and Top.gg, all at once.
+
+    Args:
+        bot (utils.Bot): The bot instance that will be used to fetch data from Upgrade.Chat.
+        user_id (int): The ID of the user we want to get the perks of.
+
+    Returns:
+        dict: The user's row, with `upgrade_chat_tier` as None if we couldn't reach Upgrade.Chat.
+    """
+
+    has_guild_purchase, purchased_item_names, has_voted = await asyncio.gather(
+        fetch_has_guild_purchase(bot, user_id),
+        fetch_upgrade_chat_item_names(bot, user_id),
+        fetch_has_topgg_vote(bot, user_id),
+    )
+    return {
+        'user_id': user_id,
+        'has_gold_guild': has_guild_purchase,
+        'upgrade_chat_tier': None if purchased_item_names is None else get_upgrade_chat_tier(purchased_item_names),
+        'last_voted': dt.utcnow() if has_voted else None,
+    }
+
+
+async def fetch_has_guild_purchase(bot: vbu.Bot, user_id: int) -> bool:
+    """
+    Get whether a user has bought MarriageBot Gold for a guild.
+    """
+
+    if GoldGuildIndex.loaded:
+        return bool(GoldGuildIndex.get_purchased_guilds(user_id))
     async with bot.database() as db:
         rows = await db("SELECT * FROM guild_specific_families WHERE purchased_by=$1", user_id)
-    if rows:
-        return TIER_THREE
+    return bool(rows)
+
+
+async def fetch_upgrade_chat_item_names(bot: vbu.Bot, user_id: int) -> typing.Optional[typing.List[str]]:
+    """
+    Get the names of all of the items that a user has bought through Upgrade.Chat, or None if
+    Upgrade.Chat didn't respond in time.
+    """
 
-    # Check UpgradeChat purchases
     try:
         purchases = await asyncio.wait_for(bot.upgrade_chat.get_orders(discord_id=user_id), timeout=3)
     except asyncio.TimeoutError:
-        purchases = []
+        return None
     purchased_item_names = []
     [purchased_item_names.extend(i.order_item_names) for i in purchases]
-    if "MarriageBot Subscription Tier 3" in purchased_item_names:
-        return TIER_THREE
-    elif "MarriageBot Subscription Tier 2" in purchased_item_names:
-        return TIER_TWO
-    elif "MarriageBot Subscription Tier 1" in purchased_item_names:
-        return TIER_ONE
+    return purchased_item_names
+
+
+async def fetch_has_topgg_vote(bot: vbu.Bot, user_id: int) -> bool:
+    """
+    Get whether a user has voted for the bot on Top.gg recently.
+    """
 
-    # Check Top.gg votes
     try:
         data = await asyncio.wait_for(bot.get_user_topgg_vote(user_id), timeout=3)
-        if data:
-            return TIER_VOTER
     except asyncio.TimeoutError:
-        pass
-
-    # Return default
-    return MarriageBotPerks()
+        return False
+    return bool(data)
@@ -1,11 +1,14 @@
 import asyncio
 import re
+import uuid
 
-import aioredlock
 import discord
 from discord.ext import commands
 import voxelbotutils as utils
 
+from cogs.utils.component_interaction_dispatcher import ComponentInteractionDispatcher
+from cogs.utils.redis_pool import RedisPool
+
 
 def only_mention(user: discord.User) -> discord.AllowedMentions:
     return discord.AllowedMentions(users=[user])
@@ -38,34 +41,65 @@ class ProposalInProgress(commands.CommandError):
 
 
 class ProposalLock(object):
+    """
+    A lock over a set of users while they're in a proposal. This doesn't hold on to a Redis
+    connection while the proposal is running - a pooled connection is only borrowed to take and
+    release the locks.
 
-    def __init__(self, redis, *locks):
-        self.redis = redis
-        self.locks = locks
+    Every user is locked in a single script, so either all of them are locked or none of them are,
+    and nothing can get in between checking the locks and taking them. Each lock holds a random
+    token so that we only ever release locks that are still ours.
+    """
+
+    LOCK_TIMEOUT = 120  # Seconds
+
+    # Lock every key or none of them
+    LOCK_SCRIPT = """
+    for _, key in ipairs(KEYS) do
+        if redis.call('EXISTS', key) == 1 then
+            return 0
+        end
+    end
+    for _, key in ipairs(KEYS) do
+        redis.call('SET', key, ARGV[1], 'PX', ARGV[2])
+    end
+    return 1
+    """
+
+    # Only delete the keys that still hold our token
+    UNLOCK_SCRIPT = """
+    local released = 0
+    for _, key in ipairs(KEYS) do
+        if redis.call('GET', key) == ARGV[1] then
+            redis.call('DEL', key)
+            released = released + 1
+        end
+    end
+    return released
+    """
+
+    def __init__(self, bot, token: str, *keys: str):
+        self.bot = bot
+        self.token = token
+        self.keys = keys
 
     @classmethod
-    async def lock(cls, redis, *user_ids):
-        locks = []
-        if any([await redis.lock_manager.is_locked(str(i)) for i in user_ids]):
-            raise ProposalInProgress()
-        try:
-            for i in user_ids:
-                locks.append(await redis.lock_manager.lock(str(i), lock_timeout=120))
-        except aioredlock.LockError:
-            for i in locks:
-                await redis.lock_manager.unlock(i)
-            await redis.disconnect()
+    async def lock(cls, bot, *user_ids):
+        keys = [str(i) for i in user_ids]
+        token = uuid.uuid4().hex
+        async with RedisPool.acquire(bot) as redis:
+            locked = await redis.conn.eval(
+                cls.LOCK_SCRIPT,
+                keys=keys,
+                args=[token, cls.LOCK_TIMEOUT * 1_000],
+            )
+        if not locked:
             raise ProposalInProgress()
-        return cls(redis, *locks)
+        return cls(bot, token, *keys)
 
-    async def unlock(self, *, disconnect_redis: bool = True):
-        for i in self.locks:
-            try:
-                await self.redis.lock_manager.unlock(i)
-            except aioredlock.LockError:
-                pass
-        if disconnect_redis:
-            await self.redis.disconnect()
+    async def unlock(self):
+        async with RedisPool.acquire(self.bot) as redis:
+            await redis.conn.eval(self.UNLOCK_SCRIPT, keys=list(self.keys), args=[self.token])
 
     async def __aenter__(self):
         return self
@@ -101,8 +135,6 @@ async def send_proposal_message(
     message = await ctx.send(text, components=components, wait=True)  # f"Hey, {user.mention}, do you want to adopt {ctx.author.mention}?"
     try:
         def check(payload):
-            if payload.message.id != message.id:
-                return False  # not relevant to this request
             if payload.user.id not in [user.id, ctx.author.id]:
                 ctx.bot.loop.create_task(payload.respond("You can't respond to this proposal!", embeddify=False, ephemeral=True))
                 return False  # user isn't whitelisted
@@ -113,7 +145,7 @@ async def send_proposal_message(
                     ctx.bot.loop.create_task(payload.respond("You can't accept your own proposal!", embeddify=False, ephemeral=True))
                     return False
             return True
-        button_event = await ctx.bot.wait_for("component_interaction", check=check, timeout=60)
+        button_event = await ComponentInteractionDispatcher.wait_for(message.id, check=check, timeout=60)
         await button_event.defer()
     except asyncio.TimeoutError:
         ctx.bot.loop.create_task(message.update_message(components=components.disable_components()))
@@ -0,0 +1,86 @@
+import time
+import typing
+
+from cogs.utils.redis_pool import RedisPool
+
+
+class RedisCooldown(object):
+    """
+    Token bucket cooldowns kept in Redis, so that a user gets the same limits whichever shard their
+    commands land on.
+
+    Each bucket is a Redis hash of how many tokens it has and when it was last updated, refilled and
+    spent in a single script using Redis' own clock. When a bucket is empty we remember locally when
+    it'll have a token again, so a user who keeps retrying while on cooldown doesn't cost a Redis
+    round trip each time.
+    """
+
+    KEY_FORMAT = "Cooldown-{name}-{bucket_id}"
+    MAX_BLOCKED_BUCKETS = 10_000
+
+    # KEYS: bucket; ARGV: capacity, milliseconds to refill the whole bucket
+    # Returns how many milliseconds until a token is available, or 0 if one was spent
+    # Redis before 5.0 won't let a script write after calling TIME unless it replicates its writes
+    # rather than the script itself
+    TOKEN_BUCKET_SCRIPT = """
+    redis.replicate_commands()
+    local capacity = tonumber(ARGV[1])
+    local per = tonumber(ARGV[2])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated) * capacity / per)
+    local retry_after = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        retry_after = math.ceil((1 - tokens) * per / capacity)
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', now)
+    redis.call('PEXPIRE', KEYS[1], per)
+    return retry_after
+    """
+
+    blocked_until: typing.Dict[str, float] = {}  # Bucket key: monotonic time that it has a token again
+
+    @classmethod
+    async def consume(cls, bot, name: str, bucket_id: int, *, rate: int, per: float) -> float:
+        """
+        Try to take a token from a bucket.
+
+        Args:
+            bot (utils.Bot): The bot instance to get a Redis connection from.
+            name (str): The name of the cooldown (eg the command name).
+            bucket_id (int): Whose bucket it is (eg the user ID).
+            rate (int): How many tokens the bucket holds.
+            per (float): How many seconds it takes for the bucket to refill.
+
+        Returns:
+            float: How many seconds until the bucket has a token, or 0 if one was taken.
+        """
+
+        # See if we already know that they're on cooldown
+        key = cls.KEY_FORMAT.format(name=name, bucket_id=bucket_id)
+        now = time.monotonic()
+        blocked_until = cls.blocked_until.get(key)
+        if blocked_until is not None:
+            if blocked_until > now:
+                return blocked_until - now
+            del cls.blocked_until[key]
+
+        # Take a token from the shared bucket
+        async with RedisPool.acquire(bot) as re:
+            retry_after = await re.conn.eval(
+                cls.TOKEN_BUCKET_SCRIPT,
+                keys=[key],
+                args=[rate, max(int(per * 1_000), 1)],
+            ) / 1_000
+
+        # Remember if they're on cooldown
+        if retry_after:
+            if len(cls.blocked_until) >= cls.MAX_BLOCKED_BUCKETS:
+                cls.blocked_until = {i: o for i, o in cls.blocked_until.items() if o > now}
+            cls.blocked_until[key] = now + retry_after
+        return retry_after
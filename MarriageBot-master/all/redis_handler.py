@@ -1,4 +1,8 @@
+import asyncio
+
+import aioredis
 import discord
+from discord.ext import tasks
 import voxelbotutils as vbu
 
 from cogs import utils
@@ -6,8 +10,13 @@ from cogs import utils
 
 class RedisHandler(vbu.Cog):
 
+    # How long we wait before resubscribing to shard messages after losing the connection
+    SHARD_MESSAGE_MIN_RETRY_DELAY = 1
+    SHARD_MESSAGE_MAX_RETRY_DELAY = 60
+
     def __init__(self, bot: vbu.Bot):
         super().__init__(bot)
+        self.shard_message_task: asyncio.Task = None
         if vbu.RedisConnection.enabled:
             self.update_guild_prefix.start()
             self.update_max_family_members.start()
@@ -15,7 +24,12 @@ class RedisHandler(vbu.Cog):
             self.update_max_children.start()
             self.update_gifs_enabled.start()
             self.send_user_message.start()
+            self.blocked_user_add.start()
+            self.blocked_user_remove.start()
             self.tree_member_update.start()
+            self.check_family_tree_update_log.start()
+            self.report_redis_pool_stats.start()
+            self.shard_message_task = self.bot.loop.create_task(self.subscribe_to_shard_messages())
 
     def cog_unload(self):
         self.update_guild_prefix.stop()
@@ -24,54 +38,85 @@ class RedisHandler(vbu.Cog):
         self.update_max_children.stop()
         self.update_gifs_enabled.stop()
         self.send_user_message.stop()
+        self.blocked_user_add.stop()
+        self.blocked_user_remove.stop()
         self.tree_member_update.stop()
+        self.check_family_tree_update_log.cancel()
+        self.report_redis_pool_stats.cancel()
+        if self.shard_message_task is not None:
+            self.shard_message_task.cancel()
+
+    # The original JSON channels, which are kept so that anything still publishing to them during a
+    # deploy is still heard - everything in this codebase publishes binary ShardMessages instead
 
     @vbu.redis_channel_handler("UpdateGuildPrefix")
     def update_guild_prefix(self, payload):
+        self.handle_update_guild_prefix(payload)
+
+    @vbu.redis_channel_handler("UpdateFamilyMaxMembers")
+    def update_max_family_members(self, payload):
+        self.handle_update_max_family_members(payload)
+
+    @vbu.redis_channel_handler("UpdateIncestAllowed")
+    def update_incest_alllowed(self, payload):
+        self.handle_update_incest_allowed(payload)
+
+    @vbu.redis_channel_handler("UpdateMaxChildren")
+    def update_max_children(self, payload):
+        self.handle_update_max_children(payload)
+
+    @vbu.redis_channel_handler("UpdateGifsEnabled")
+    def update_gifs_enabled(self, payload):
+        self.handle_update_gifs_enabled(payload)
+
+    @vbu.redis_channel_handler("SendUserMessage")
+    async def send_user_message(self, payload):
+        await self.handle_send_user_message(payload)
+
+    @vbu.redis_channel_handler("BlockedUserAdd")
+    def blocked_user_add(self, payload):
+        self.handle_blocked_user_add(payload)
+
+    @vbu.redis_channel_handler("BlockedUserRemove")
+    def blocked_user_remove(self, payload):
+        self.handle_blocked_user_remove(payload)
+
+    def handle_update_guild_prefix(self, payload):
         """
         Updates the prefix for the guild.
         """
 
         self.bot.guild_settings[payload['guild_id']].update(payload)
 
-    @vbu.redis_channel_handler("UpdateFamilyMaxMembers")
-    def update_max_family_members(self, payload):
+    def handle_update_max_family_members(self, payload):
         """
         Updates the max number of family members for the guild.
         """
 
-        data = payload.get('max_family_members')
-        self.bot.guild_settings[payload['guild_id']]['max_family_members'] = data
+        utils.GuildSettingsCache.update(payload['guild_id'], max_family_members=payload.get('max_family_members'))
 
-    @vbu.redis_channel_handler("UpdateIncestAllowed")
-    def update_incest_alllowed(self, payload):
+    def handle_update_incest_allowed(self, payload):
         """
         Updates whether incest is allowed on guild.
         """
 
-        data = payload.get('allow_incest')
-        self.bot.guild_settings[payload['guild_id']]['allow_incest'] = data
+        utils.GuildSettingsCache.update(payload['guild_id'], allow_incest=payload.get('allow_incest'))
 
-    @vbu.redis_channel_handler("UpdateMaxChildren")
-    def update_max_children(self, payload):
+    def handle_update_max_children(self, payload):
         """
         Updates the maximum children allowed per role in a guild.
         """
 
-        data = payload.get('max_children')
-        self.bot.guild_settings[payload['guild_id']]['max_children'] = data
+        utils.GuildSettingsCache.update(payload['guild_id'], max_children=payload.get('max_children'))
 
-    @vbu.redis_channel_handler("UpdateGifsEnabled")
-    def update_gifs_enabled(self, payload):
+    def handle_update_gifs_enabled(self, payload):
         """
         Updates whether or not gifs are enabled for a guild.
         """
 
-        data = payload.get('gifs_enabled')
-        self.bot.guild_settings[payload['guild_id']]['gifs_enabled'] = data
+        utils.GuildSettingsCache.update(payload['guild_id'], gifs_enabled=payload.get('gifs_enabled'))
 
-    @vbu.redis_channel_handler("SendUserMessage")
-    async def send_user_message(self, payload):
+    async def handle_send_user_message(self, payload):
         """
         Sends a message to a given user.
         """
@@ -87,10 +132,219 @@ class RedisHandler(vbu.Cog):
         except (discord.NotFound, discord.Forbidden, AttributeError):
             pass
 
+    def handle_blocked_user_add(self, payload):
+        """
+        Adds a block to the blocked user index.
+        """
+
+        utils.BlockedUserIndex.add(payload['user_id'], payload['blocked_user_id'])
+
+    def handle_blocked_user_remove(self, payload):
+        """
+        Removes a block from the blocked user index.
+        """
+
+        utils.BlockedUserIndex.remove(payload['user_id'], payload['blocked_user_id'])
+
+    def handle_update_user_perks(self, payload):
+        """
+        Updates a user's cached perks after a purchase, refund, or vote.
+        """
+
+        utils.update_cached_marriagebot_perks(payload['user_id'], payload['tier'], payload['valid_until'])
+
+    async def handle_update_gold_guild(self, payload):
+        """
+        Updates who bought MarriageBot Gold for a guild. The process with shard 0 also fills in the
+        shared Redis hash if the change couldn't be written to it because it was missing.
+        """
+
+        if not utils.GoldGuildIndex.loaded:
+            return
+        utils.GoldGuildIndex.apply(payload['guild_id'], payload['user_id'])
+        if 0 not in (self.bot.shard_ids or [0]):
+            return
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.GoldGuildIndex.save_to_redis(re)
+
     @vbu.redis_channel_handler("TreeMemberUpdate")
     def tree_member_update(self, payload):
+        """
+        Replaces a cached family member with the one given. This is only kept so that shards on
+        older versions can still be heard from during a deploy - FamilyTreeUpdate is used instead.
+        """
+
         utils.FamilyTreeMember(**payload)
 
+    async def handle_family_tree_update(self, update):
+        """
+        Applies a change to the cached family graph, catching up on any changes that we missed.
+        """
+
+        if not await utils.FamilyTreeUpdateLog.receive(self.bot, update):
+            await self.reload_family_cache()
+
+    async def subscribe_to_shard_messages(self):
+        """
+        Listens for binary messages from other shards and hands them to their handlers. If the
+        connection drops then we reconnect, backing off while Redis is unreachable, and catch up on
+        any family tree updates that we missed while we weren't listening.
+
+        This uses its own connection rather than one from the bot's pool, since it's held for as
+        long as we're subscribed and is closed whenever we reconnect.
+        """
+
+        retry_delay = self.SHARD_MESSAGE_MIN_RETRY_DELAY
+        has_subscribed = False
+        while True:
+            receiver = aioredis.pubsub.Receiver()
+            conn = None
+            try:
+                redis_config = dict(self.bot.config['redis'])
+                redis_config.pop('enabled', None)
+                conn = await aioredis.create_redis((redis_config.pop('host'), redis_config.pop('port')), **redis_config)
+                await conn.subscribe(receiver.channel(utils.ShardMessageCodec.CHANNEL_NAME))
+                if has_subscribed:
+                    self.logger.info("Resubscribed to shard messages")
+                    await self.catch_up_family_tree_updates()
+                has_subscribed = True
+                retry_delay = self.SHARD_MESSAGE_MIN_RETRY_DELAY
+                async for _, data in receiver.iter():
+                    try:
+                        await self.handle_shard_message(data)
+                    except Exception as e:
+                        self.logger.error(f"Failed to handle shard message: {e}", exc_info=e)
+                self.logger.warning(f"Lost connection to shard messages - reconnecting in {retry_delay}s")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Failed to listen for shard messages - retrying in {retry_delay}s: {e}", exc_info=e)
+            finally:
+                receiver.stop()
+                if conn is not None:
+                    conn.close()
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, self.SHARD_MESSAGE_MAX_RETRY_DELAY)
+
+    async def handle_shard_message(self, data: bytes):
+        """
+        Handles a binary message from another shard. The header is read first so that messages
+        about guilds that this shard doesn't serve are dropped without decoding their body.
+
+        Family tree updates are applied before the next message is read, since they have to be
+        applied in order - any other handler that needs to wait on something runs in its own task,
+        so that it doesn't hold up the messages behind it.
+        """
+
+        try:
+            message_name, guild_id, sequence = utils.ShardMessageCodec.decode_header(data)
+        except ValueError as e:
+            self.logger.warning(f"Dropping shard message: {e}")
+            return
+        serves_guild = guild_id == 0 or self.is_guild_on_shard(guild_id)
+
+        # Family tree updates for other guilds still move our place in the update log along
+        if message_name == "FamilyTreeUpdate":
+            if serves_guild:
+                payload = utils.ShardMessageCodec.decode_body(data)
+                update = utils.FamilyTreeUpdate.from_json({**payload, 'sequence': sequence or None})
+            else:
+                update = utils.FamilyTreeUpdate(guild_id, sequence=sequence or None)
+            return await self.handle_family_tree_update(update)
+
+        # Everything else can just be skipped
+        if not serves_guild:
+            return
+        payload = utils.ShardMessageCodec.decode_body(data)
+        handler = {
+            "UpdateGuildPrefix": self.handle_update_guild_prefix,
+            "UpdateFamilyMaxMembers": self.handle_update_max_family_members,
+            "UpdateIncestAllowed": self.handle_update_incest_allowed,
+            "UpdateMaxChildren": self.handle_update_max_children,
+            "UpdateGifsEnabled": self.handle_update_gifs_enabled,
+            "SendUserMessage": self.handle_send_user_message,
+            "BlockedUserAdd": self.handle_blocked_user_add,
+            "BlockedUserRemove": self.handle_blocked_user_remove,
+            "UpdateUserPerks": self.handle_update_user_perks,
+            "UpdateGoldGuild": self.handle_update_gold_guild,
+        }.get(message_name)
+        if handler is None:
+            return
+        result = handler(payload)
+        if asyncio.iscoroutine(result):
+            self.bot.loop.create_task(self.wait_for_shard_message_handler(message_name, result))
+
+    async def wait_for_shard_message_handler(self, message_name: str, handler_coro):
+        """
+        Runs a shard message handler in the background, logging it if it fails.
+        """
+
+        try:
+            await handler_coro
+        except Exception as e:
+            self.logger.error(f"Failed to handle {message_name} shard message: {e}", exc_info=e)
+
+    def is_guild_on_shard(self, guild_id: int) -> bool:
+        """
+        Gets whether a guild belongs to one of this process's shards. This is worked out from the
+        guild's ID rather than the guild cache, so that guilds which are unavailable (or which we
+        haven't been sent yet) still count.
+        """
+
+        if self.bot.shard_count is None or self.bot.shard_ids is None:
+            return True
+        return (guild_id >> 22) % self.bot.shard_count in self.bot.shard_ids
+
+    @tasks.loop(seconds=30)
+    async def check_family_tree_update_log(self):
+        """
+        Catches up on any family tree changes that we missed and haven't heard about since
+        (eg if we were disconnected from Redis for the last update). Errors are logged rather than
+        raised, since they'd stop the loop for good.
+        """
+
+        try:
+            await self.catch_up_family_tree_updates()
+        except Exception as e:
+            self.logger.error(f"Failed to catch up on family tree updates: {e}", exc_info=e)
+
+    @tasks.loop(seconds=60)
+    async def report_redis_pool_stats(self):
+        """
+        Sends how busy the Redis connection pool has been to statsd.
+        """
+
+        pool_stats = utils.RedisPool.pop_stats()
+        async with self.bot.stats() as stats:
+            stats.increment("marriagebot.redis.pool.acquires", value=pool_stats["acquires"])
+            if pool_stats["acquires"]:
+                stats.timing(
+                    "marriagebot.redis.pool.wait_time",
+                    pool_stats["total_wait_time"] / pool_stats["acquires"] * 1_000,
+                )
+            stats.timing("marriagebot.redis.pool.max_wait_time", pool_stats["max_wait_time"] * 1_000)
+            stats.gauge("marriagebot.redis.pool.in_use", pool_stats["max_in_use"])
+            stats.gauge("marriagebot.redis.pool.saturation", pool_stats["max_in_use"] / pool_stats["size"])
+
+    async def catch_up_family_tree_updates(self):
+        """
+        Applies any family tree changes that we've missed from the update log, reloading the
+        cache if they're no longer there.
+        """
+
+        if not await utils.FamilyTreeUpdateLog.catch_up(self.bot):
+            await self.reload_family_cache()
+
+    async def reload_family_cache(self):
+        """
+        Reloads the family cache from the database, for when we've missed more updates than the
+        update log still holds.
+        """
+
+        self.logger.warning("Missed family tree updates that are no longer in the update log - reloading the cache")
+        utils.FamilyTreeUpdateLog.last_applied_sequence = None
+        await self.bot.startup()
+
 
 def setup(bot: vbu.Bot):
     x = RedisHandler(bot)
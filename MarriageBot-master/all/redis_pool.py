@@ -0,0 +1,103 @@
+import asyncio
+import contextlib
+import time
+import typing
+
+import voxelbotutils as utils
+
+
+class RedisPool(object):
+    """
+    A long-lived, bounded pool of Redis connections that every command shares.
+
+    Connections are kept open and handed back out rather than being set up and torn down for every
+    publish or GET, and no more than `max_connections` are ever open at once - if they're all in use
+    then the next caller waits for one to be released. Several commands can be sent in one round trip
+    by using `re.conn.pipeline()` on a pooled connection.
+    """
+
+    DEFAULT_MAX_CONNECTIONS = 20
+
+    idle_connections: typing.List[utils.RedisConnection] = []
+    connections_in_use: int = 0
+    max_connections: typing.Optional[int] = None
+    _semaphore: typing.Optional[asyncio.Semaphore] = None
+
+    # How the pool is doing - these are reported (and reset) by the Redis handler cog
+    acquire_count: int = 0
+    total_wait_time: float = 0.0
+    max_wait_time: float = 0.0
+    max_connections_in_use: int = 0
+
+    @classmethod
+    def get_semaphore(cls, bot: utils.Bot) -> asyncio.Semaphore:
+        """
+        Gets the semaphore that bounds how many connections can be in use at once.
+        """
+
+        if cls._semaphore is None:
+            cls.max_connections = bot.config.get('redis_pool_size', cls.DEFAULT_MAX_CONNECTIONS)
+            cls._semaphore = asyncio.Semaphore(cls.max_connections)
+        return cls._semaphore
+
+    @classmethod
+    @contextlib.asynccontextmanager
+    async def acquire(cls, bot: utils.Bot) -> typing.AsyncIterator[utils.RedisConnection]:
+        """
+        Borrow a connection from the pool for the duration of an `async with` block.
+
+        Args:
+            bot (utils.Bot): The bot instance whose Redis config should be used to open new connections.
+
+        Yields:
+            utils.RedisConnection: The connection to use.
+        """
+
+        # Wait for a free slot
+        wait_start_time = time.monotonic()
+        semaphore = cls.get_semaphore(bot)
+        await semaphore.acquire()
+        wait_time = time.monotonic() - wait_start_time
+        cls.connections_in_use += 1
+        re = None
+        try:
+
+            # Track how long we waited and how busy the pool is
+            cls.acquire_count += 1
+            cls.total_wait_time += wait_time
+            cls.max_wait_time = max(cls.max_wait_time, wait_time)
+            cls.max_connections_in_use = max(cls.max_connections_in_use, cls.connections_in_use)
+
+            # Grab a connection, reusing an open one if we can
+            while cls.idle_connections and re is None:
+                re = cls.idle_connections.pop()
+                if re.conn is None or re.conn.closed:
+                    re = None
+            if re is None:
+                re = await bot.redis.get_connection()
+            yield re
+
+        # Put it back if it's still usable
+        finally:
+            cls.connections_in_use -= 1
+            semaphore.release()
+            if re is not None and re.conn is not None and not re.conn.closed:
+                cls.idle_connections.append(re)
+
+    @classmethod
+    def pop_stats(cls) -> typing.Dict[str, float]:
+        """
+        Get how many connections were acquired since this was last called, how long they waited for
+        in total and at most (in seconds), the most that were in use at once, and the pool's size.
+        """
+
+        output = {
+            "acquires": cls.acquire_count,
+            "total_wait_time": cls.total_wait_time,
+            "max_wait_time": cls.max_wait_time,
+            "max_in_use": cls.max_connections_in_use,
+            "size": cls.max_connections or cls.DEFAULT_MAX_CONNECTIONS,
+        }
+        cls.acquire_count = cls.max_connections_in_use = 0
+        cls.total_wait_time = cls.max_wait_time = 0.0
+        return output
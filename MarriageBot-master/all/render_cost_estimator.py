@@ -0,0 +1,165 @@
+import math
+import typing
+
+
+class RenderPlan(object):
+    """
+    How a tree should be rendered, as picked by the render cost estimator.
+    """
+
+    __slots__ = ("format_rendering_option", "dpi", "split", "refuse", "estimated_time",)
+
+    def __init__(
+            self, format_rendering_option: str = None, dpi: int = None, *, split: bool = False,
+            refuse: bool = False, estimated_time: float = 0.0):
+        self.format_rendering_option = format_rendering_option
+        self.dpi = dpi
+        self.split = split
+        self.refuse = refuse
+        self.estimated_time = estimated_time
+
+    def __repr__(self) -> str:
+        return (
+            f"RenderPlan[{self.format_rendering_option} @ {self.dpi}dpi <split {self.split}> "
+            f"<refuse {self.refuse}> <~{self.estimated_time:.2f}s>]"
+        )
+
+
+class RenderCostModel(object):
+    """
+    A linear model of how long a render takes for a given cost, fitted to the
+    renders that we've timed. Older renders are slowly decayed out of the fit so that
+    the model follows changes in load.
+    """
+
+    __slots__ = ("base_time", "time_per_unit", "sum_weights", "sum_x", "sum_y", "sum_xx", "sum_xy",)
+
+    DECAY = 0.98
+
+    def __init__(self, base_time: float, time_per_unit: float):
+        self.base_time = base_time
+        self.time_per_unit = time_per_unit
+        self.sum_weights = 0.0
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.sum_xx = 0.0
+        self.sum_xy = 0.0
+
+    def estimate(self, cost: float) -> float:
+        """
+        Estimate how long a render of the given cost will take, in seconds.
+        """
+
+        return self.base_time + (self.time_per_unit * cost)
+
+    def record(self, cost: float, render_time: float) -> None:
+        """
+        Add a timed render to the model.
+        """
+
+        self.sum_weights = (self.sum_weights * self.DECAY) + 1
+        self.sum_x = (self.sum_x * self.DECAY) + cost
+        self.sum_y = (self.sum_y * self.DECAY) + render_time
+        self.sum_xx = (self.sum_xx * self.DECAY) + (cost * cost)
+        self.sum_xy = (self.sum_xy * self.DECAY) + (cost * render_time)
+
+        # We need a spread of costs before a fit means anything, so until then we just
+        # move the slope so that it goes through the latest render
+        variance = (self.sum_weights * self.sum_xx) - (self.sum_x ** 2)
+        if self.sum_weights < 5 or variance <= 1e-9:
+            if cost > 0:
+                self.time_per_unit = max((render_time - self.base_time) / cost, 0.0)
+            return
+        time_per_unit = ((self.sum_weights * self.sum_xy) - (self.sum_x * self.sum_y)) / variance
+        self.time_per_unit = max(time_per_unit, 0.0)
+        self.base_time = max((self.sum_y - (self.time_per_unit * self.sum_x)) / self.sum_weights, 0.0)
+
+
+class RenderCostEstimator(object):
+    """
+    Picks how a tree should be rendered before we start rendering it, so that huge trees are
+    cheapened (or refused) up front rather than timing out in Graphviz.
+
+    The cost of a tree comes from its node count and the size of its widest generation (which is
+    what makes Graphviz's crossing minimisation slow); the time that each way of rendering
+    takes for a given cost is calibrated from the renders that we've timed.
+    """
+
+    DEFAULT_DPI = 96
+    LOW_DPI = 48
+
+    # Our starting guesses for each (format, DPI) before any renders have been timed
+    models: typing.Dict[typing.Tuple[str, int], RenderCostModel] = {
+        ('-Tpng:cairo', DEFAULT_DPI): RenderCostModel(0.3, 0.004),
+        ('-Tpng:cairo', LOW_DPI): RenderCostModel(0.25, 0.003),
+        ('-Tpng:gd', DEFAULT_DPI): RenderCostModel(0.2, 0.003),
+        ('-Tpng:gd', LOW_DPI): RenderCostModel(0.15, 0.0025),
+    }
+
+    @staticmethod
+    def get_cost(gen_span: typing.Dict[int, list]) -> float:
+        """
+        Get the cost of rendering a given generational span.
+
+        Args:
+            gen_span (typing.Dict[int, list]): The generational span to be rendered.
+
+        Returns:
+            float: The cost of the tree, in arbitrary units.
+        """
+
+        node_count = sum(len(i) for i in gen_span.values())
+        generation_count = len(gen_span)
+        widest_generation = max([len(i) for i in gen_span.values()] or [0])
+        return (node_count * max(math.log2(widest_generation + 1), 1)) + generation_count
+
+    @classmethod
+    def record(cls, format_rendering_option: str, dpi: int, cost: float, render_time: float) -> None:
+        """
+        Record how long a render actually took so the estimates get better.
+        """
+
+        model = cls.models.get((format_rendering_option, dpi))
+        if model is None:
+            return
+        model.record(cost, render_time)
+
+    @classmethod
+    def get_plan(cls, cost: float, format_rendering_option: str, *, budget: float, can_split: bool = True) -> RenderPlan:
+        """
+        Pick how a tree of a given cost should be rendered within a time budget. We'll try the
+        quality that the user is allowed to have first, then a lower DPI, then the (faster) gd
+        renderer, before asking for the tree to be split or refusing to render it at all.
+
+        Args:
+            cost (float): The cost of the tree, as given by `get_cost`.
+            format_rendering_option (str): The Graphviz format that the user would normally get.
+            budget (float): How long we're willing to spend on rendering, in seconds.
+            can_split (bool, optional): Whether or not the tree can be split into a smaller one.
+
+        Returns:
+            RenderPlan: How the tree should be rendered.
+        """
+
+        # Work out which options we have
+        options = [
+            (format_rendering_option, cls.DEFAULT_DPI),
+            (format_rendering_option, cls.LOW_DPI),
+        ]
+        if format_rendering_option != '-Tpng:gd':
+            options.extend([
+                ('-Tpng:gd', cls.DEFAULT_DPI),
+                ('-Tpng:gd', cls.LOW_DPI),
+            ])
+
+        # Use the first one that fits
+        estimated_time = 0.0
+        for option, dpi in options:
+            estimated_time = cls.models[(option, dpi)].estimate(cost)
+            if estimated_time <= budget:
+                return RenderPlan(option, dpi, estimated_time=estimated_time)
+
+        # Nothing fits
+        if can_split:
+            return RenderPlan(split=True, estimated_time=estimated_time)
+        return RenderPlan(refuse=True, estimated_time=estimated_time)
@@ -39,8 +39,11 @@ class ServerSpecific(vbu.Cog):
 
         if not self.bot.config['is_server_specific']:
             return
-        async with self.bot.database() as db:
-            data = await db("SELECT guild_id FROM guild_specific_families WHERE guild_id=$1", guild.id)
+        if utils.GoldGuildIndex.loaded:
+            data = utils.GoldGuildIndex.is_gold_guild(guild.id)
+        else:
+            async with self.bot.database() as db:
+                data = await db("SELECT guild_id FROM guild_specific_families WHERE guild_id=$1", guild.id)
         if data:
             return
         self.logger.warn(f"Automatically left guild {guild.name} ({guild.id}) for non-subscription")
@@ -128,7 +131,7 @@ class ServerSpecific(vbu.Cog):
                 DO UPDATE SET allow_incest=excluded.allow_incest""",
                 ctx.guild.id, True,
             )
-        self.bot.guild_settings[ctx.guild.id]['allow_incest'] = True
+        utils.GuildSettingsCache.update(ctx.guild.id, allow_incest=True)
         await ctx.send("Incest is now **ALLOWED** on your guild.", wait=False)
 
     @vbu.command(hidden=True)
@@ -147,7 +150,7 @@ class ServerSpecific(vbu.Cog):
                 DO UPDATE SET allow_incest=excluded.allow_incest""",
                 ctx.guild.id, False,
             )
-        self.bot.guild_settings[ctx.guild.id]['allow_incest'] = False
+        utils.GuildSettingsCache.update(ctx.guild.id, allow_incest=False)
         await ctx.send("Incest is now **DISALLOWED** on your guild.", wait=False)
 
     @vbu.group(add_slash_command=False)
@@ -185,7 +188,7 @@ class ServerSpecific(vbu.Cog):
                 DO UPDATE SET allow_incest=excluded.allow_incest""",
                 ctx.guild.id, True,
             )
-        self.bot.guild_settings[ctx.guild.id]['allow_incest'] = True
+        utils.GuildSettingsCache.update(ctx.guild.id, allow_incest=True)
         await ctx.send("Incest is now **ALLOWED** on your guild.", wait=False)
 
     @incest.command(name="disallow", aliases=['disable', 'off', 'stop'], add_slash_command=False)
@@ -204,7 +207,7 @@ class ServerSpecific(vbu.Cog):
                 DO UPDATE SET allow_incest=excluded.allow_incest""",
                 ctx.guild.id, False,
             )
-        self.bot.guild_settings[ctx.guild.id]['allow_incest'] = False
+        utils.GuildSettingsCache.update(ctx.guild.id, allow_incest=False)
         await ctx.send("Incest is now **DISALLOWED** on your guild.", wait=False)
 
     @vbu.command(aliases=['ssf'])
@@ -275,11 +278,8 @@ class ServerSpecific(vbu.Cog):
         )
 
         # Update cache
-        usera_tree._partner = userb
-        userb_tree._partner = usera
-        async with self.bot.redis() as re:
-            await re.publish('TreeMemberUpdate', usera_tree.to_json())
-            await re.publish('TreeMemberUpdate', userb_tree.to_json())
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.FamilyTreeUpdate(family_guild_id).add_partner(usera_tree.id, userb_tree.id).publish(re)
 
     @vbu.command(add_slash_command=False)
     @utils.checks.is_server_specific_bot_moderator()
@@ -308,12 +308,8 @@ class ServerSpecific(vbu.Cog):
             )
 
         # Update cache
-        usera_tree.partner._partner = None
-        userb_tree = usera_tree.partner
-        usera_tree._partner = None
-        async with self.bot.redis() as re:
-            await re.publish('TreeMemberUpdate', usera_tree.to_json())
-            await re.publish('TreeMemberUpdate', userb_tree.to_json())
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.FamilyTreeUpdate(family_guild_id).remove_partner(usera_tree.id, usera_tree._partner).publish(re)
         await ctx.send("Consider it done.", wait=False)
 
     @vbu.command(add_slash_command=False)
@@ -349,11 +345,8 @@ class ServerSpecific(vbu.Cog):
                 return await ctx.send("I ran into an error saving your family data.", wait=False)
 
         # Update cache
-        parent_tree._children.append(child_id)
-        child_tree._parent = parent_id
-        async with self.bot.redis() as re:
-            await re.publish('TreeMemberUpdate', parent_tree.to_json())
-            await re.publish('TreeMemberUpdate', child_tree.to_json())
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.FamilyTreeUpdate(family_guild_id).add_child(parent_id, child_id).publish(re)
         await ctx.send(f"Added **{child_name}** to **{parent_name}**'s children list.", wait=False)
 
     @vbu.command(aliases=['forceeman'], add_slash_command=False)
@@ -379,15 +372,8 @@ class ServerSpecific(vbu.Cog):
             )
 
         # Update cache
-        try:
-            child_tree.parent._children.remove(child)
-        except ValueError:
-            pass
-        parent = child_tree.parent
-        child_tree._parent = None
-        async with self.bot.redis() as re:
-            await re.publish('TreeMemberUpdate', child_tree.to_json())
-            await re.publish('TreeMemberUpdate', parent.to_json())
+        async with utils.RedisPool.acquire(self.bot) as re:
+            await utils.FamilyTreeUpdate(family_guild_id).remove_child(child_tree._parent, child).publish(re)
         await ctx.send("Consider it done.", wait=False)
 
 
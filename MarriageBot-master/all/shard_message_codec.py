@@ -0,0 +1,132 @@
+import struct
+import typing
+
+import msgpack
+
+
+class ShardMessageCodec(object):
+    """
+    A compact binary format for the messages that shards send each other over Redis.
+
+    Every message is sent over the one `ShardMessages` channel, starting with a fixed size header of
+    the format version, the message type, the guild that the message is about (0 for messages that
+    every shard needs), and the update log sequence number (0 if there isn't one). The body is
+    msgpack with integer tags in place of field names. Since the header can be read without touching
+    the body, shards can skip messages about guilds that they don't serve without decoding them.
+    """
+
+    CHANNEL_NAME = "ShardMessages"
+    VERSION = 1
+    HEADER = struct.Struct("!BBQQ")  # Version, message type, guild ID, sequence
+
+    # These values are part of the wire format - only ever add to them
+    MESSAGE_TYPES: typing.Dict[str, int] = {
+        "UpdateGuildPrefix": 1,
+        "UpdateFamilyMaxMembers": 2,
+        "UpdateIncestAllowed": 3,
+        "UpdateMaxChildren": 4,
+        "UpdateGifsEnabled": 5,
+        "SendUserMessage": 6,
+        "BlockedUserAdd": 7,
+        "BlockedUserRemove": 8,
+        "FamilyTreeUpdate": 9,
+        "UpdateUserPerks": 10,
+        "UpdateGoldGuild": 11,
+    }
+    FIELD_TAGS: typing.Dict[str, int] = {
+        "guild_id": 0,
+        "prefix": 1,
+        "gold_prefix": 2,
+        "max_family_members": 3,
+        "allow_incest": 4,
+        "max_children": 5,
+        "gifs_enabled": 6,
+        "bot_id": 7,
+        "user_id": 8,
+        "content": 9,
+        "blocked_user_id": 10,
+        "changes": 11,
+        "user_ids": 12,
+        "tier": 13,
+        "valid_until": 14,
+    }
+    MESSAGE_NAMES: typing.Dict[int, str] = {o: i for i, o in MESSAGE_TYPES.items()}
+    FIELD_NAMES: typing.Dict[int, str] = {o: i for i, o in FIELD_TAGS.items()}
+
+    @classmethod
+    def encode_body(cls, payload: dict) -> bytes:
+        """
+        Encode just the body of a message.
+        """
+
+        return msgpack.packb({cls.FIELD_TAGS[i]: o for i, o in payload.items()}, use_bin_type=True)
+
+    @classmethod
+    def encode_header(cls, message_name: str, guild_id: int = 0, sequence: int = 0) -> bytes:
+        """
+        Encode just the header of a message.
+        """
+
+        return cls.HEADER.pack(cls.VERSION, cls.MESSAGE_TYPES[message_name], guild_id or 0, sequence or 0)
+
+    @classmethod
+    def encode(cls, message_name: str, payload: dict, *, guild_id: int = None) -> bytes:
+        """
+        Encode a message to be sent to other shards.
+
+        Args:
+            message_name (str): The name of the message (eg `UpdateGuildPrefix`).
+            payload (dict): The data to send.
+            guild_id (int, optional): The guild the message is about. Defaults to the payload's `guild_id`.
+
+        Returns:
+            bytes: The encoded message.
+        """
+
+        if guild_id is None:
+            guild_id = int(payload.get('guild_id') or 0)
+        return cls.encode_header(message_name, guild_id) + cls.encode_body(payload)
+
+    @classmethod
+    def decode_header(cls, data: bytes) -> typing.Tuple[str, int, int]:
+        """
+        Decode the header of a message without touching its body.
+
+        Returns:
+            typing.Tuple[str, int, int]: The message name, guild ID, and sequence number.
+
+        Raises:
+            ValueError: The message is from a version of the format that we don't know, or is of
+                a type that we don't know.
+        """
+
+        version, message_type, guild_id, sequence = cls.HEADER.unpack_from(data)
+        if version != cls.VERSION:
+            raise ValueError(f"Unknown shard message version {version}")
+        try:
+            return cls.MESSAGE_NAMES[message_type], guild_id, sequence
+        except KeyError:
+            raise ValueError(f"Unknown shard message type {message_type}")
+
+    @classmethod
+    def decode_body(cls, data: bytes) -> dict:
+        """
+        Decode the body of a message, skipping over its header.
+        """
+
+        body = msgpack.unpackb(data[cls.HEADER.size:], raw=False, strict_map_key=False)
+        return {cls.FIELD_NAMES[i]: o for i, o in body.items()}
+
+    @classmethod
+    async def publish(cls, re, message_name: str, payload: dict, *, guild_id: int = None) -> None:
+        """
+        Encode a message and send it to every shard.
+
+        Args:
+            re (utils.RedisConnection): The Redis connection to publish over.
+            message_name (str): The name of the message (eg `UpdateGuildPrefix`).
+            payload (dict): The data to send.
+            guild_id (int, optional): The guild the message is about. Defaults to the payload's `guild_id`.
+        """
+
+        await re.conn.publish(cls.CHANNEL_NAME, cls.encode(message_name, payload, guild_id=guild_id))
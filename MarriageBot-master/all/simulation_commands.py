@@ -18,7 +18,7 @@ class SimulationCommands(vbu.Cog):
         # See if we should return anything anyway
         if not ctx.guild:
             return None
-        if not self.bot.guild_settings[ctx.guild.id]['gifs_enabled']:
+        if not (await utils.GuildSettingsCache.get(self.bot, ctx.guild.id))['gifs_enabled']:
             return None
 
         # Make sure we have an API key
@@ -486,7 +486,7 @@ class SimulationCommands(vbu.Cog):
         # See if they're already related
         async with ctx.typing():
             relation = author_tree.get_relation(target_tree)
-        if relation and relation != "partner" and utils.guild_allows_incest(ctx) is False:
+        if relation and relation != "partner" and await utils.GuildSettingsCache.guild_allows_incest(ctx) is False:
             return await ctx.send(
                 f"Woah woah woah, it looks like you guys are related! {target.mention} is your {relation}!",
                 allowed_mentions=utils.only_mention(ctx.author),
@@ -0,0 +1,93 @@
+import io
+import re
+import typing
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class TreeImageOptimiser(object):
+    """
+    Shrinks rendered tree images before they're uploaded to Discord.
+
+    Trees only use the handful of colours that a user has picked (plus whatever antialiasing
+    blends them together), so quantising them down to a small palette loses next to nothing,
+    and we can make sure huge trees are rendered at a DPI that keeps them a sensible size.
+    """
+
+    # Enough colours for the 6 that a user picks and a few shades of antialiasing between them
+    PALETTE_SIZE = 32
+
+    # The biggest image (in pixels) that we want to render
+    MAX_IMAGE_PIXELS = 4096 * 4096
+    MIN_DPI = 24
+
+    BOUNDING_BOX_REGEX = re.compile(r'bb="([\d.]+),([\d.]+),([\d.]+),([\d.]+)"')
+
+    @classmethod
+    def is_available(cls) -> bool:
+        """
+        Whether or not we're able to post-process images.
+        """
+
+        return Image is not None
+
+    @classmethod
+    def get_dpi_for_layout(cls, layout: str, dpi: int) -> int:
+        """
+        Get the DPI that a positioned DOT script should be rendered at so that the resulting image
+        doesn't go over our maximum size.
+
+        Args:
+            layout (str): The positioned DOT script.
+            dpi (int): The DPI that we'd like to render at.
+
+        Returns:
+            int: The DPI that the tree should be rendered at.
+        """
+
+        match = cls.BOUNDING_BOX_REGEX.search(layout)
+        if match is None:
+            return dpi
+        left, bottom, right, top = [float(i) for i in match.groups()]
+        width_inches, height_inches = (right - left) / 72, (top - bottom) / 72  # The bounding box is in points
+        image_pixels = (width_inches * dpi) * (height_inches * dpi)
+        if image_pixels <= cls.MAX_IMAGE_PIXELS:
+            return dpi
+        scale = (cls.MAX_IMAGE_PIXELS / image_pixels) ** 0.5
+        return max(int(dpi * scale), cls.MIN_DPI)
+
+    @classmethod
+    def optimise(cls, image_data: bytes, *, image_format: str = "png") -> typing.Tuple[bytes, str]:
+        """
+        Quantise a rendered tree to a small palette and re-encode it.
+
+        Args:
+            image_data (bytes): The PNG data that came out of the renderer.
+            image_format (str, optional): The format to output - either "png" or "webp".
+
+        Returns:
+            typing.Tuple[bytes, str]: The optimised image data, and the file extension that it should be sent with.
+        """
+
+        image = Image.open(io.BytesIO(image_data))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        output = io.BytesIO()
+
+        # WebP does better on the full colour image than a quantised one
+        if image_format == "webp":
+            image.save(output, "WEBP", lossless=True, method=6)
+            return output.getvalue(), "webp"
+
+        # Quantise the PNG
+        method = Image.FASTOCTREE if image.mode == "RGBA" else Image.MEDIANCUT
+        image = image.quantize(colors=cls.PALETTE_SIZE, method=method)
+        image.save(output, "PNG", optimize=True)
+
+        # And only use it if it's actually smaller
+        if len(output.getvalue()) >= len(image_data):
+            return image_data, "png"
+        return output.getvalue(), "png"
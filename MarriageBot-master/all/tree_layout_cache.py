@@ -0,0 +1,119 @@
+import asyncio
+import collections
+import hashlib
+import typing
+
+
+class TreeLayoutError(Exception):
+    """Raised when Graphviz fails to lay out or render a tree."""
+
+
+class TreeLayoutCache(object):
+    """
+    A cache of Graphviz layouts, keyed by the unstyled DOT script that was laid out.
+
+    Laying out a tree is the expensive part of rendering it, but the unstyled script only changes
+    when the family itself (or the tree's direction) does - the colours that a user picks are added
+    on top of the layout afterwards, so changing them never needs a new layout.
+    """
+
+    cached_layouts: typing.Dict[str, str] = collections.OrderedDict()
+    max_cached_layouts: int = 250
+
+    @staticmethod
+    def get_cache_key(dot_script: str) -> str:
+        """
+        Get the key that a given unstyled DOT script would be cached under.
+        """
+
+        return hashlib.sha1(dot_script.encode()).hexdigest()
+
+    @classmethod
+    def is_cached(cls, dot_script: str) -> bool:
+        """
+        Get whether a layout for an unstyled DOT script is cached, so that getting it won't run Graphviz.
+        """
+
+        return cls.get_cache_key(dot_script) in cls.cached_layouts
+
+    @classmethod
+    async def get_layout(cls, dot_script: str, *, timeout: float = 10.0) -> str:
+        """
+        Get the positioned DOT script for an unstyled DOT script, running it through Graphviz
+        if we haven't laid it out recently.
+
+        Args:
+            dot_script (str): The unstyled DOT script to be laid out.
+            timeout (float, optional): How long Graphviz is given to lay out the tree.
+
+        Returns:
+            str: The DOT script with all of the node and edge positions filled in.
+
+        Raises:
+            asyncio.TimeoutError: Graphviz didn't lay out the tree in time.
+            TreeLayoutError: Graphviz failed to lay out the tree.
+        """
+
+        # See if it's cached
+        key = cls.get_cache_key(dot_script)
+        layout = cls.cached_layouts.get(key)
+        if layout is not None:
+            cls.cached_layouts.move_to_end(key)
+            return layout
+
+        # Lay it out
+        dot = await asyncio.create_subprocess_exec(
+            'dot', '-Tdot', '-Gcharset=UTF-8',
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(dot.communicate(dot_script.encode()), timeout)
+        finally:
+            try:
+                dot.kill()
+            except ProcessLookupError:
+                pass  # It already died
+        layout = stdout.decode()
+        if dot.returncode != 0 or "{" not in layout:
+            raise TreeLayoutError(f"dot exited with return code {dot.returncode}")
+
+        # Cache it, evicting the least recently used layouts
+        cls.cached_layouts[key] = layout
+        while len(cls.cached_layouts) > cls.max_cached_layouts:
+            cls.cached_layouts.popitem(last=False)
+        return layout
+
+    @staticmethod
+    async def render_layout(
+            layout: str, format_rendering_option: str, image_filename: str, *,
+            dpi: int = 96, timeout: float = 10.0) -> None:
+        """
+        Render an already positioned (and styled) DOT script into an image. This uses neato
+        with `-n2` so that Graphviz uses the positions it's given rather than laying out the
+        tree again.
+
+        Args:
+            layout (str): The positioned DOT script.
+            format_rendering_option (str): The Graphviz output format (eg `-Tpng:cairo`).
+            image_filename (str): Where the image should be saved.
+            dpi (int, optional): The DPI that the image should be rendered at.
+            timeout (float, optional): How long Graphviz is given to render the image.
+
+        Raises:
+            asyncio.TimeoutError: Graphviz didn't render the tree in time.
+            TreeLayoutError: Graphviz failed to render the tree.
+        """
+
+        neato = await asyncio.create_subprocess_exec(
+            'neato', '-n2', format_rendering_option, '-o', image_filename, '-Gcharset=UTF-8', f'-Gdpi={dpi}',
+            stdin=asyncio.subprocess.PIPE,
+        )
+        try:
+            await asyncio.wait_for(neato.communicate(layout.encode()), timeout)
+        finally:
+            try:
+                neato.kill()
+            except ProcessLookupError:
+                pass  # It already died
+        if neato.returncode != 0:
+            raise TreeLayoutError(f"neato exited with return code {neato.returncode}")
@@ -0,0 +1,83 @@
+import asyncio
+import typing
+
+
+class TreeRenderError(Exception):
+    """Raised when a tree can't be rendered, with the message to give to the user."""
+
+
+class TreeRender(object):
+    """
+    A rendered tree image, along with the part of the family that it shows.
+    """
+
+    __slots__ = ("image_data", "image_extension", "original_image_size", "renderer_name", "window_centre", "gen_span",)
+
+    def __init__(
+            self, image_data: bytes, image_extension: str, original_image_size: int, renderer_name: str,
+            window_centre, gen_span: dict):
+        self.image_data = image_data
+        self.image_extension = image_extension
+        self.original_image_size = original_image_size
+        self.renderer_name = renderer_name
+        self.window_centre = window_centre
+        self.gen_span = gen_span
+
+
+class TreeRenderRegistry(object):
+    """
+    The tree renders that are currently in progress, so that identical requests share one render
+    rather than each drawing the same tree from scratch.
+
+    Renders are keyed by everything that decides what the image looks like - including the
+    family's version (see `get_family_version`), so a render never gets shared across a change to
+    the family. Renders are removed as soon as they finish, so nothing is kept for users who have
+    stopped asking for trees.
+    """
+
+    renders_in_flight: typing.Dict[typing.Hashable, asyncio.Task] = {}
+
+    @staticmethod
+    def get_family_version(gen_span: dict) -> int:
+        """
+        Get a number that changes whenever anyone in a generational span is changed.
+        """
+
+        return max((i._mutation for generation in gen_span.values() for i in generation), default=0)
+
+    @classmethod
+    def is_rendering(cls, key: typing.Hashable) -> bool:
+        """
+        Get whether there's already a render in progress for a key.
+        """
+
+        return key in cls.renders_in_flight
+
+    @classmethod
+    async def render(cls, key: typing.Hashable, render: typing.Callable[[], typing.Awaitable[TreeRender]]) -> TreeRender:
+        """
+        Render a tree, or wait for the identical render that's already in progress.
+
+        Args:
+            key (typing.Hashable): Everything that decides what the image looks like.
+            render (typing.Callable[[], typing.Awaitable[TreeRender]]): Starts the render if there isn't one in progress.
+
+        Returns:
+            TreeRender: The rendered tree.
+
+        Raises:
+            TreeRenderError: The tree couldn't be rendered.
+        """
+
+        def on_done(task):
+            if cls.renders_in_flight.get(key) is task:
+                del cls.renders_in_flight[key]
+            if not task.cancelled():
+                task.exception()  # Anything waiting on the task gets the error - don't warn about it
+
+        task = cls.renders_in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(render())
+            cls.renders_in_flight[key] = task
+            task.add_done_callback(on_done)
+        return await asyncio.shield(task)
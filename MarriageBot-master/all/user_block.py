@@ -1,5 +1,7 @@
 from discord.ext import commands
 
+from cogs.utils.blocked_user_index import BlockedUserIndex
+
 
 class BlockedUserError(commands.BadArgument):
     """The error raised when a given user is blocked by the author."""
@@ -13,8 +15,11 @@ class UnblockedMember(commands.MemberConverter):
 
     async def convert(self, ctx:commands.Context, argument:str):
         user = await super().convert(ctx, argument)
-        async with ctx.bot.database() as db:
-            data = await db("SELECT * FROM blocked_user WHERE user_id=$1 AND blocked_user_id=$2", user.id, ctx.author.id)
+        if BlockedUserIndex.loaded:
+            data = BlockedUserIndex.is_blocked(user.id, ctx.author.id)
+        else:
+            async with ctx.bot.database() as db:
+                data = await db("SELECT * FROM blocked_user WHERE user_id=$1 AND blocked_user_id=$2", user.id, ctx.author.id)
         if data:
             raise BlockedUserError(f"You have been blocked by {user.mention}.")
         return user
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+# Let the tests import the bot's cogs the same way that the bot does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeStats(object):
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+    def __getattr__(self, _):
+        return lambda *args, **kwargs: None
+
+
+@pytest.fixture
+def redis_bot():
+    """
+    A stand-in bot whose Redis connections go to the server at `TEST_REDIS_URL`. Tests using this
+    are skipped if there's no Redis server to talk to.
+    """
+
+    aioredis = pytest.importorskip("aioredis")
+    from cogs.utils.redis_pool import RedisPool
+
+    url = os.environ.get("TEST_REDIS_URL", "redis://localhost:6379")
+
+    async def get_connection():
+        return types.SimpleNamespace(conn=await aioredis.create_redis(url))
+
+    async def check_connection():
+        re = await get_connection()
+        re.conn.close()
+        await re.conn.wait_closed()
+
+    try:
+        asyncio.run(asyncio.wait_for(check_connection(), timeout=2))
+    except (OSError, asyncio.TimeoutError):
+        pytest.skip(f"no Redis server at {url}")
+
+    # Don't share pooled connections (or their event loops) between tests
+    RedisPool.idle_connections = []
+    RedisPool.connections_in_use = 0
+    RedisPool._semaphore = None
+    bot = types.SimpleNamespace(
+        config={},
+        redis=types.SimpleNamespace(get_connection=get_connection),
+        stats=FakeStats,
+    )
+    yield bot
+    RedisPool.idle_connections = []  # Their event loop has closed already
+    RedisPool._semaphore = None
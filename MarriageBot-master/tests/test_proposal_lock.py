@@ -0,0 +1,111 @@
+import asyncio
+import random
+
+import pytest
+
+pytest.importorskip("voxelbotutils")
+from cogs.utils.proposal_message_checker import ProposalInProgress, ProposalLock  # noqa: E402
+
+
+def get_user_ids(count: int):
+    """
+    Get some user IDs that won't clash with anything else in the Redis server.
+    """
+
+    start = random.randrange(1 << 40, 1 << 50)
+    return list(range(start, start + count))
+
+
+async def try_lock(bot, *user_ids):
+    try:
+        return await ProposalLock.lock(bot, *user_ids)
+    except ProposalInProgress:
+        return None
+
+
+async def get_lock_values(bot, *user_ids):
+    re = await bot.redis.get_connection()
+    try:
+        return await re.conn.mget(*[str(i) for i in user_ids], encoding="utf-8")
+    finally:
+        re.conn.close()
+
+
+def test_racing_proposals_lock_all_or_nothing(redis_bot):
+    """
+    Overlapping proposals started at the same time never both get their locks, and a proposal that
+    doesn't get its locks doesn't hold on to any of them.
+    """
+
+    async def race():
+        for _ in range(50):
+            a, b, c = get_user_ids(3)
+            attempts = [(a, b), (b, c), (c, a)] * 5
+            random.shuffle(attempts)
+            locks = await asyncio.gather(*[try_lock(redis_bot, *i) for i in attempts])
+            held = [i for i in locks if i is not None]
+
+            # Every pair shares a user with every other pair, so only one can have won
+            assert len(held) == 1
+            winner = held[0]
+
+            # The user that isn't in the winning proposal is still free
+            values = dict(zip((a, b, c), await get_lock_values(redis_bot, a, b, c)))
+            for user_id, value in values.items():
+                if str(user_id) in winner.keys:
+                    assert value == winner.token
+                else:
+                    assert value is None
+            await winner.unlock()
+            assert await get_lock_values(redis_bot, a, b, c) == [None, None, None]
+
+    asyncio.run(race())
+
+
+def test_unlock_only_releases_our_own_locks(redis_bot):
+    """
+    A proposal whose lock expired and was taken by another proposal doesn't release the other
+    proposal's lock when it finishes.
+    """
+
+    async def run():
+        a, b = get_user_ids(2)
+        first = await ProposalLock.lock(redis_bot, a, b)
+
+        # Pretend that the first proposal's lock on A expired, and someone else took it
+        re = await redis_bot.redis.get_connection()
+        try:
+            await re.conn.delete(str(a))
+        finally:
+            re.conn.close()
+        second = await ProposalLock.lock(redis_bot, a)
+        assert second.token != first.token
+
+        # The first unlock only releases B
+        await first.unlock()
+        assert await get_lock_values(redis_bot, a, b) == [second.token, None]
+        await second.unlock()
+        assert await get_lock_values(redis_bot, a, b) == [None, None]
+
+    asyncio.run(run())
+
+
+def test_locks_expire(redis_bot):
+    """
+    Locks are taken with a timeout, so a shard dying mid-proposal doesn't lock its users forever.
+    """
+
+    async def run():
+        a, = get_user_ids(1)
+        async with await ProposalLock.lock(redis_bot, a):
+            re = await redis_bot.redis.get_connection()
+            try:
+                ttl = await re.conn.pttl(str(a))
+            finally:
+                re.conn.close()
+            assert 0 < ttl <= ProposalLock.LOCK_TIMEOUT * 1_000
+            with pytest.raises(ProposalInProgress):
+                await ProposalLock.lock(redis_bot, a)
+        assert await get_lock_values(redis_bot, a) == [None]
+
+    asyncio.run(run())
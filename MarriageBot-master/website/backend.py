@@ -1,3 +1,4 @@
+from datetime import datetime as dt
 import json
 
 from aiohttp.web import HTTPFound, Request, Response, RouteTableDef, json_response
@@ -75,7 +76,7 @@ async def set_prefix(request: Request):
             'prefix': prefix,
             'gold_prefix': gold_prefix,
         }
-        await re.publish('UpdateGuildPrefix', redis_data)
+        await botutils.ShardMessageCodec.publish(re, 'UpdateGuildPrefix', redis_data)
 
     # Redirect to page
     return json_response({"error": ""}, status=200)
@@ -106,7 +107,7 @@ async def set_gifs_enabled(request: Request):
             checked_data['guild_id'], enabled,
         )
     async with request.app['redis']() as re:
-        await re.publish('UpdateGifsEnabled', {
+        await botutils.ShardMessageCodec.publish(re, 'UpdateGifsEnabled', {
             'guild_id': checked_data['guild_id'],
             'gifs_enabled': enabled,
         })
@@ -140,7 +141,7 @@ async def set_incest_enabled(request: Request):
             checked_data['guild_id'], enabled,
         )
     async with request.app['redis']() as re:
-        await re.publish('UpdateIncestAllowed', {
+        await botutils.ShardMessageCodec.publish(re, 'UpdateIncestAllowed', {
             'guild_id': checked_data['guild_id'],
             'allow_incest': enabled,
         })
@@ -179,7 +180,7 @@ async def set_max_allowed_children(request: Request):
                 pass
         await db.commit_transaction()
     async with request.app['redis']() as re:
-        await re.publish('UpdateMaxChildren', {
+        await botutils.ShardMessageCodec.publish(re, 'UpdateMaxChildren', {
             'guild_id': checked_data['guild_id'],
             'max_children': max_children_dict,
         })
@@ -221,7 +222,7 @@ async def unblock_user_post_handler(request: Request):
             logged_in_user, blocked_user,
         )
     async with request.app['redis']() as re:
-        await re.publish("BlockedUserRemove", {"user_id": logged_in_user, "blocked_user_id": blocked_user})
+        await botutils.ShardMessageCodec.publish(re, "BlockedUserRemove", {"user_id": logged_in_user, "blocked_user_id": blocked_user})
 
     # Redirect back to user settings
     return json_response({"error": ""}, status=200)
@@ -286,18 +287,19 @@ async def change_gold_guild(request: Request):
     session = await aiohttp_session.get_session(request)
     logged_in_user = session['user_id']
 
-    # Save the data to the database
+    # Save the data to the database - this only changes anything if they own the guild
+    before_guild_id, after_guild_id = int(post_data['before']), int(post_data['after'])
     async with request.app['database']() as db:
-        rows = await db(
-            """SELECT * FROM guild_specific_families WHERE purchased_by=$1 AND guild_id=$2""",
-            logged_in_user, int(post_data['before']),
-        )
-        if not rows:
-            return json_response({"error": "You don't own the guild that you're trying to move gold from."}, status=401)
-        await db(
-            """UPDATE guild_specific_families SET guild_id=$3 WHERE purchased_by=$1 AND guild_id=$2""",
-            logged_in_user, int(post_data['before']), int(post_data['after']),
+        changed_rows = await db(
+            """UPDATE guild_specific_families SET guild_id=$3 WHERE purchased_by=$1 AND guild_id=$2
+            RETURNING guild_id""",
+            logged_in_user, before_guild_id, after_guild_id,
         )
+    if not changed_rows:
+        return json_response({"error": "You don't own the guild that you're trying to move gold from."}, status=401)
+    async with request.app['redis']() as re:
+        await botutils.GoldGuildIndex.update(re, before_guild_id, None)
+        await botutils.GoldGuildIndex.update(re, after_guild_id, logged_in_user)
 
     # Redirect back to user settings
     return json_response({"error": ""}, status=200)
@@ -322,18 +324,27 @@ async def paypal_purchase_complete(request: Request):
     async with request.app['database']() as db:
         refund = data.get('refund', False) or data.get('refunded', False)
         if refund is False:
-            await db(
-                """INSERT INTO guild_specific_families VALUES ($1, $2) ON CONFLICT (guild_id) DO NOTHING""",
+            changed_rows = await db(
+                """INSERT INTO guild_specific_families VALUES ($1, $2) ON CONFLICT (guild_id) DO NOTHING
+                RETURNING purchased_by""",
                 int(data['discord_guild_id']), int(data['discord_user_id']),
             )
+            purchaser_id = int(data['discord_user_id'])
             discord_channel_send_text = f"<@{data['discord_user_id']}> has purchased MarriageBot Gold."
         else:
-            await db(
-                """DELETE FROM guild_specific_families WHERE guild_id=$1""",
+            changed_rows = await db(
+                """DELETE FROM guild_specific_families WHERE guild_id=$1 RETURNING purchased_by""",
                 int(data['discord_guild_id']),
             )
+            purchaser_id = None
             discord_channel_send_text = f"<@{data['discord_user_id']}> has refunded their purchase of MarriageBot Gold."
 
+        # Update the Gold guilds and their perks
+        async with request.app['redis']() as re:
+            if changed_rows:
+                await botutils.GoldGuildIndex.update(re, int(data['discord_guild_id']), purchaser_id)
+            await botutils.update_gold_guild_perks(db, re, int(data['discord_user_id']))
+
     # Send data to channel
     bot = request.app['bots']['bot']
     channel_id = request.app['config']['payment_info']['notification_channel_id']
@@ -346,3 +357,65 @@ async def paypal_purchase_complete(request: Request):
 
     # And we done
     return Response(status=200)
+
+
+@routes.post('/webhooks/topgg/vote')
+async def topgg_vote(request: Request):
+    """
+    Handles Top.gg telling us that someone has voted for the bot.
+    """
+
+    # Check the headers
+    if request.headers.get("Authorization", None) != request.app['config']['topgg']['webhook_authorization']:
+        return Response(status=200)
+    data = await request.json()
+    if data.get('type') != "upvote":
+        return Response(status=200)
+
+    # Update the database and their perks
+    user_id = int(data['user'])
+    voted_at = dt.utcnow()
+    async with request.app['database']() as db:
+        await db(
+            """INSERT INTO dbl_votes (user_id, timestamp) VALUES ($1, $2)
+            ON CONFLICT (user_id) DO UPDATE SET timestamp=excluded.timestamp""",
+            user_id, voted_at,
+        )
+        async with request.app['redis']() as re:
+            await botutils.update_user_perks(db, re, user_id, last_voted=voted_at)
+
+    # And we done
+    return Response(status=200)
+
+
+@routes.post('/webhooks/upgrade_chat')
+async def upgrade_chat_order_update(request: Request):
+    """
+    Handles Upgrade.Chat telling us that someone's orders have changed.
+    """
+
+    # Check the headers
+    if request.headers.get("Authorization", None) != request.app['config']['upgrade_chat']['webhook_authorization']:
+        return Response(status=200)
+    data = await request.json()
+    try:
+        user_id = int(data['body']['user']['discord_id'])
+    except (KeyError, TypeError, ValueError):
+        return Response(status=400)
+
+    # Get their orders as they are now rather than trusting the event
+    bot = request.app['bots']['bot']
+    purchased_item_names = await botutils.fetch_upgrade_chat_item_names(bot, user_id)
+    if purchased_item_names is None:
+        return Response(status=503)  # Upgrade.Chat will send the event again
+
+    # Update the database and their perks
+    async with request.app['database']() as db:
+        async with request.app['redis']() as re:
+            await botutils.update_user_perks(
+                db, re, user_id,
+                upgrade_chat_tier=botutils.get_upgrade_chat_tier(purchased_item_names),
+            )
+
+    # And we done
+    return Response(status=200)
@@ -95,10 +95,9 @@ async def user_settings(request: Request):
         session['user_id'],
     )
     bot = request.app['bots']['bot']
-    blocked_users = {
-        i['blocked_user_id']: await botutils.DiscordNameManager.fetch_name_by_id(bot, i['blocked_user_id'])
-        for i in blocked_users_db
-    }
+    blocked_users = await botutils.DiscordNameManager.fetch_names_by_ids(
+        bot, [i['blocked_user_id'] for i in blocked_users_db],
+    )
 
     # Give all the data to the page
     await db.disconnect()
@@ -131,12 +130,11 @@ async def guild_picker(request: Request):
     guild_ids = [i.guild.id for i in guilds]
 
     # Get guilds that have gold attached
-    async with request.app['database']() as db:
-        gold_guild_data = await db(
-            """SELECT guild_id FROM guild_specific_families WHERE guild_id=ANY($1::BIGINT[])""",
-            guild_ids,
-        )
-    gold_guild_ids = [i['guild_id'] for i in gold_guild_data]
+    async with request.app['redis']() as re:
+        gold_guild_ids = await botutils.GoldGuildIndex.fetch_purchasers(re, guild_ids)
+    if gold_guild_ids is None:
+        async with request.app['database']() as db:
+            gold_guild_ids = await botutils.GoldGuildIndex.fetch_purchasers_from_db(db, guild_ids)
     for i in guilds:
         if i.guild.id in gold_guild_ids:
             i.guild.gold = True
@@ -243,16 +241,17 @@ async def guild_settings(request: Request):
             guild_id,
         )
 
-        # See if this guild has gold
-        gold_settings = await db(
-            """SELECT * FROM guild_specific_families WHERE guild_id=$1""",
-            guild_id,
-        )
-
         # Get children amount that they've set
         max_children_data = await db('SELECT * FROM max_children_amount WHERE guild_id=$1', guild_id)
         max_children_amount = {i['role_id']: i['amount'] for i in max_children_data}
 
+    # See if this guild has gold
+    async with request.app['redis']() as re:
+        gold_settings = await botutils.GoldGuildIndex.fetch_purchasers(re, [guild_id])
+    if gold_settings is None:
+        async with request.app['database']() as db:
+            gold_settings = await botutils.GoldGuildIndex.fetch_purchasers_from_db(db, [guild_id])
+
     # Sort the role object
     guild_roles = sorted([i for i in await guild_object.fetch_roles()], key=lambda c: c.position, reverse=True)
 
@@ -287,13 +286,13 @@ async def change_gold_guild(request: Request):
     guilds = [i for i in all_guilds if i.guild.owner_id == i.id or i.guild_permissions.manage_guild]
     guild_ids = [i.guild.id for i in guilds]
 
-    # Get guilds that have gold attached
+    # Get the guilds that they bought gold for, and which of their guilds have gold attached
     async with request.app['database']() as db:
-        gold_guild_data = await db(
-            """SELECT * FROM guild_specific_families WHERE purchased_by=$1 OR guild_id=ANY($2::BIGINT[])""",
+        gold_guild_rows = await db(
+            """SELECT guild_id, purchased_by FROM guild_specific_families WHERE purchased_by=$1 OR guild_id=ANY($2::BIGINT[])""",
             session['user_id'], guild_ids,
         )
-    gold_guild_ids = [i['guild_id'] for i in gold_guild_data]
+    gold_guild_ids = {i['guild_id'] for i in gold_guild_rows}
     for i in guilds:
         if i.guild.id in gold_guild_ids:
             i.guild.gold = True
@@ -302,6 +301,6 @@ async def change_gold_guild(request: Request):
 
     # Send off guilds to the page
     return {
-        "user_gold_guilds": [i['guild_id'] for i in gold_guild_data if i['purchased_by'] == session['user_id']],
+        "user_gold_guilds": [i['guild_id'] for i in gold_guild_rows if i['purchased_by'] == session['user_id']],
         "guilds": guilds,
     }